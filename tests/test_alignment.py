@@ -4,6 +4,7 @@ import os
 import tarfile
 from io import StringIO, BytesIO
 import unittest
+import random
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
 
 #from collections import namedtuple
@@ -12,6 +13,10 @@ from tempfile import NamedTemporaryFile, TemporaryDirectory
 from ete4 import Tree
 from treeprofiler import tree_annotate
 from treeprofiler.src import utils
+from treeprofiler.src import consensus
+from treeprofiler.src.alignment_store import AlignmentStore
+from treeprofiler.src import domain_table
+from treeprofiler.src.tree_index import TreeIndex
 
 class TestMSA(unittest.TestCase):
     def test_annotate_msa(self):
@@ -35,6 +40,62 @@ class TestMSA(unittest.TestCase):
             expected_tree_msa = '(A:1[&&NHX:alignment=MAEIPDETIQQFMALT---HNIAVQYLSEFGDLNEALNSYYASQTDDIKDRREEAH],(B:1[&&NHX:alignment=MAEIPDATIQQFMALTNVSHNIAVQY--EFGDLNEALNSYYAYQTDDQKDRREEAH],(E:1[&&NHX:alignment=MAEIPDATIQ---ALTNVSHNIAVQYLSEFGDLNEALNSYYASQTDDQPDRREEAH],D:1[&&NHX:alignment=MAEAPDETIQQFMALTNVSHNIAVQYLSEFGDLNEAL--------------REEAH])Internal_1:0.5[&&NHX:alignment=MAE-PD-TIQQFMALTNVSHNIAVQYLSEFGDLNEALNSYYASQTDDQPDRREEAH])Internal_2:0.5[&&NHX:alignment=MAE-PD-TIQQFMALTNVSHNIAVQYLSEFGDLNEALNSYYA-QTDDQ-DRREEAH])Root[&&NHX:alignment=MAEIPD-TIQQFMALTNVSHNIAVQYLSEFGDLNEALNSYYA-QTDD--DRREEAH];'
             self.assertEqual(test_tree_annotated_msa.write(props=['alignment'], parser=parser, format_root_node=True), expected_tree_msa)
 
+    def test_clade_consensus(self):
+        # bottom-up profiles give the same consensus as get_consensus_seq on each clade, ties and gaps included
+        random.seed(1)
+        tree = Tree()
+        tree.populate(30)
+        name2seq = {leaf.name: ''.join(random.choice('AAC-.') for _ in range(40)) for leaf in tree.leaves()}
+        name2seq[next(tree.leaves()).name] = ''
+        encoded = consensus.EncodedAlignment.from_dict(name2seq)
+
+        for cutoff in (0.3, 0.7, 1.0):
+            results = dict(consensus.clade_consensus(TreeIndex(tree), encoded, threshold=cutoff))
+            for node in tree.traverse():
+                if node.is_leaf:
+                    continue
+                matrix_string = ''.join(f">{leaf.name}\n{name2seq[leaf.name]}\n" for leaf in node.leaves() if name2seq[leaf.name])
+                expected = str(utils.get_consensus_seq(matrix_string, threshold=cutoff))
+                self.assertEqual(results.get(node, ''), expected)
+
+    def test_alignment_store(self):
+        # wrapped records, duplicated names and the .npy cache give the same sequences
+        with TemporaryDirectory() as tmpdir:
+            fasta_file = os.path.join(tmpdir, 'aln.faa')
+            with open(fasta_file, 'w') as f_alignment:
+                f_alignment.write('>A desc\nMAE-\nPDE\n>B\nMA--PD\n>C\nXXXX\n>C\nMAEIPDE\n')
+
+            expected = {'A desc': 'MAE-PDE', 'B': 'MA--PD', 'C': 'MAEIPDE'}
+            self.assertEqual(tree_annotate.parse_fasta(fasta_file), expected)
+            for _ in range(2):
+                store = AlignmentStore(fasta_file, cache=True)
+                self.assertEqual(dict(store.items()), expected)
+                self.assertEqual(store.window('C', 2, 5), 'EIP')
+                self.assertEqual(store.window('B', 4, 10), 'PD')
+                self.assertEqual(store.get('missing'), '')
+            self.assertTrue(os.path.exists(fasta_file + '.npy'))
+            self.assertEqual(store.encode().shape, (3, 7))
+
+    def test_translate_domains(self):
+        # raw residue positions become alignment columns, queries missing from the alignment are skipped
+        with TemporaryDirectory() as tmpdir:
+            fasta_file = os.path.join(tmpdir, 'aln.faa')
+            with open(fasta_file, 'w') as f_alignment:
+                f_alignment.write('>A\n--MA-E-IP\n>B\nMAEIP----\n')
+            smart_file = os.path.join(tmpdir, 'out.emapper.smart')
+            with open(smart_file, 'w') as f_smart:
+                f_smart.write('#query\tdomain\tstart\tend\nA\tdom1\t1\t3\nC\tdom2\t1\t2\nB\tdom3\t2\t5\nA\tdom4\t4\t5\n')
+
+            store = AlignmentStore(fasta_file)
+            for batch_size in (1, 3, 100):
+                translated = list(domain_table.translate_domains(smart_file, store, domain_table.SMART_COLUMNS, batch_size=batch_size))
+                self.assertEqual(translated, [('A', 'dom1', 3, 6), ('B', 'dom3', 2, 5), ('A', 'dom4', 8, 9)])
+
+            with open(smart_file, 'a') as f_smart:
+                f_smart.write('B\tdom5\t4\t6\n')
+            with self.assertRaises(KeyError):
+                list(domain_table.translate_domains(smart_file, store, domain_table.SMART_COLUMNS))
+
 if __name__ == '__main__':
     unittest.main()
 #pytest.main(['-v'])
\ No newline at end of file
@@ -13,6 +13,11 @@ from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 from treeprofiler import tree_annotate
 from treeprofiler.src import utils
+from treeprofiler.src import ls
+from treeprofiler.src import acr_continuous
+from treeprofiler.src import phylosignal
+from treeprofiler.src import permutation
+from treeprofiler.src.tree_index import TreeIndex
 import time
 
 class TestAnalytic(unittest.TestCase):
@@ -143,6 +148,42 @@ class TestAnalytic(unittest.TestCase):
         expected_tree_with_root = '(A:1[&&NHX:alphabet_type=vowel],(B:1[&&NHX:alphabet_type=vowel],(E:1[&&NHX:alphabet_type=consonant],D:1[&&NHX:alphabet_type=consonant])Internal_1:0.5[&&NHX:alphabet_type=consonant:alphabet_type_counter=consonant--2])Internal_2:0.5[&&NHX:alphabet_type=vowel:alphabet_type_counter=consonant--2||vowel--1])Root[&&NHX:alphabet_type=vowel:alphabet_type_counter=consonant--2||vowel--2];'
         self.assertEqual(test_tree_annotated.write(props=None, parser=parser, format_root_node=True), expected_tree_with_root)
 
+    def test_delta_chains(self):
+        # vectorized chains are reproducible per seed and keep the emcmc sample budget
+        marginal_probs = np.array([[0.9, 0.1], [0.8, 0.2], [0.3, 0.7], [0.6, 0.4], [0.1, 0.9]])
+        x = phylosignal.entropy_type(marginal_probs, 'SE')
+        samples = phylosignal.emcmc_chains(x, 0.1, 0.5, sim=1000, thin=10, burn=100, chains=4, seed=1)
+        self.assertEqual(samples.shape, (4, 46, 2))
+        self.assertTrue((samples > 0).all())
+        np.testing.assert_array_equal(samples,
+            phylosignal.emcmc_chains(x, 0.1, 0.5, sim=1000, thin=10, burn=100, chains=4, seed=1))
+
+        delta_1 = phylosignal.delta(marginal_probs, 0.1, 0.5, 1000, 10, 100, 'SE', seed=3)
+        delta_2 = phylosignal.delta(marginal_probs, 0.1, 0.5, 1000, 10, 100, 'SE', seed=3)
+        self.assertEqual(delta_1, delta_2)
+
+    def test_permutation_engine(self):
+        # shuffles only depend on the seed and the iteration number
+        column2states = {'alphabet_type': ['vowel', 'vowel', 'consonant', 'consonant', 'consonant']}
+        shuffled = permutation.shuffle_states(column2states, 42, 3)
+        self.assertEqual(shuffled, permutation.shuffle_states(column2states, 42, 3))
+        self.assertEqual(sorted(shuffled['alphabet_type']), sorted(column2states['alphabet_type']))
+        self.assertNotEqual(
+            [permutation.shuffle_states(column2states, 42, i) for i in range(10)],
+            [permutation.shuffle_states(column2states, 43, i) for i in range(10)])
+
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser="name")
+        targets = permutation.resolve_targets(test_tree, ['A', 'E||D', 'missing'])
+        self.assertEqual(targets[0], [test_tree['A']])
+        self.assertEqual(targets[1], [test_tree['Internal_1']])
+        self.assertEqual(targets[2], [])
+
+        # early stopping once the p-value is clearly on one side of alpha
+        self.assertTrue(permutation.pvalue_decided(0, 200))
+        self.assertTrue(permutation.pvalue_decided(150, 200))
+        self.assertFalse(permutation.pvalue_decided(0, 20))
+        self.assertFalse(permutation.pvalue_decided(10, 200))
+
     def test_acr_continuous_01(self):
         # test acr continuous with default
         # load tree
@@ -272,6 +313,49 @@ class TestAnalytic(unittest.TestCase):
         self.assertTrue(-3 <= float(test_tree_annotated['Internal_2'].props.get('length')) <= 3)
         self.assertTrue(-2 <= float(test_tree_annotated['Internal_1'].props.get('length')) <= 2)
 
+    def test_acr_continuous_04(self):
+        # covariance matrix from clade blocks and root value from independent contrasts
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:2)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser="name")
+        species = ['D', 'A', 'E', 'B']
+        V = acr_continuous.build_variance_covariance_matrix(test_tree, species, sigma=1.0)
+        expected = np.array([
+            [3.0, 0.0, 1.0, 0.5],
+            [0.0, 1.0, 0.0, 0.0],
+            [1.0, 0.0, 2.0, 0.5],
+            [0.5, 0.0, 0.5, 1.5],
+        ])
+        np.testing.assert_allclose(V, expected)
+
+        observed_traits = {'A': 1.0, 'B': 3.0, 'D': 0.2, 'E': 0.5}
+        Y = np.array([observed_traits[sp] for sp in species])
+        ones = np.ones(len(species))
+        V_inv = np.linalg.inv(V)
+        gls_root = (ones @ V_inv @ Y) / (ones @ V_inv @ ones)
+        self.assertAlmostEqual(acr_continuous.contrasts_root_estimate(test_tree, observed_traits), gls_root)
+
+        with self.assertRaises(ValueError):
+            acr_continuous.ml_acr(test_tree, 'length', observed_traits, model='OU', root_method='contrasts')
+
+    def test_acr_continuous_05(self):
+        # pruning reconstruction, root value is the GLS estimate
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser="name")
+        transformed_dict = {'length': {'A': 1.0, 'B': 1.0, 'D': 0.2, 'E': 0.4}}
+        gls_root = acr_continuous.contrasts_root_estimate(test_tree, transformed_dict['length'])
+
+        acr_result, test_tree = tree_annotate.run_acr_continuous(test_tree, transformed_dict,
+            prediction_method="PRUNING", model="BM")
+
+        self.assertAlmostEqual(test_tree.props.get('length'), gls_root)
+        self.assertAlmostEqual(acr_result['root']['length'], gls_root)
+        # cherry of E and D (mean 0.3, precision 2) combined with the rest
+        # of the tree seen through the branch above it (mean 1, variance 1.1)
+        internal_1 = acr_result['Internal_1']
+        self.assertAlmostEqual(internal_1['length'], (0.3 * 2 + 1 / 1.1) / (2 + 1 / 1.1))
+        lower, upper = internal_1['credible_interval']
+        self.assertTrue(lower < internal_1['length'] < upper)
+        self.assertTrue(internal_1['variance'] < acr_result['root']['variance'])
+        self.assertEqual(test_tree['D'].props.get('length'), 0.2)
+
     def test_ls_01(self):
         # test acr discrete with default
         # load tree
@@ -301,6 +385,37 @@ class TestAnalytic(unittest.TestCase):
 
         self.assertEqual(f1, 0.33)
         self.assertEqual(best_node.name, "Internal_16")
+
+    def test_ls_02(self):
+        # vectorized metrics of several props match per node calculate_metrics
+        test_tree = utils.ete4_parse("((A:1,(B:1,C:1)N3:1)N2:1,((D:1,E:1)N5:1,F:1)N4:1)Root;")
+        traits = {
+            'a': {'A': 'True', 'B': '1', 'C': 'yes', 'D': '0', 'E': 'False', 'F': 'x'},
+            'b': {'A': '0', 'B': '0', 'C': '0', 'D': '0', 'E': '0', 'F': '0'},
+            'c': {'A': '0', 'B': '0', 'C': '0', 'D': '1', 'E': '1', 'F': '1'},
+        }
+        props = list(traits)
+        for leaf in test_tree.leaves():
+            for prop in props:
+                leaf.add_prop(prop, traits[prop][leaf.name])
+
+        tree_index = TreeIndex(test_tree)
+        matrix = ls.trait_matrix(tree_index, props)
+        precision, sensitivity, f1 = ls.ls_metrics(tree_index, matrix)
+        for j, prop in enumerate(props):
+            total_with_trait = ls.get_total_trait(test_tree, prop)
+            for node in test_tree.traverse():
+                if node.is_leaf:
+                    continue
+                i = tree_index.node_id(node)
+                expected = ls.calculate_metrics(node, total_with_trait, prop)
+                self.assertEqual((precision[i, j], sensitivity[i, j], f1[i, j]), expected)
+
+        best_node, qualified_nodes = ls.run_ls(test_tree, props, precision_cutoff=0.9, sensitivity_cutoff=0.9)
+        self.assertEqual(best_node.name, "N2")
+        self.assertEqual([node.name for node in qualified_nodes], ["N2", "N4"])
+        self.assertEqual(test_tree['N4'].props.get('c_f1'), 1.0)
+        self.assertEqual(test_tree['N4'].props.get('b_sens'), 0)
         
 
 if __name__ == '__main__':
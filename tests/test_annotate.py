@@ -4,14 +4,24 @@ import os
 import tarfile
 from io import StringIO, BytesIO
 import unittest
+import random
+import statistics
+import numpy as np
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
 
 #from collections import namedtuple
+from collections import Counter
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 from treeprofiler import tree_annotate
 from treeprofiler.src import utils
+from treeprofiler.src import summary
+from treeprofiler.src import leaf_table
+from treeprofiler.src.tree_index import TreeIndex, LCAIndex
+from treeprofiler.src import ete_format
+from treeprofiler.src import type_inference
+from ete4 import PhyloTree
 import time
 
 class TestAnnotate(unittest.TestCase):
@@ -510,6 +520,229 @@ class TestAnnotate(unittest.TestCase):
         expected_tree = '(a:1[&&NHX:col1=apple:col2=3.0]);'
         self.assertEqual(test_tree_annotated.write(props=props), expected_tree)
 
+    def test_parse_csv_streaming(self):
+        # small chunks and early name filtering give the same metadata and types
+        lines = ['#name\tnum\tflag\ttags\tempty']
+        for i in range(200):
+            lines.append(f'leaf{i}\t{i * 0.5}\t{"yes" if i % 3 else "no"}\t{"a,b" if i % 5 else ""}\t')
+            if i % 50 == 0:
+                lines.append('## comment')
+        with NamedTemporaryFile(suffix='.tsv') as f_annotation:
+            f_annotation.write('\n'.join(lines).encode())
+            f_annotation.flush()
+
+            target_nodes = {f'leaf{i}' for i in range(0, 200, 3)}
+            metadata_dict, node_props, columns, prop2type = tree_annotate.parse_csv([f_annotation.name],
+                target_nodes=target_nodes)
+            chunked = tree_annotate.parse_csv([f_annotation.name], target_nodes=target_nodes, chunk_size=16)
+
+        self.assertEqual(set(metadata_dict), target_nodes)
+        self.assertEqual(metadata_dict['leaf15'], {'num': '7.5', 'flag': 'no'})
+        self.assertEqual(node_props, ['num', 'flag', 'tags', 'empty'])
+        self.assertEqual(prop2type, {'num': float, 'flag': bool, 'tags': list, 'empty': bool})
+        self.assertEqual(len(columns['num']), len(target_nodes))
+        self.assertEqual(columns['empty'], [])
+        self.assertEqual(chunked[0], metadata_dict)
+        self.assertEqual(chunked[1], node_props)
+        self.assertEqual(chunked[3], prop2type)
+
+    def test_parse_csv_ragged_rows(self):
+        # rows with more or fewer fields than the header are kept but reported
+        with NamedTemporaryFile(suffix='.tsv') as f_annotation:
+            f_annotation.write(b'#name\tcol1\tcol2\na\tapple\t3\nb\tbanana\nc\tcherry\t4\textra\n')
+            f_annotation.flush()
+
+            with self.assertLogs(tree_annotate.logger, level='WARNING') as logs:
+                metadata_dict, node_props, columns, prop2type = tree_annotate.parse_csv([f_annotation.name])
+
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('2 fields instead of 3', logs.output[0])
+        self.assertIn('node b', logs.output[0])
+        self.assertIn('4 fields instead of 3', logs.output[1])
+        self.assertIn('node c', logs.output[1])
+        self.assertEqual(metadata_dict['b'], {'col1': 'banana'})
+        self.assertEqual(metadata_dict['c'], {'col1': 'cherry', 'col2': '4'})
+
+    def test_type_inference(self):
+        # same types as infer_dtype whatever the batches, sampling stops at the budget
+        columns = {
+            'num': ['1', '2.5', 'nan', '-3'],
+            'flag': ['yes', 'no', 'none', 'yes'],
+            'mixed_flag': ['yes', 'Yes', 'no', 'no'],
+            'binary': ['1', '0', '0', '1'],
+            'tags': ['GO:1', 'GO:1,GO:2', 'GO:3', 'GO:4'],
+            'text': ['apple', 'banana', '1', 'yes'],
+        }
+        inference = type_inference.TypeInference()
+        for prop, values in columns.items():
+            for value in values:
+                inference.update(prop, [value])
+        expected = {'num': float, 'flag': bool, 'mixed_flag': str, 'binary': bool, 'tags': list, 'text': str}
+        self.assertEqual(inference.dtypes(), expected)
+        self.assertEqual({prop: tree_annotate.infer_dtype(values) for prop, values in columns.items()}, expected)
+        self.assertEqual(set(inference.timings()), set(columns))
+
+        sampled = type_inference.TypeInference(sample_size=1, confirm=False)
+        for prop, values in columns.items():
+            sampled.update(prop, values)
+        # only the first value of every column is seen
+        self.assertEqual(sampled.dtypes()['tags'], str)
+        self.assertEqual(sampled.dtypes()['num'], bool)
+
+    def test_annotate_evol_events(self):
+        # species overlap of both sides of each bifurcation from species bitsets
+        test_tree = utils.ete4_parse("((sp1.A:1,sp2.B:1)N1:1,((sp1.C:1,sp3.D:1)N3:1,sp3.E:1)N2:1)Root;")
+        tree_annotate.annotate_evol_events(test_tree, taxid_attr="name", sos_thr=0.0, sp_delimiter='.', sp_field=0)
+
+        self.assertEqual(test_tree['N1'].props.get('evoltype'), 'S')
+        self.assertEqual(test_tree['N3'].props.get('evoltype'), 'S')
+        self.assertEqual(test_tree['N2'].props.get('evoltype'), 'D')
+        self.assertEqual(test_tree['N2'].props.get('dup_sp'), 'sp3')
+        self.assertEqual(test_tree['N2'].props.get('dup_percent'), 50.0)
+        self.assertEqual(test_tree.props.get('evoltype'), 'D')
+        self.assertEqual(test_tree.props.get('dup_sp'), 'sp1')
+        self.assertEqual(test_tree.props.get('dup_percent'), 33.333)
+        self.assertNotIn('dup_sp', test_tree['N1'].props)
+        self.assertEqual(test_tree['sp3.E'].props.get('species'), {'sp3'})
+        self.assertTrue(all('_speciesFunction' not in n.props for n in test_tree.traverse()))
+
+    def test_annotate_bottom_up_summary(self):
+        # bottom-up summary must match merging every descendant leaf per node
+        test_tree = PhyloTree()
+        test_tree.populate(60)
+        random.seed(1)
+        for i, leaf in enumerate(test_tree.leaves()):
+            leaf.name = f"leaf{i}"
+            if i % 7:
+                leaf.add_prop('fruit', random.choice(['apple', 'banana', 'cherry']))
+                leaf.add_prop('size', float(random.randint(-5, 20)))
+                leaf.add_prop('tags', random.sample(['GO:1', 'GO:2', 'GO:3'], 2))
+
+        column2method = {'fruit': 'raw', 'size': 'all', 'tags': 'relative'}
+        for node, internal_props in summary.merge_annotations(test_tree,
+                text_prop=['fruit'], multiple_text_prop=['tags'], num_prop=['size'],
+                column2method=column2method):
+            leaves = list(node.leaves())
+            fruits = Counter(leaf.props['fruit'] for leaf in leaves if 'fruit' in leaf.props)
+            tags = Counter(tag for leaf in leaves for tag in leaf.props.get('tags', []))
+            expected = summary.text_counter_props(fruits, 'fruit', 'raw')
+            expected.update(summary.multitext_counter_props(tags, 'tags', 'relative'))
+            self.assertEqual(internal_props['fruit_counter'], expected['fruit_counter'])
+            self.assertEqual(internal_props['tags_counter'], expected['tags_counter'])
+
+            sizes = [leaf.props['size'] for leaf in leaves if 'size' in leaf.props]
+            if sizes:
+                self.assertAlmostEqual(internal_props['size_sum'], sum(sizes))
+                self.assertAlmostEqual(internal_props['size_avg'], sum(sizes) / len(sizes))
+                self.assertEqual(internal_props['size_min'], min(sizes))
+                self.assertEqual(internal_props['size_max'], max(sizes))
+                if len(sizes) > 1:
+                    self.assertAlmostEqual(internal_props['size_std'], statistics.stdev(sizes))
+            else:
+                self.assertNotIn('size_sum', internal_props)
+
+    def test_annotate_parallel_summary(self):
+        # clades summarized by workers over the shared leaf table match the sequential pass
+        test_tree = PhyloTree()
+        test_tree.populate(80)
+        random.seed(2)
+        for i, leaf in enumerate(test_tree.leaves()):
+            leaf.name = f"leaf{i}"
+            if i % 5:
+                leaf.add_prop('fruit', random.choice(['apple', 'banana', 'NaN']))
+                leaf.add_prop('size', float(random.randint(0, 9)))
+                leaf.add_prop('tags', random.sample(['GO:1', 'GO:2', 'NaN'], 2))
+
+        options = dict(text_prop=['fruit'], multiple_text_prop=['tags'], num_prop=['size'],
+            column2method={'fruit': 'raw', 'size': 'all', 'tags': 'raw'})
+        expected = dict(summary.merge_annotations(test_tree, **options))
+        results = dict(leaf_table.parallel_merge_annotations(test_tree, threads=2,
+            min_leaves_per_thread=1, **options))
+
+        self.assertEqual(results.keys(), expected.keys())
+        for node, internal_props in expected.items():
+            self.assertEqual(results[node].keys(), internal_props.keys())
+            for key, value in internal_props.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(results[node][key], value)
+                else:
+                    self.assertEqual(results[node][key], value)
+
+    def test_tree_index_intervals(self):
+        # preorder leaf intervals give the leaves of every clade as a slice
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser="name")
+        tree_index = TreeIndex(test_tree)
+        for node in test_tree.traverse():
+            self.assertEqual(tree_index.clade_leaf_names(node), [leaf.name for leaf in node.leaves()])
+            self.assertEqual(tree_index.clade_size(node), len(list(node.leaves())))
+
+        mask = [leaf.name in ('B', 'D') for leaf in tree_index.leaves]
+        counts = tree_index.clade_counts(mask)
+        internal_1 = next(test_tree.search_nodes(name='Internal_1'))
+        self.assertEqual(counts[tree_index.node_id(test_tree)], 2)
+        self.assertEqual(counts[tree_index.node_id(internal_1)], 1)
+
+    def test_lca_index(self):
+        # LCA queries match ete's common_ancestor, clade keys use it to annotate
+        test_tree = PhyloTree()
+        test_tree.populate(50, dist_fn=lambda: 0.5)
+        for i, node in enumerate(test_tree.traverse()):
+            node.name = f"node{i}"
+        lca_index = LCAIndex(test_tree)
+        nodes = list(test_tree.traverse())
+        random.seed(2)
+        for _ in range(200):
+            query = random.sample(nodes, random.randint(1, 4))
+            self.assertIs(lca_index.common_ancestor(query), test_tree.common_ancestor(query))
+            self.assertIs(lca_index.common_ancestor([node.name for node in query]), test_tree.common_ancestor(query))
+
+        u, v = random.sample(nodes, 2)
+        self.assertAlmostEqual(lca_index.path_length(u, v), test_tree.get_distance(u, v))
+        self.assertAlmostEqual(lca_index.shared_path_length(u, u), test_tree.get_distance(test_tree, u))
+        ids = lca_index.lca_ids([1, 5, 7], [1, 9, 3])
+        self.assertEqual(list(ids), [lca_index.lca_id(1, 1), lca_index.lca_id(5, 9), lca_index.lca_id(7, 3)])
+        with self.assertRaises(KeyError):
+            lca_index.common_ancestor(['node1', 'missing'])
+
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1):0.5):0.5);")
+        annotated_tree = tree_annotate.load_metadata_to_tree(test_tree, {'E||B': {'clade': 'inner'}})
+        self.assertEqual(annotated_tree.common_ancestor(['E', 'B']).props.get('clade'), 'inner')
+
+    def test_ete_columnar_format(self):
+        # binary .ete keeps topology, props and their types, and loads only requested props
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser="name")
+        for i, node in enumerate(test_tree.traverse()):
+            node.add_prop('count', i)
+            node.add_prop('ratio', i / 2)
+            node.add_prop('flag', i % 2 == 0)
+            node.add_prop('group', 'odd' if i % 2 else 'even')
+            node.add_prop('items', ['x', str(i)])
+        test_tree['A'].add_prop('mixed', {'a': 1})
+
+        with NamedTemporaryFile(suffix='.ete') as f_tree:
+            ete_format.dump(test_tree, f_tree.name)
+            self.assertTrue(ete_format.is_columnar(f_tree.name))
+            loaded_tree, eteformat_flag = utils.validate_tree(f_tree.name, 'auto')
+            self.assertTrue(eteformat_flag)
+            for node, loaded_node in zip(test_tree.traverse(), loaded_tree.traverse()):
+                self.assertEqual(loaded_node.props, node.props)
+                self.assertEqual({k: type(v) for k, v in loaded_node.props.items()},
+                                 {k: type(v) for k, v in node.props.items()})
+            self.assertEqual(loaded_tree.write(props=None, format_root_node=True),
+                             test_tree.write(props=None, format_root_node=True))
+
+            partial_tree = ete_format.load(f_tree.name, props=['ratio'])
+            self.assertEqual(set(partial_tree['A'].props), {'name', 'dist', 'ratio'})
+
+        # text ete files are still readable
+        with NamedTemporaryFile(suffix='.ete', mode='w') as f_tree:
+            f_tree.write(ete_format.dumps(test_tree))
+            f_tree.flush()
+            self.assertFalse(ete_format.is_columnar(f_tree.name))
+            loaded_tree, eteformat_flag = utils.validate_tree(f_tree.name, 'auto')
+            self.assertTrue(eteformat_flag)
+            self.assertEqual(loaded_tree['A'].props.get('items'), test_tree['A'].props.get('items'))
+
     def test_array_annotate_01(self):
         # test data-matrix one column
         # load tree
@@ -531,6 +764,37 @@ class TestAnnotate(unittest.TestCase):
         expected_tree_avgs = "(A:1[&&NHX:data_matrix.tsv=1.0],(B:1[&&NHX:data_matrix.tsv=2.0],(E:1[&&NHX:data_matrix.tsv=4.0],D:1[&&NHX:data_matrix.tsv=3.0])Internal_1:0.5[&&NHX:data_matrix.tsv_avg=3.5])Internal_2:0.5[&&NHX:data_matrix.tsv_avg=3.0])Root[&&NHX:data_matrix.tsv_avg=2.5];"
         self.assertEqual(test_tree_annotated.write(props=None, parser=parser, format_root_node=True), expected_tree_avgs)
 
+    def test_array_annotate_02(self):
+        # multi-column matrix, all stats match the clade matrix reductions, also from the .npy cache
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;")
+        rows = {'A': [1, 5, 0], 'B': [2, 7, 1], 'D': [3, 1, 1], 'E': [4, 2, 0]}
+        with TemporaryDirectory() as tmpdir:
+            matrix_file = os.path.join(tmpdir, "matrix.tsv")
+            with open(matrix_file, "w") as f_matrix:
+                for name, values in rows.items():
+                    f_matrix.write(name + "\t" + "\t".join(map(str, values)) + "\n")
+                f_matrix.write("X\ta\tb\tc\n")
+
+            for _ in range(2):
+                array_dict = tree_annotate.parse_tsv_to_array([matrix_file], cache=True)
+                matrix = array_dict["matrix.tsv"]
+                self.assertNotIn("X", matrix)
+                self.assertEqual(matrix.get("B"), [2.0, 7.0, 1.0])
+            self.assertTrue(os.path.exists(matrix_file + ".npy"))
+            self.assertIsInstance(matrix.values, np.memmap)
+
+            tree_annotate.run_array_annotate(test_tree, array_dict, num_stat="all", column2method={})
+
+        for node in test_tree.traverse():
+            if node.is_leaf:
+                self.assertEqual(node.props.get("matrix.tsv"), rows[node.name])
+                continue
+            clade = np.array([rows[leaf.name] for leaf in node.leaves()], dtype=np.float64)
+            expected = {'avg': clade.mean(axis=0), 'max': clade.max(axis=0), 'min': clade.min(axis=0),
+                        'sum': clade.sum(axis=0), 'std': clade.std(axis=0)}
+            for stat, values in expected.items():
+                np.testing.assert_allclose(node.props.get(utils.add_suffix("matrix.tsv", stat)), values)
+
     def test_internal_parser_01(self):
         parser='name'
         test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;", internal_parser=parser)
@@ -4,18 +4,22 @@ import os
 import tarfile
 import requests
 import time
+import tempfile
 import json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from io import StringIO
 import unittest
+import numpy as np
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
 
 from multiprocessing import Process
-from treeprofiler import tree_plot
+from treeprofiler import tree_plot, tree_render, render_batch
 from treeprofiler.layouts import (
     text_layouts, taxon_layouts, staple_layouts, 
     conditional_layouts, seq_layouts, profile_layouts)
-from treeprofiler.src import utils
+from treeprofiler.src import utils, colormap, prop_cache, profile_matrix, canvas
+from treeprofiler.src.tree_index import TreeIndex
 
 paried_color = ["red", "darkblue", "lightgreen", "sienna", "lightCoral", "violet", "mediumturquoise",   "lightSkyBlue", "indigo", "tan", "coral", "olivedrab", "teal", "darkyellow"]
 
@@ -190,11 +194,24 @@ class TestTreePlots(unittest.TestCase):
         layouts.extend(heatmap_layouts)
         expected_config = "{'default': {'Branch length': True, 'Branch support': True, 'Leaf name': True, 'Number of leaves': False, 'Heatmap_col1': True}}"
         expected_draw = "[['line', [0, 2.0], [2.0, 2.0], '', [], {'stroke': '#000000', 'stroke-width': 0.5, 'fill': '#e5e5e5', 'fill-opacity': 0.3, 'type': 'solid'}], ['nodebox', [0, 0, 2.0, 4.0], '', {'name': '', 'dist': 0.0, 'support': 1.0}, [], [], {'fill': 'transparent'}]]"
-        expected_layout = "{'name': 'Heatmap_col1_min-max', 'active': True, 'aligned_faces': True, 'description': '', 'legend': True, 'always_render': False, 'ts': None, 'ns': None, 'prop': 'col1', 'internal_prop': 'col1_avg', 'column': 1, 'value_color': {1.0: '#fff5f0', 2.0: '#fca082', 3.0: '#e32f27', 4.0: '#67000d', 3.5: '#ad1117'}, 'value_range': [1.0, 4.0], 'color_range': {1: '#fff5f0', 2: '#fff1ea', 3: '#ffece4', 4: '#fee8de', 5: '#fee4d8', 6: '#fee0d2', 7: '#fed8c7', 8: '#fdd1be', 9: '#fdc9b3', 10: '#fcc1a8', 11: '#fcb99f', 12: '#fcb095', 13: '#fca98c', 14: '#fca082', 15: '#fc9879', 16: '#fc8f6f', 17: '#fc8666', 18: '#fc7f5f', 19: '#fb7656', 20: '#fb6e4e', 21: '#fa6547', 22: '#f75c41', 23: '#f5523a', 24: '#f34935', 25: '#f03f2e', 26: '#ea362a', 27: '#e32f27', 28: '#db2824', 29: '#d42121', 30: '#cc191e', 31: '#c5171c', 32: '#bd151a', 33: '#b51318', 34: '#ad1117', 35: '#a50f15', 36: '#9a0c14', 37: '#8c0912', 38: '#800610', 39: '#73030f', 40: '#67000d'}, 'absence_color': '#EBEBEB', 'maxval': 4.0, 'minval': 1.0, 'width': 70, 'height': None, 'padding_x': 1, 'padding_y': 0}"
+        expected_layout = "{'name': 'Heatmap_col1_min-max', 'active': True, 'aligned_faces': True, 'description': '', 'legend': True, 'always_render': False, 'ts': None, 'ns': None, 'prop': 'col1', 'internal_prop': 'col1_avg', 'column': 1, 'value_color': {1.0: '#fff5f0', 2.0: '#fca082', 3.0: '#e32f27', 3.5: '#ad1117', 4.0: '#67000d'}, 'value_range': [1.0, 4.0], 'color_range': {1: '#fff5f0', 2: '#fff1ea', 3: '#ffece4', 4: '#fee8de', 5: '#fee4d8', 6: '#fee0d2', 7: '#fed8c7', 8: '#fdd1be', 9: '#fdc9b3', 10: '#fcc1a8', 11: '#fcb99f', 12: '#fcb095', 13: '#fca98c', 14: '#fca082', 15: '#fc9879', 16: '#fc8f6f', 17: '#fc8666', 18: '#fc7f5f', 19: '#fb7656', 20: '#fb6e4e', 21: '#fa6547', 22: '#f75c41', 23: '#f5523a', 24: '#f34935', 25: '#f03f2e', 26: '#ea362a', 27: '#e32f27', 28: '#db2824', 29: '#d42121', 30: '#cc191e', 31: '#c5171c', 32: '#bd151a', 33: '#b51318', 34: '#ad1117', 35: '#a50f15', 36: '#9a0c14', 37: '#8c0912', 38: '#800610', 39: '#73030f', 40: '#67000d'}, 'absence_color': '#EBEBEB', 'maxval': 4.0, 'minval': 1.0, 'width': 70, 'height': None, 'padding_x': 1, 'padding_y': 0}"
         get_parallel(test_tree, layouts, expected_draw, expected_config)
         
         self.assertEqual(str(layouts[0].__dict__), expected_layout)
 
+    def test_plot_06_normalized(self):
+        # mean and zscore heatmaps and the numerical bubbles spread their values over the whole gradient
+        newick = "(A:1[&&NHX:col1=1.0],(B:1[&&NHX:col1=2.0],(E:1[&&NHX:col1=4.0],D:1[&&NHX:col1=3.0])Internal_1:0.5[&&NHX:col1_avg=3.5:col1_max=4.0:col1_min=3.0:col1_std=0.5:col1_sum=7.0])Internal_2:0.5[&&NHX:col1_avg=3.0:col1_max=4.0:col1_min=2.0:col1_std=1.0:col1_sum=9.0]);"
+        test_tree = utils.ete4_parse(newick)
+        expected_value_color = {1.0: '#7da0f9', 2.0: '#bbd1f8', 3.0: '#e6d7cf', 3.5: '#f3c7b1', 4.0: '#f7a688'}
+        for norm_method in ['mean', 'zscore']:
+            heatmap_layouts, level = tree_plot.get_heatmap_layouts(test_tree, ["col1"], 1, norm_method=norm_method)
+            self.assertEqual(heatmap_layouts[0].value_color, expected_value_color)
+
+        bubble_layouts, level, _ = tree_plot.get_numerical_bubble_layouts(test_tree, ["col1"], 1, prop2type={'col1': float})
+        self.assertEqual(bubble_layouts[0].value2color,
+            {1.0: '#000080', 2.0: '#00d4ff', 3.0: '#ffe600', 3.5: '#ff5200', 4.0: '#800000'})
+
     def test_plot_07(self):
         newick = "(A:1[&&NHX:col1=1.0],(B:1[&&NHX:col1=2.0],(E:1[&&NHX:col1=4.0],D:1[&&NHX:col1=3.0])Internal_1:0.5[&&NHX:col1_avg=3.5:col1_max=4.0:col1_min=3.0:col1_std=0.5:col1_sum=7.0])Internal_2:0.5[&&NHX:col1_avg=3.0:col1_max=4.0:col1_min=2.0:col1_std=1.0:col1_sum=9.0]);"
         test_tree = utils.ete4_parse(newick)
@@ -382,6 +399,151 @@ class TestTreePlots(unittest.TestCase):
         
         self.assertEqual(str(layout_dict), expected_layout)
 
+    def test_gradient_lut(self):
+        # nearest gradient step of every value, as an argmin over the steps
+        gradient = colormap.gradient('Reds')
+        values = np.array([-0.5, 0, 0.1, 0.33, 0.5, 2/3, 5/6, 0.99, 1, 1.5, np.nan])
+        for start, stop in [(0, 1), (-1, 1), (0, -3)]:
+            lut = colormap.GradientLUT(gradient, start, stop)
+            steps = np.linspace(start, stop, len(gradient))
+            expected = [gradient[np.abs(steps - value).argmin() + 1] for value in values[:-1]]
+            self.assertEqual(list(lut.lookup(values[:-1])), expected)
+
+        value2color = colormap.GradientLUT(gradient, 0, 1).value2color(values, value2color={None: '#EBEBEB', 0.5: 'red'})
+        self.assertEqual(len(value2color), 11)
+        self.assertEqual(value2color[0.5], 'red')
+        self.assertEqual(value2color[1], gradient[40])
+        self.assertEqual(value2color.get(None), '#EBEBEB')
+        self.assertIsNone(value2color.get(0.25))
+
+    def test_prop_cache(self):
+        # property arrays of a registered tree, same values as a traversal, dropped after pruning
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;")
+        for name, col1, list_data in [('A', '1.0', 'a||b'), ('B', 'NaN', 'c'), ('D', '3.0', 'a'), ('E', '4.0', '')]:
+            test_tree[name].add_props(col1=col1, list_data=list_data)
+        test_tree['Internal_1'].add_prop('col1_avg', 3.5)
+
+        queries = [('col1', False, True, False), ('col1', True, False, False),
+            ('col1_avg', False, True, False), ('list_data', True, False, True), ('missing', False, True, False)]
+        expected = {query: sorted(map(str, utils.tree_prop_array(test_tree, *query))) for query in queries}
+
+        prop_cache.register(test_tree)
+        try:
+            for query in queries:
+                self.assertEqual(sorted(map(str, utils.tree_prop_array(test_tree, *query))), expected[query])
+            self.assertEqual(len(prop_cache.lookup(test_tree).columns), 4)
+
+            utils.conditional_prune(test_tree, ["col1 > 3"], {'col1': float})
+            self.assertEqual(sorted(utils.tree_prop_array(test_tree, 'col1', leaf_only=True)), ['1.0', '3.0', 'NaN'])
+        finally:
+            prop_cache.unregister(test_tree)
+        self.assertIsNone(prop_cache.lookup(test_tree))
+
+    def test_profile_matrix(self):
+        # presence of every term in the leaves, ratio of leaves with it in the internal nodes
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;")
+        for name, list_data, col1 in [('A', 'a||b', 'x'), ('B', 'c', 'xy'), ('D', 'a||c', 'xy')]:
+            test_tree[name].add_props(list_data=list_data, col1=col1)
+        tree_index = TreeIndex(test_tree)
+
+        matrix = profile_matrix.build_profile(tree_index, 'list_data', ['a', 'b', 'c'], list_type=True)
+        self.assertEqual(dict(matrix), {'A': [1, 1, 0], 'B': [0, 0, 1], 'D': [1, 0, 1],
+            'Root': [0.5, 0.25, 0.5], 'Internal_2': [1/3, 0.0, 2/3], 'Internal_1': [0.5, 0.0, 0.5]})
+        self.assertEqual(matrix.distinct_values().tolist(), [0, 0.25, 1/3, 0.5, 2/3, 1])
+
+        # single values match as a whole, out of the leaves holding one
+        matrix = profile_matrix.build_profile(tree_index, 'col1', ['x', 'xy'], clade_total=False)
+        self.assertEqual(matrix['A'], [1, 0])
+        self.assertEqual(matrix['Internal_1'], [0.0, 1.0])
+        self.assertEqual(matrix['Root'], [1/3, 2/3])
+
+    def test_canvas(self):
+        # graphic elements of the tree view painted without a browser
+        elements = [
+            ['line', (0, 0.5), (1, 0.5), 'hz', [], {'stroke': 'red'}],
+            ['rect', (1, 0, 1, 1), '', {'fill': 'blue'}, ''],
+            ['array', (2, 0, 2, 1), ['#ff0000', '#00ff00'], ''],
+            ['text', (1, 1, 2, 1), 'A&B', 'name', 0, 'left', {'fill': 'black'}],
+        ]
+        paint = canvas.Canvas()
+        for element in elements:
+            paint.add(element, lambda point: (point[0] * 10, point[1] * 20))
+        self.assertEqual((paint.xmax, paint.ymax), (40, 40))
+
+        svg = paint.svg()
+        self.assertIn('<path d="M0.00,10.00L10.00,10.00" fill="none" stroke="#ff0000"', svg)
+        self.assertIn('fill="#0000ff"', svg)
+        self.assertIn('>A&amp;B</text>', svg)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            svg_file = os.path.join(tmpdir, 'tree.svg')
+            png_file = os.path.join(tmpdir, 'tree.png')
+            paint.save(svg_file)
+            paint.save(png_file)
+            with open(svg_file) as f:
+                self.assertEqual(f.read(), svg)
+            self.assertGreater(os.path.getsize(png_file), 0)
+            with self.assertRaises(canvas.UnsupportedFormat):
+                paint.save(os.path.join(tmpdir, 'tree.gif'))
+
+    def test_render_svg(self):
+        # layouts drawn by the smartview drawers straight into an svg file
+        newick = "(A:1[&&NHX:alphabet_type=vowel],(B:1[&&NHX:alphabet_type=consonant],(E:1[&&NHX:alphabet_type=vowel],D:1[&&NHX:alphabet_type=consonant])Internal_1:0.5[&&NHX:alphabet_type_counter=consonant--1||vowel--1])Internal_2:0.5[&&NHX:alphabet_type_counter=consonant--2||vowel--1]);"
+        test_tree = utils.ete4_parse(newick)
+        layouts, level, _ = tree_plot.get_rectangle_layouts(test_tree, ["alphabet_type"], 1,
+            prop2type={'name': str, 'dist': float, 'support': float})
+        self.assertEqual(tree_render.tree_size(test_tree), (2.0, 4))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            svg_file = os.path.join(tmpdir, 'tree.svg')
+            self.assertEqual(tree_render.render(test_tree, layouts, svg_file), svg_file)
+            with open(svg_file) as f:
+                svg = f.read()
+            # rendering again gives the same file
+            tree_render.render(test_tree, layouts, svg_file)
+            with open(svg_file) as f:
+                self.assertEqual(f.read(), svg)
+
+        self.assertTrue(svg.startswith('<svg'))
+        self.assertIn('<path d="M', svg)
+        # rectangles of the aligned panel, one color per value
+        for color in layouts[0].color_dict.values():
+            self.assertIn(f'fill="{color}"', svg)
+
+    def test_render_batch_manifest(self):
+        # rows of tree, output and plot arguments, parsed trees reused between rows
+        manifest = StringIO("# tree\toutput\tplot arguments\n"
+            "tree.nw\tfamily1.svg\t--heatmap-layout sample1 sample2 --column-width 50\n"
+            "\n"
+            "tree.nw\tfamily1.png\t--rectangle-layout 'random type'\n")
+        items = render_batch.read_manifest(manifest)
+        self.assertEqual([item.line for item in items], [2, 4])
+        self.assertEqual(render_batch.item_argv(items[1]),
+            ['--tree', 'tree.nw', '--rectangle-layout', 'random type', '--render', 'family1.png'])
+
+        parser = render_batch.get_plot_parser()
+        args = render_batch.parse_item(parser, items[0])
+        self.assertEqual(args.heatmap_layout, ['sample1', 'sample2'])
+        self.assertEqual(args.render, 'family1.svg')
+        with self.assertRaises(render_batch.ManifestError):
+            render_batch.parse_item(parser, items[0]._replace(plot_args=['--no-such-layout']))
+        with self.assertRaises(render_batch.ManifestError):
+            render_batch.read_manifest(StringIO("tree.nw\n"))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tree_file = os.path.join(tmpdir, 'tree.nw')
+            with open(tree_file, 'w') as f:
+                f.write("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;")
+            args = parser.parse_args(['--tree', tree_file, '--internal', 'name'])
+            trees = OrderedDict()
+            tree1, _ = render_batch.load_tree(args, trees)
+            tree1['A'].add_prop('col1', 'x')
+            os.remove(tree_file)
+            tree2, _ = render_batch.load_tree(args, trees)
+            self.assertEqual(len(trees), 1)
+            self.assertIsNot(tree1, tree2)
+            self.assertNotIn('col1', tree2['A'].props)
+
 if __name__ == '__main__':
     unittest.main()
 #pytest.main(['-v'])
\ No newline at end of file
@@ -189,6 +189,23 @@ class TestPrune(unittest.TestCase):
 
         self.assertEqual(pruned_tree.write(props=props, parser=parser, format_root_node=True), expected_tree)
 
+    def test_pruned_by_07(self):
+        # test several conditions together, matching clades nested in a matching clade
+        internal_parser = "name"
+        parser = utils.get_internal_parser(internal_parser)
+
+        test_tree = utils.ete4_parse("(A:1,(B:1,(E:1,D:1)Internal_1:0.5)Internal_2:0.5)Root;")
+        for name, alphabet_type, col1 in [('A', 'vowel', 1.0), ('B', 'consonant', 2.0), ('D', 'consonant', 3.0),
+                ('E', 'vowel', 4.0), ('Internal_1', 'vowel', 3.5)]:
+            test_tree[name].add_props(alphabet_type=alphabet_type, col1=col1)
+        prop2type = {'alphabet_type': str, 'col1': float}
+
+        props = ['alphabet_type', 'col1']
+        expected_tree = '(A:1[&&NHX:alphabet_type=vowel:col1=1.0],(B:1[&&NHX:alphabet_type=consonant:col1=2.0])Internal_2:0.5)Root;'
+        condition_inputs = ["alphabet_type=vowel", "col1 > 2"]
+        pruned_tree = utils.conditional_prune(test_tree, condition_inputs, prop2type)
+        self.assertEqual(pruned_tree.write(props=props, parser=parser, format_root_node=True), expected_tree)
+
 if __name__ == '__main__':
     unittest.main()
 #pytest.main(['-v'])
\ No newline at end of file
@@ -2,14 +2,16 @@ import sys
 import os
 from io import StringIO
 import unittest
+import time
 import requests
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__) + '/..'))
 
 #from collections import namedtuple
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from treeprofiler import tree_annotate
 from treeprofiler.src import utils
+from treeprofiler.src import taxonomy
 from ete4 import GTDBTaxa
 
 GTDB_r202_url = "https://github.com/etetoolkit/ete-data/raw/main/gtdb_taxonomy/gtdb202/gtdb202dump.tar.gz"
@@ -172,6 +174,59 @@ class TestGTDBTaxonomy(unittest.TestCase):
         self.assertEqual(pruned_tree.write(props=props, parser=1), expected_tree_no_root)
         self.assertEqual(pruned_tree.write(props=props, parser=1, format_root_node=True), expected_tree_with_root)
 
+class TestTaxonomyResolver(unittest.TestCase):
+    def test_resolve_once(self):
+        # each taxid is queried once, later resolvers read the disk cache of the same database
+        class CountingTaxa:
+            def __init__(self, dbfile):
+                self.dbfile = dbfile
+                self.queries = []
+            def get_rank(self, taxids):
+                self.queries.append(set(taxids))
+                return {taxid: 'no rank' if taxid == 1 else 'species' for taxid in taxids}
+            def get_taxid_translator(self, taxids):
+                return {taxid: f'taxon{taxid}' for taxid in taxids}
+
+        with TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'taxa.sqlite')
+            with open(dbfile, 'w') as f_db:
+                f_db.write('db')
+
+            taxa = CountingTaxa(dbfile)
+            resolver = taxonomy.TaxonomyResolver(taxa, cache=True, cache_dir=tmpdir)
+            resolver.resolve([9606, 1, 9606, 131567])
+            resolver.resolve([1, 9606])
+            self.assertEqual(taxa.queries, [{1, 131567, 9606}])
+            self.assertEqual(list(resolver.names([9606, 1, 131567])), [1, 9606, 131567])
+            self.assertEqual(resolver.ranks([1])[1], 'no rank')
+
+            taxonomy._lookups.clear()
+            other = CountingTaxa(dbfile)
+            resolver = taxonomy.TaxonomyResolver(other, cache=True, cache_dir=tmpdir)
+            resolver.resolve([9606, 131567])
+            self.assertEqual(other.queries, [])
+            self.assertEqual(resolver.names([9606]), {9606: 'taxon9606'})
+
+    def test_prune_databases(self):
+        # databases are listed oldest used first and pruned by checksum, age or count
+        with TemporaryDirectory() as tmpdir:
+            now = time.time()
+            for checksum, days in [('aaa1', 30), ('bbb2', 10), ('ccc3', 0)]:
+                path = os.path.join(taxonomy.databases_dir(tmpdir), checksum)
+                os.makedirs(path)
+                with open(os.path.join(path, taxonomy.DBFILE), 'w') as f_db:
+                    f_db.write('db')
+                taxonomy.write_info(path, {'taxadb': 'GTDB', 'dump': f'{checksum}.tar.gz', 'checksum': checksum,
+                    'created': now - days * 86400, 'last_used': now - days * 86400})
+
+            self.assertEqual([info['checksum'] for info in taxonomy.list_databases(tmpdir)], ['aaa1', 'bbb2', 'ccc3'])
+            removed = taxonomy.prune_databases(tmpdir, older_than=20)
+            self.assertEqual([info['checksum'] for info in removed], ['aaa1'])
+            removed = taxonomy.prune_databases(tmpdir, checksums=['cc'])
+            self.assertEqual([info['checksum'] for info in removed], ['ccc3'])
+            taxonomy.prune_databases(tmpdir, keep=0)
+            self.assertEqual(taxonomy.list_databases(tmpdir), [])
+
 if __name__ == '__main__':
     unittest.main()
 #pytest.main(['-v'])
\ No newline at end of file
@@ -1,8 +1,11 @@
+import numpy as np
 from ete4.smartview import TreeStyle, NodeStyle, TreeLayout, PieChartFace
 from ete4.smartview  import (RectFace, CircleFace, SeqMotifFace, TextFace, OutlineFace, \
                             SelectedFace, SelectedCircleFace, SelectedRectFace, LegendFace)
 from treeprofiler.layouts.general_layouts import get_heatmapface, get_aggregated_heatmapface
-from treeprofiler.src.utils import to_code, call, counter_call, check_nan
+from treeprofiler.src.utils import to_code, check_nan
+from treeprofiler.src.query import NodeColumns, compile_query, matched_below
+from treeprofiler.src.tree_index import TreeIndex
 # for boolean layouts
 try:
     from distutils.util import strtobool
@@ -33,42 +36,16 @@ class LayoutHighlight(TreeLayout):
                                     colormap=colormap
                                     )
 
+        tree_index = TreeIndex(tree)
+        columns = NodeColumns(tree_index.nodes)
         for color, conditions in self.color2conditions.items():
-            conditional_output = to_code(conditions)
-            for node in tree.traverse():
-                final_call = False
-                for condition in conditional_output:
-                    op = condition[1]
-                    if op == 'in':
-                        value = condition[0]
-                        prop = condition[2]
-                        datatype = self.prop2type.get(prop)
-                        final_call = call(node, prop, datatype, op, value)
-
-                    elif ':' in condition[0] :
-                        internal_prop, leaf_prop = condition[0].split(':')
-                        value = condition[2]
-                        datatype = self.prop2type[internal_prop]
-                        final_call = counter_call(node, internal_prop, leaf_prop, datatype, op, value)
-                    else:
-                        prop = condition[0]
-                        value = condition[2]
-                        datatype = self.prop2type.get(prop)
-                        final_call = call(node, prop, datatype, op, value)
-                    if final_call == False:
-                        break
-                    else:
-                        continue
-                
-                if final_call:
-                    #prop_face = SelectedRectFace(name='prop')
-                    node.add_prop(f'hl_{conditions}', color)  # highligh clade
+            matched = compile_query(to_code(conditions), self.prop2type).evaluate(columns)
+            below = matched_below(tree_index, matched)
+            for i in np.flatnonzero(matched | below):
+                node = tree_index.nodes[i]
+                node.add_prop(f'hl_{conditions}', True if below[i] else color)  # highligh clade
+                if matched[i]:
                     node.add_prop(f'hl_{conditions}_endnode', True)
-                    while (node):
-                        node = node.up
-                        if node:
-                            node.add_prop(f'hl_{conditions}', True)
-                            #node.sm_style["hz_line_width"] = 5
         return
 
     def set_node_style(self, node):
@@ -103,43 +80,15 @@ class LayoutCollapse(TreeLayout):
                                     colormap=colormap
                                     )
 
+        tree_index = TreeIndex(tree)
+        columns = NodeColumns(tree_index.nodes)
         for color, conditions in self.color2conditions.items():
-            conditional_output = to_code(conditions)
-            for node in tree.traverse():
-                final_call = False
-                for condition in conditional_output:
-                    op = condition[1]
-                    if op == 'in':
-                        value = condition[0]
-                        prop = condition[2]
-                        datatype = self.prop2type.get(prop)
-                        final_call = call(node, prop, datatype, op, value)
-
-                    elif ':' in condition[0] :
-                        internal_prop, leaf_prop = condition[0].split(':')
-                        value = condition[2]
-                        datatype = self.prop2type[internal_prop]
-                        final_call = counter_call(node, internal_prop, leaf_prop, datatype, op, value)
-                    else:
-                        prop = condition[0]
-                        value = condition[2]
-                        datatype = self.prop2type.get(prop)
-                        final_call = call(node, prop, datatype, op, value)
-                        
-                    if final_call == False:
-                        break
-                    else:
-                        continue
-                
-                if final_call:
-                    #prop_face = SelectedRectFace(name='prop')
-                    node.add_prop(f'cl_{conditions}', color)  # highligh clade
-                    node.add_prop(f'cl_{conditions}_endnode', True)
-                    while (node):
-                        node = node.up
-                        if node:
-                            node.add_prop(f'hl_{conditions}', True)
-                            #node.sm_style["hz_line_width"] = 5
+            matched = compile_query(to_code(conditions), self.prop2type).evaluate(columns)
+            for i in np.flatnonzero(matched):
+                tree_index.nodes[i].add_prop(f'cl_{conditions}', color)  # collapse clade
+                tree_index.nodes[i].add_prop(f'cl_{conditions}_endnode', True)
+            for i in np.flatnonzero(matched_below(tree_index, matched)):
+                tree_index.nodes[i].add_prop(f'hl_{conditions}', True)
         return
 
     def set_node_style(self, node):
@@ -154,35 +103,9 @@ class LayoutCollapse(TreeLayout):
 
 # conditional collapse layouts
 def collapsed_by_layout(conditions, level, prop2type={}, color='red'):
-    conditional_output = to_code(conditions)
+    query = compile_query(to_code(conditions), prop2type)
     def layout_fn(node):
-        final_call = False
-        for condition in conditional_output:
-            #normal
-            
-            op = condition[1]
-            if op == 'in':
-                value = condition[0]
-                prop = condition[2]
-                datatype = prop2type.get(prop)
-                final_call = call(node, prop, datatype, op, value)
-
-            elif ':' in condition[0] :
-                internal_prop, leaf_prop = condition[0].split(':')
-                value = condition[2]
-                datatype = prop2type[internal_prop]
-                final_call = counter_call(node, internal_prop, leaf_prop, datatype, op, value)
-            else:
-                prop = condition[0]
-                value = condition[2]
-                datatype = prop2type.get(prop)
-                final_call = call(node, prop, datatype, op, value)
-            
-            if final_call == False:
-                break
-            else:
-                continue
-        if final_call:
+        if query.match(node):
             if not node.is_root:
                 node.sm_style["draw_descendants"] = False
                 node.sm_style["outline_color"] = color
@@ -13,7 +13,7 @@ import math
 from ete4.smartview import TreeStyle, NodeStyle, TreeLayout, PieChartFace, LegendFace, RectFace
 from ete4.smartview.renderer.draw_helpers import *
 
-from treeprofiler.src.utils import to_code, call, counter_call, check_nan
+from treeprofiler.src.utils import to_code, check_nan
 from treeprofiler.src import utils
 
 Box = namedtuple('Box', 'x y dx dy')  # corner and size of a 2D shape
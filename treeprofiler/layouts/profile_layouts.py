@@ -458,8 +458,9 @@ class LayoutPropsMatrixBinary(TreeLayout):
     #         return self._get_array(first_leaf)
 
     def get_array(self, node):
-        if self.matrix.get(node.name):
-            return self.matrix.get(node.name)
+        array = self.matrix.get(node.name)
+        if array:
+            return array
         else:
             first_leaf = next(node.leaves())
             return self._get_array(first_leaf)
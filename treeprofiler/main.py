@@ -83,6 +83,8 @@ def main():
     # Delayed import to avoid circular import issue
     from treeprofiler import tree_annotate
     from treeprofiler import tree_plot
+    from treeprofiler import taxa_cache
+    from treeprofiler import render_batch
     
     ## - ANNOTATE -
     annotate_args_p = subparser.add_parser('annotate', parents=[main_args_p],
@@ -96,6 +98,16 @@ def main():
     tree_plot.poplulate_plot_args(plot_args_p)
     plot_args_p.set_defaults(func=tree_plot.run)
 
+    ## - CACHE -
+    cache_args_p = subparser.add_parser('cache', description=taxa_cache.DESC)
+    taxa_cache.populate_cache_args(cache_args_p)
+    cache_args_p.set_defaults(func=taxa_cache.run)
+
+    ## - RENDER-BATCH -
+    batch_args_p = subparser.add_parser('render-batch', description=render_batch.DESC)
+    render_batch.populate_batch_args(batch_args_p)
+    batch_args_p.set_defaults(func=render_batch.run)
+
     ## - RUN -
     if len(sys.argv[1:]) < 1:
         print(parser.print_usage())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+import os
+import sys
+import copy
+import time
+import shlex
+import pickle
+import argparse
+import logging
+from collections import OrderedDict, namedtuple
+from multiprocessing import Pool
+
+from treeprofiler import tree_plot
+from treeprofiler.main import populate_main_args
+from treeprofiler.src import utils, prop_cache
+
+# Render many plots in one run.
+#
+# A manifest lists one plot per row: the tree, the output image and the
+# plot arguments, exactly as given to `treeprofiler plot`. The rows are
+# parsed up front with the plot parser, so a bad flag fails its row before
+# anything is drawn, and every color config is read once and handed to the
+# workers. Each worker keeps its last parsed trees and gives every row its
+# own copy, so presets of the same tree parse it only once. The rows are
+# rendered headless (see tree_render) and reported as they finish, with
+# their timing or their error.
+
+DESC = "render the plots of a manifest of trees and layout arguments"
+
+TREE_CACHE_SIZE = 8  # parsed trees kept by each worker
+REPORT_HEADER = ['line', 'tree', 'output', 'status', 'seconds', 'error']
+
+logger = logging.getLogger(__name__)
+
+BatchItem = namedtuple('BatchItem', ['line', 'tree', 'output', 'plot_args'])
+
+class ManifestError(Exception):
+    pass
+
+class PlotArgsParser(argparse.ArgumentParser):
+    """Plot parser that raises on bad arguments instead of exiting."""
+    def error(self, message):
+        raise ManifestError(message)
+
+def populate_batch_args(parser):
+    parser.add_argument('manifest', type=argparse.FileType('r'),
+        help="tab separated rows of: tree, output image (.svg, .png or .pdf) and the plot arguments of "
+             "`treeprofiler plot`, quoted as in a shell. Empty lines and lines starting with # are skipped.")
+    parser.add_argument('--threads', default=4, type=int,
+        help="Number of processes rendering the plots [default: 4]")
+    parser.add_argument('--report', type=str, default=None,
+        help="tsv file to write the status and time of every row. [default: None]")
+
+def get_plot_parser():
+    parser = PlotArgsParser(add_help=False)
+    populate_main_args(parser)
+    tree_plot.poplulate_plot_args(parser)
+    return parser
+
+def read_manifest(manifest):
+    """BatchItems of the rows of a manifest file object."""
+    items = []
+    for line, row in enumerate(manifest, 1):
+        row = row.rstrip('\n')
+        if not row.strip() or row.lstrip().startswith('#'):
+            continue
+        fields = row.split('\t')
+        if len(fields) < 2 or len(fields) > 3:
+            raise ManifestError(f"line {line}: expected tree, output and plot arguments separated by tabs")
+        tree_path, output = fields[0].strip(), fields[1].strip()
+        if tree_path == '-':
+            raise ManifestError(f"line {line}: trees cannot be read from standard input")
+        plot_args = shlex.split(fields[2]) if len(fields) == 3 else []
+        items.append(BatchItem(line, tree_path, output, plot_args))
+    return items
+
+def item_argv(item):
+    """Command line of the plot of `item`, whose order sets the order of its layouts."""
+    return ['--tree', item.tree] + item.plot_args + ['--render', item.output]
+
+def parse_item(parser, item):
+    args = parser.parse_args(item_argv(item))
+    if args.color_config:
+        args.color_config.close()
+    return args
+
+def color_config_key(args):
+    if not args.color_config:
+        return None
+    return (os.path.abspath(args.color_config.name), args.config_sep)
+
+def read_color_configs(parser, items):
+    """
+    {(path, separator): color config} of every distinct config in the
+    manifest, and {line: error} of the rows that cannot be parsed.
+    """
+    color_configs = {}
+    errors = {}
+    for item in items:
+        try:
+            args = parser.parse_args(item_argv(item))
+        except ManifestError as e:
+            errors[item.line] = str(e)
+            continue
+        key = color_config_key(args)
+        if key is not None:
+            if key not in color_configs:
+                color_configs[key] = tree_plot.read_config_to_dict(args.color_config, delimiter=args.config_sep)
+            args.color_config.close()
+    return color_configs, errors
+
+def load_tree(args, trees):
+    """
+    Copy of the tree of `args` and its eteformat flag, parsed only the first
+    time (with all its properties, to serve every preset) and kept pickled
+    in `trees`, an OrderedDict of the most recently used ones.
+    """
+    key = (os.path.abspath(args.tree), args.input_type, args.internal)
+    if key in trees:
+        trees.move_to_end(key)
+    else:
+        tree, eteformat_flag = utils.validate_tree(args.tree, args.input_type, args.internal)
+        trees[key] = (pickle.dumps(tree, protocol=pickle.HIGHEST_PROTOCOL), eteformat_flag)
+        if len(trees) > TREE_CACHE_SIZE:
+            trees.popitem(last=False)
+    data, eteformat_flag = trees[key]
+    return pickle.loads(data), eteformat_flag
+
+def render_item(item, parser, color_configs, trees):
+    """(line, tree, output, status, seconds, error) of plotting `item`."""
+    start = time.perf_counter()
+    tree = None
+    try:
+        args = parse_item(parser, item)
+        tree, eteformat_flag = load_tree(args, trees)
+        # every row starts from the shared config, not from what earlier rows did to it
+        color_config = copy.deepcopy(color_configs.get(color_config_key(args), {}))
+        tree_plot.run(args, argv=item_argv(item), parsed_tree=(tree, eteformat_flag),
+            color_config=color_config)
+        status, error = 'ok', ''
+    except SystemExit as e:
+        status, error = 'failed', f"exited with status {e.code}"
+    except Exception as e:
+        status, error = 'failed', f"{type(e).__name__}: {e}"
+    finally:
+        if tree is not None:
+            prop_cache.unregister(tree)
+    return item.line, item.tree, item.output, status, time.perf_counter() - start, error
+
+# worker side
+_worker = {}
+
+def _init_worker(color_configs):
+    _worker['parser'] = get_plot_parser()
+    _worker['color_configs'] = color_configs
+    _worker['trees'] = OrderedDict()
+
+def _render_item(item):
+    return render_item(item, _worker['parser'], _worker['color_configs'], _worker['trees'])
+
+def iter_render(items, color_configs, threads=1):
+    """Yield the result of every item as it finishes, see render_item."""
+    # rows of the same tree go together, so workers find it among their parsed trees
+    items = sorted(items, key=lambda item: (item.tree, item.line))
+    if threads > 1:
+        with Pool(threads, initializer=_init_worker, initargs=(color_configs,)) as pool:
+            yield from pool.imap_unordered(_render_item, items)
+    else:
+        parser = get_plot_parser()
+        trees = OrderedDict()
+        for item in items:
+            yield render_item(item, parser, color_configs, trees)
+
+def run(args):
+    try:
+        items = read_manifest(args.manifest)
+    except ManifestError as e:
+        logger.error(f"Invalid manifest {args.manifest.name}: {e}")
+        sys.exit(1)
+
+    parser = get_plot_parser()
+    color_configs, errors = read_color_configs(parser, items)
+    results = [(item.line, item.tree, item.output, 'failed', 0.0, errors[item.line])
+        for item in items if item.line in errors]
+    for result in results:
+        print(f"[failed] line {result[0]}: {result[5]}")
+
+    start = time.perf_counter()
+    valid_items = [item for item in items if item.line not in errors]
+    for result in iter_render(valid_items, color_configs, threads=args.threads):
+        line, tree_path, output, status, seconds, error = result
+        if status == 'ok':
+            print(f"[ok] line {line}: {output} in {seconds:.2f} seconds")
+        else:
+            print(f"[failed] line {line}: {output}: {error}")
+        results.append(result)
+
+    failed = sum(1 for result in results if result[3] != 'ok')
+    print(f"Rendered {len(results) - failed} of {len(results)} plots in {time.perf_counter() - start:.2f} seconds")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            print(*REPORT_HEADER, sep='\t', file=f)
+            for line, tree_path, output, status, seconds, error in sorted(results):
+                print(line, tree_path, output, status, f'{seconds:.3f}', error, sep='\t', file=f)
+
+    if failed:
+        sys.exit(1)
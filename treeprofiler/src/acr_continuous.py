@@ -2,6 +2,81 @@
 import numpy as np
 import pymc as pm
 
+from treeprofiler.src.tree_index import TreeIndex
+
+# smallest variance of a branch in the pruning reconstruction
+MIN_BRANCH_VARIANCE = 1e-12
+
+def node_depths(tree):
+    """
+    Distance from the root to every node, in a single preorder traversal.
+    Nodes below a branch without length get NaN.
+    """
+    depths = {tree: 0.0}
+    for node in tree.traverse("preorder"):
+        if node is tree:
+            continue
+        dist = node.dist if node.dist is not None else np.nan
+        depths[node] = depths[node.up] + dist
+    return depths
+
+def shared_time_matrix(tree, species):
+    """
+    Matrix of the root to MRCA distances of every pair of species.
+
+    Every pair of leaves is written exactly once, at their MRCA: for each
+    internal node the blocks between the leaves of its different children
+    get the depth of the node, and the diagonal gets the depth of the leaves.
+    This is O(n^2) instead of a common_ancestor lookup per pair.
+    """
+    n = len(species)
+    index = TreeIndex(tree)
+    depths = node_depths(tree)
+
+    # row of every species, following the preorder leaf order
+    name2row = {}
+    for i, name in enumerate(species):
+        name2row.setdefault(name, i)
+    leaf_rows = np.full(index.n_leaves, -1, dtype=np.int64)
+    seen = set()
+    for i, leaf in enumerate(index.leaves):
+        # like search_leaves_by_name, the first leaf with a name is used
+        if leaf.name in name2row and leaf.name not in seen:
+            leaf_rows[i] = name2row[leaf.name]
+            seen.add(leaf.name)
+    missing = set(name2row) - seen
+    if missing:
+        raise ValueError(f"Species not found in tree: {', '.join(sorted(missing))}")
+
+    T = np.zeros((n, n))
+    for node in index.nodes:
+        if node.is_leaf:
+            row = leaf_rows[index.leaf_start[index.node_id(node)]]
+            if row >= 0:
+                T[row, row] = depths[node]
+            continue
+        children_rows = []
+        for child in node.children:
+            rows = leaf_rows[index.clade_slice(child)]
+            rows = rows[rows >= 0]
+            if len(rows):
+                children_rows.append(rows)
+        for a in range(len(children_rows)):
+            for b in range(a + 1, len(children_rows)):
+                T[np.ix_(children_rows[a], children_rows[b])] = depths[node]
+                T[np.ix_(children_rows[b], children_rows[a])] = depths[node]
+
+    # duplicated species names share the row of their first occurrence
+    for i, name in enumerate(species):
+        first = name2row[name]
+        if first != i:
+            T[i, :] = T[first, :]
+            T[:, i] = T[:, first]
+
+    if np.isnan(T).any():
+        raise ValueError("Tree has branches without length, cannot compute the variance-covariance matrix")
+    return T
+
 def build_variance_covariance_matrix(tree, species, sigma, alpha=None, model='BM'):
     """
     Build the variance-covariance matrix for BM or OU models.
@@ -16,22 +91,62 @@ def build_variance_covariance_matrix(tree, species, sigma, alpha=None, model='BM
     Returns:
     - Variance-covariance matrix (V)
     """
-    n = len(species)
-    V = np.zeros((n, n))
-
-    for i in range(n):
-        for j in range(i, n):
-            leaf_i = next(tree.search_leaves_by_name(name=species[i]))
-            leaf_j = next(tree.search_leaves_by_name(name=species[j]))
-            mrca = tree.common_ancestor([leaf_i, leaf_j])
-            shared_time = tree.get_distance(tree, mrca)
-            
-            if model == 'BM':
-                V[i, j] = V[j, i] = sigma ** 2 * shared_time
-            elif model == 'OU':
-                V[i, j] = V[j, i] = (sigma ** 2 / (2 * alpha)) * (1 - np.exp(-2 * alpha * shared_time))
+    shared_time = shared_time_matrix(tree, species)
+
+    if model == 'BM':
+        V = sigma ** 2 * shared_time
+    elif model == 'OU':
+        V = (sigma ** 2 / (2 * alpha)) * (1 - np.exp(-2 * alpha * shared_time))
+    else:
+        V = np.zeros_like(shared_time)
     return V
 
+def contrasts_root_estimate(tree, observed_traits):
+    """
+    GLS estimate of the root value under Brownian Motion, computed with
+    Felsenstein's independent contrasts in a single postorder traversal.
+
+    Every node gets the weighted average of its children values, with
+    weights 1/v, and its branch is lengthened by the variance of that
+    average. This gives the same value as (1' V^-1 Y) / (1' V^-1 1) without
+    building V. Leaves without an observed value are ignored.
+    
+    Parameters:
+    - tree: Phylogenetic tree
+    - observed_traits: Observed trait values
+    
+    Returns:
+    - Root value estimate
+    """
+    node2estimate = {}
+    seen = set()
+    for node in tree.traverse("postorder"):
+        dist = node.dist if node.dist is not None and node is not tree else 0.0
+        if node.is_leaf:
+            if node.name in observed_traits and node.name not in seen:
+                node2estimate[node] = (float(observed_traits[node.name]), dist)
+                seen.add(node.name)
+            continue
+
+        estimates = [node2estimate.pop(child) for child in node.children if child in node2estimate]
+        if not estimates:
+            continue
+        values = np.array([value for value, _ in estimates])
+        variances = np.array([variance for _, variance in estimates])
+        zero = variances == 0
+        if zero.any():
+            # a child without variance fixes the value of the node
+            value, extra = values[zero].mean(), 0.0
+        else:
+            weights = 1.0 / variances
+            value = (weights @ values) / weights.sum()
+            extra = 1.0 / weights.sum()
+        node2estimate[node] = (value, dist + extra)
+
+    if tree not in node2estimate:
+        raise ValueError("No observed traits found in tree")
+    return node2estimate[tree][0]
+
 def bm_model(V, Y, sigma):
     """
     Likelihood function for Brownian Motion model.
@@ -64,7 +179,7 @@ def ou_model(V, Y, sigma, alpha, theta):
     # Placeholder function structure; for Bayesian, the actual likelihood computation happens in PyMC3
     return V, Y, alpha, theta
 
-def ml_acr(tree, prop, observed_traits, model='BM', sigma=1.0, alpha=None, theta=None):
+def ml_acr(tree, prop, observed_traits, model='BM', sigma=1.0, alpha=None, theta=None, root_method=None):
     """
     Maximum Likelihood Ancestral Character Reconstruction.
     
@@ -75,25 +190,41 @@ def ml_acr(tree, prop, observed_traits, model='BM', sigma=1.0, alpha=None, theta
     - sigma: Drift rate
     - alpha: Selection strength (OU model only)
     - theta: Optimal trait value (OU model only)
+    - root_method: 'contrasts' to estimate the root value with independent
+      contrasts in O(n) without the variance-covariance matrix (BM only), or
+      'gls' to solve with the dense matrix. Defaults to 'contrasts' for BM
+      and 'gls' for OU.
     
     Returns:
     - Annotated tree with estimated traits
     - Results with node values and credible intervals
     """
-    species = list(observed_traits.keys())
-    V = build_variance_covariance_matrix(tree, species, sigma, alpha, model)
-    Y = np.array([observed_traits[sp] for sp in species])
+    if root_method is None:
+        root_method = 'contrasts' if model == 'BM' else 'gls'
+    if root_method == 'contrasts' and model != 'BM':
+        raise ValueError(f"Independent contrasts are only valid for the BM model, not {model}")
 
     # Compute ML estimate for the root value
-    V_inv = np.linalg.inv(V)
-    ones = np.ones(len(species))
-    root_value = (ones @ V_inv @ Y) / (ones @ V_inv @ ones)
+    if root_method == 'contrasts':
+        root_value = contrasts_root_estimate(tree, observed_traits)
+    elif root_method == 'gls':
+        species = list(observed_traits.keys())
+        V = build_variance_covariance_matrix(tree, species, sigma, alpha, model)
+        Y = np.array([observed_traits[sp] for sp in species])
+        ones = np.ones(len(species))
+        V_inv_ones = np.linalg.solve(V, ones)
+        root_value = (V_inv_ones @ Y) / (V_inv_ones @ ones)
+    else:
+        raise ValueError(f"Invalid root_method '{root_method}'")
     
     results = {'root': {prop: root_value}}
     print(f"Estimated ancestral {prop} value at the root ({model}-ML): {root_value:.2f}")
 
-    # Recursive estimation for internal nodes
-    def estimate_internal_states(node, parent_value):
+    # Estimation for internal nodes, in preorder with an explicit stack so
+    # deep trees do not hit the recursion limit
+    stack = [(tree, root_value)]
+    while stack:
+        node, parent_value = stack.pop()
         if node.is_leaf:
             node.add_prop(prop, observed_traits[node.name])
             results[node.name] = {prop: observed_traits[node.name]}
@@ -112,15 +243,151 @@ def ml_acr(tree, prop, observed_traits, model='BM', sigma=1.0, alpha=None, theta
             node.add_prop(prop, expected_value)
             results[node.name or 'Unnamed'] = {prop: expected_value}
 
-            # Recurse to estimate states for children nodes
-            estimate_internal_states(left_child, left_child_value)
-            estimate_internal_states(right_child, right_child_value)
+            # Visit the left subtree before the right one
+            stack.append((right_child, right_child_value))
+            stack.append((left_child, left_child_value))
 
-    estimate_internal_states(tree, root_value)
     return tree, results
 
 
 
+def _branch_params(node, model, sigma, alpha=None, theta=None):
+    """
+    Linear Gaussian transition along the branch above `node`:
+    x_node = a * x_parent + b + N(0, q).
+    """
+    branch_length = node.dist if node.dist is not None else 1  # Ensure branch length is not None
+    if model == 'OU':
+        a = np.exp(-alpha * branch_length)
+        b = theta * (1 - a)
+        q = (sigma ** 2 / (2 * alpha)) * (1 - a ** 2)
+    else:
+        a, b, q = 1.0, 0.0, sigma ** 2 * branch_length
+    # zero length branches would give infinite precision messages
+    return a, b, max(q, MIN_BRANCH_VARIANCE)
+
+def _message_up(message, a, b, q):
+    """Move a (precision, precision * mean) message from a node to its parent."""
+    precision, weighted_mean = message
+    if precision <= 0:
+        return (0.0, 0.0)
+    mean = weighted_mean / precision
+    up_precision = a ** 2 / (1 / precision + q)
+    return (up_precision, up_precision * (mean - b) / a)
+
+def _message_down(message, a, b, q):
+    """Move a (precision, precision * mean) message from a node to its child."""
+    precision, weighted_mean = message
+    if precision <= 0:
+        return (0.0, 0.0)
+    mean = weighted_mean / precision
+    down_precision = 1 / (a ** 2 / precision + q)
+    return (down_precision, down_precision * (a * mean + b))
+
+def pruning_acr(tree, prop, observed_traits, model='BM', sigma=None, alpha=None, theta=None):
+    """
+    Marginal Ancestral Character Reconstruction by Gaussian message passing.
+
+    A postorder pass collects, for every node, the likelihood of the traits
+    below it as a Gaussian in the node value, and a preorder pass sends down
+    the information from the rest of the tree. Their product gives the exact
+    marginal mean and variance of every internal node in O(n), without the
+    variance-covariance matrix. The root has a flat prior, so its mean is the
+    GLS root estimate. Leaves without an observed value are ignored.
+    
+    Parameters:
+    - tree: Phylogenetic tree
+    - observed_traits: Observed trait values
+    - model: 'BM' or 'OU'
+    - sigma: Drift rate. If None with BM, it is estimated by REML from the
+      independent contrasts of the postorder pass
+    - alpha: Selection strength (OU model only)
+    - theta: Optimal trait value (OU model only)
+    
+    Returns:
+    - Annotated tree with estimated traits
+    - Results with node values, variances and 95% confidence intervals
+    """
+    if model == 'OU' and (sigma is None or alpha is None or theta is None):
+        raise ValueError("sigma, alpha and theta are required for the OU model")
+    estimate_sigma = sigma is None
+    branch_sigma = 1.0 if estimate_sigma else sigma
+
+    # postorder, likelihood of the data below each node as (precision, precision * mean)
+    node2up = {}
+    node2message = {}
+    contrasts_sum = 0.0
+    contrasts_count = 0
+    seen = set()
+    for node in tree.traverse("postorder"):
+        if node is not tree:
+            a, b, q = _branch_params(node, model, branch_sigma, alpha, theta)
+        if node.is_leaf:
+            if node.name in observed_traits and node.name not in seen and node is not tree:
+                seen.add(node.name)
+                value = float(observed_traits[node.name])
+                precision = a ** 2 / q
+                node2message[node] = (precision, precision * (value - b) / a)
+            else:
+                node2message[node] = (0.0, 0.0)
+            continue
+
+        precision, weighted_mean = 0.0, 0.0
+        for child in node.children:
+            child_precision, child_weighted_mean = node2message[child]
+            if child_precision == 0:
+                continue
+            if precision > 0:
+                # standardized independent contrast between the merged messages
+                difference = weighted_mean / precision - child_weighted_mean / child_precision
+                contrasts_sum += difference ** 2 / (1 / precision + 1 / child_precision)
+                contrasts_count += 1
+            precision += child_precision
+            weighted_mean += child_weighted_mean
+        node2up[node] = (precision, weighted_mean)
+        if node is not tree:
+            node2message[node] = _message_up(node2up[node], a, b, q)
+
+    if not node2up.get(tree, (0.0, 0.0))[0]:
+        raise ValueError("No observed traits found in tree")
+
+    variance_scale = 1.0
+    if estimate_sigma and model == 'BM' and contrasts_count:
+        variance_scale = contrasts_sum / contrasts_count
+
+    # preorder, information from outside the clade of each node
+    node2down = {tree: (0.0, 0.0)}
+    results = {}
+    for node in tree.traverse("preorder"):
+        if node.is_leaf:
+            if node.name in observed_traits:
+                node.add_prop(prop, observed_traits[node.name])
+                results[node.name] = {prop: observed_traits[node.name]}
+            continue
+
+        up_precision, up_weighted_mean = node2up[node]
+        down_precision, down_weighted_mean = node2down.pop(node)
+        precision = up_precision + down_precision
+        weighted_mean = up_weighted_mean + down_weighted_mean
+        for child in node.children:
+            child_precision, child_weighted_mean = node2message[child]
+            cavity = (precision - child_precision, weighted_mean - child_weighted_mean)
+            if not child.is_leaf:
+                node2down[child] = _message_down(cavity, *_branch_params(child, model, branch_sigma, alpha, theta))
+
+        if precision <= 0:
+            continue
+        mean = weighted_mean / precision
+        variance = variance_scale / precision
+        half_width = 1.96 * np.sqrt(variance)
+        node.add_prop(prop, mean)
+        key = 'root' if node is tree else (node.name or 'Unnamed')
+        results[key] = {prop: mean, 'variance': variance,
+            'credible_interval': (mean - half_width, mean + half_width)}
+
+    print(f"Estimated ancestral {prop} value at the root ({model}-PRUNING): {results['root'][prop]:.2f}")
+    return tree, results
+
 def by_acr(tree, prop, observed_traits, model='BM', sigma_prior=10, sigma_drift=5.0, alpha=None, theta=None):
     """
     Bayesian Inference Ancestral Character Reconstruction using PyMC.
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import os
+import mmap
+
+import numpy as np
+
+# Random access to the sequences of an aligned FASTA file.
+#
+# The file is indexed once into the byte range of every record, so a
+# sequence is read back with one slice of the memory-mapped file instead of
+# keeping every sequence as a Python string. With `cache`, the alignment is
+# also saved as a uint8 matrix (one row per sequence, padded with gaps)
+# in .npy sidecars next to the file, which later runs memory-map instead of
+# scanning the FASTA again. Annotation, consensus and domain coordinate
+# translation share one store.
+
+GAP = ord('-')
+ROWS_SUFFIX = '.rows.npy'
+LENGTHS_SUFFIX = '.lengths.npy'
+
+def sidecar_paths(fasta_file):
+    return fasta_file + '.npy', fasta_file + ROWS_SUFFIX, fasta_file + LENGTHS_SUFFIX
+
+def read_seq(data):
+    """Sequence of the bytes of a record body, without newlines or spaces."""
+    return b''.join(data.split()).decode('latin-1')
+
+class AlignmentStore:
+    def __init__(self, fasta_file, cache=False):
+        self.fasta_file = fasta_file
+        self.matrix = None
+        self._mm = None
+
+        if cache and self.load_cache():
+            return
+
+        self.build_index()
+        if cache:
+            self.save_cache()
+
+    def build_index(self):
+        """Byte range of the body of every record, later records win on duplicated names."""
+        self.name2range = {}
+        self.name2length = {}
+        name = None
+        start = end = length = 0
+        offset = 0
+        with open(self.fasta_file, 'rb') as f:
+            for line in f:
+                stripped = line.strip()
+                if stripped.startswith(b'>'):
+                    if name is not None:
+                        self.name2range[name] = (start, end)
+                        self.name2length[name] = length
+                    name = stripped[1:].decode('latin-1')
+                    start = end = offset + len(line)
+                    length = 0
+                elif name is not None:
+                    end = offset + len(line)
+                    length += len(b''.join(stripped.split()))
+                offset += len(line)
+        if name is not None:
+            self.name2range[name] = (start, end)
+            self.name2length[name] = length
+
+        self.names = list(self.name2range)
+        self.name2row = {name: i for i, name in enumerate(self.names)}
+        self.length = max(self.name2length.values(), default=0)
+
+    @property
+    def mm(self):
+        if self._mm is None:
+            with open(self.fasta_file, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mm
+
+    def load_cache(self):
+        paths = sidecar_paths(self.fasta_file)
+        if not all(os.path.exists(path) for path in paths) \
+                or os.path.getmtime(paths[0]) < os.path.getmtime(self.fasta_file):
+            return False
+        values_path, rows_path, lengths_path = paths
+        self.matrix = np.load(values_path, mmap_mode='r')
+        self.names = np.load(rows_path).tolist()
+        self.name2row = {name: i for i, name in enumerate(self.names)}
+        self.name2length = dict(zip(self.names, np.load(lengths_path).tolist()))
+        self.length = self.matrix.shape[1]
+        return True
+
+    def save_cache(self):
+        values_path, rows_path, lengths_path = sidecar_paths(self.fasta_file)
+        np.save(values_path, self.encode())
+        np.save(rows_path, np.array(self.names, dtype=str))
+        np.save(lengths_path, np.array([self.name2length[name] for name in self.names], dtype=np.int64))
+        self.matrix = np.load(values_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2row
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def get(self, name, default=''):
+        """Aligned sequence of `name`."""
+        if name not in self.name2row:
+            return default
+        if self.matrix is not None:
+            row = self.matrix[self.name2row[name], :self.name2length[name]]
+            return row.tobytes().decode('latin-1')
+        start, end = self.name2range[name]
+        return read_seq(self.mm[start:end])
+
+    def window(self, name, start, end, default=''):
+        """Columns [start, end) of the aligned sequence of `name`."""
+        if name not in self.name2row:
+            return default
+        if self.matrix is not None:
+            end = min(end, self.name2length[name])
+            return self.matrix[self.name2row[name], start:end].tobytes().decode('latin-1')
+        return self.get(name)[start:end]
+
+    def items(self):
+        for name in self.names:
+            yield name, self.get(name)
+
+    def residue_columns(self, name):
+        """1-based alignment columns of the residues of `name`, raw position p is at index p - 1."""
+        seq = np.frombuffer(self.get(name).encode('latin-1'), dtype=np.uint8)
+        return np.flatnonzero(seq != GAP) + 1
+
+    def encode(self):
+        """The alignment as a uint8 matrix of characters, shorter sequences padded with gaps."""
+        if self.matrix is not None:
+            return self.matrix
+        values = np.full((len(self.names), self.length), GAP, dtype=np.uint8)
+        for i, name in enumerate(self.names):
+            seq = self.get(name).encode('latin-1')
+            values[i, :len(seq)] = np.frombuffer(seq, dtype=np.uint8)
+        return values
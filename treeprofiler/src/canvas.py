@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import os
+from collections import defaultdict
+from xml.sax.saxutils import escape
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection, EllipseCollection
+import matplotlib.colors as mcolors
+
+# Static painting of smartview graphic elements.
+#
+# The smartview drawers describe a tree as a stream of graphic elements,
+# ['line', p1, p2, type, parent_of, style], ['rect', box, type, style,
+# tooltip], ['array', box, colors, tooltip]..., that the browser turns into
+# SVG. A Canvas collects the same elements already in pixels, grouped by
+# kind and style, and writes them as SVG itself (one path per group) or
+# rasters them with matplotlib into PNG or PDF, with no browser involved.
+# Groups are written in a fixed order, so the same drawing always gives
+# the same file.
+
+DPI = 72  # one pixel of the tree view is one point of the figure
+MARGIN = 10
+MAX_PNG_SIDE = 30000  # Agg cannot raster images over 2^16 pixels a side
+MIN_PNG_FSIZE = 3     # texts rastered smaller than this are left out of PNGs
+DEFAULT_COLOR = '#000000'
+OUTLINE_STYLE = {'fill': '#e5e5e5', 'fill-opacity': 0.3, 'stroke': '#000000'}
+DASHES = {'dotted': '1,2', 'dashed': '4,2'}
+FORMATS = ('svg', 'png', 'pdf')
+
+# drawing order of the element kinds
+Z_ORDER = {'nodebox': 0, 'outline': 1, 'polygon': 2, 'line': 3, 'ellipse': 4, 'text': 5}
+
+class UnsupportedFormat(Exception):
+    pass
+
+def image_format(path):
+    extension = os.path.splitext(path)[1][1:].lower()
+    if extension not in FORMATS:
+        raise UnsupportedFormat(f"Cannot render '{path}', use one of the extensions: {', '.join(FORMATS)}")
+    return extension
+
+def points(vertices):
+    return 'L'.join(f'{x:.2f},{y:.2f}' for x, y in vertices)
+
+class Canvas:
+    def __init__(self):
+        self.lines = defaultdict(list)     # (color, width, alpha, dash) -> segments
+        self.polygons = defaultdict(list)  # (kind, fill, alpha, stroke) -> vertices
+        self.ellipses = defaultdict(list)  # (fill, alpha) -> (x, y, rx, ry)
+        self.texts = []                    # (x, y, text, fontsize, rotation, color)
+        self.xmax = self.ymax = 0
+        self._colors = {}
+
+    def color(self, color, default=DEFAULT_COLOR):
+        """Hex of a color, `default` for the ones matplotlib does not know."""
+        if color not in self._colors:
+            self._colors[color] = mcolors.to_hex(color) if color and mcolors.is_color_like(color) else None
+        return self._colors[color] or default
+
+    def extend(self, x, y):
+        self.xmax = max(self.xmax, x)
+        self.ymax = max(self.ymax, y)
+
+    def add(self, element, transform):
+        """Paint a graphic element, `transform` taking its points to pixels."""
+        kind = element[0]
+        if kind == 'line':
+            _, p1, p2, _, _, style = element[:6]
+            self.add_line(transform(p1), transform(p2), style)
+        elif kind == 'rect':
+            _, box, _, style = element[:4]
+            self.add_box(box, transform, style)
+        elif kind == 'array':
+            _, box, colors = element[:3]
+            self.add_array(box, colors, transform)
+        elif kind in ('polygon', 'rhombus'):
+            _, vertices, _, style = element[:4]
+            self.add_polygon([transform(p) for p in vertices], style)
+        elif kind == 'triangle':
+            _, box, tip, _, style = element[:5]
+            self.add_triangle(box, tip, transform, style)
+        elif kind == 'circle':
+            _, center, radius, _, style = element[:5]
+            self.add_ellipse(transform(center), radius, radius, style)
+        elif kind == 'ellipse':
+            _, center, rx, ry, _, style = element[:6]
+            self.add_ellipse(transform(center), rx, ry, style)
+        elif kind == 'text':
+            _, box, text, _, rotation, _, style = element[:7]
+            self.add_text(box, text, transform, rotation, style)
+        elif kind == 'outline':
+            _, box, style = element[:3]
+            self.add_box(box, transform, {**OUTLINE_STYLE, **(style or {})}, kind='outline')
+        elif kind == 'nodebox':
+            style = element[-1] or {}
+            if style.get('fill') not in (None, '', 'transparent'):
+                self.add_box(element[1], transform, style, kind='nodebox')
+        # arcs and slices only exist in circular drawings, html and images are not painted
+
+    def add_line(self, p1, p2, style):
+        style = style or {}
+        key = (self.color(style.get('stroke')), float(style.get('stroke-width', 1)),
+            float(style.get('opacity', 1)), style.get('type') or 'solid')
+        self.lines[key].append((tuple(p1), tuple(p2)))
+        self.extend(max(p1[0], p2[0]), max(p1[1], p2[1]))
+
+    def add_polygon(self, vertices, style, kind='polygon'):
+        style = style or {}
+        key = (kind, self.color(style.get('fill', style.get('color'))),
+            float(style.get('fill-opacity', style.get('opacity', 1))),
+            self.color(style.get('stroke'), default='none'))
+        self.polygons[key].append(vertices)
+        for x, y in vertices:
+            self.extend(x, y)
+
+    def add_box(self, box, transform, style, kind='polygon'):
+        x, y, dx, dy = box
+        (x0, y0), (x1, y1) = transform((x, y)), transform((x + dx, y + dy))
+        self.add_polygon([(x0, y0), (x1, y0), (x1, y1), (x0, y1)], style, kind)
+
+    def add_array(self, box, colors, transform):
+        if not colors:
+            return
+        x, y, dx, dy = box
+        step = dx / len(colors)
+        for i, color in enumerate(colors):
+            self.add_box((x + i * step, y, step, dy), transform, {'fill': color})
+
+    def add_triangle(self, box, tip, transform, style):
+        x, y, dx, dy = box
+        if tip == 'top':
+            vertices = [(x, y + dy), (x + dx / 2, y), (x + dx, y + dy)]
+        elif tip == 'bottom':
+            vertices = [(x, y), (x + dx / 2, y + dy), (x + dx, y)]
+        elif tip == 'left':
+            vertices = [(x + dx, y), (x, y + dy / 2), (x + dx, y + dy)]
+        else:
+            vertices = [(x, y), (x + dx, y + dy / 2), (x, y + dy)]
+        self.add_polygon([transform(p) for p in vertices], style)
+
+    def add_ellipse(self, center, rx, ry, style):
+        style = style or {}
+        key = (self.color(style.get('fill', style.get('color'))),
+            float(style.get('fill-opacity', style.get('opacity', 1))))
+        self.ellipses[key].append((center[0], center[1], rx, ry))
+        self.extend(center[0] + rx, center[1] + ry)
+
+    def add_text(self, box, text, transform, rotation, style):
+        style = style or {}
+        x, y, dx, dy = box
+        (x0, y0), (x1, y1) = transform((x, y)), transform((x + dx, y + dy))
+        # the text fills the height of its box, as in the tree view
+        fontsize = min(abs(y1 - y0), float(style.get('max_fsize', style.get('font-size', 15))))
+        if fontsize <= 0 or text is None or str(text) == '':
+            return
+        self.texts.append((x0, (y0 + y1) / 2, str(text), fontsize, rotation or 0,
+            self.color(style.get('fill', style.get('color')))))
+        self.extend(x0 + fontsize * 0.6 * len(str(text)), y1)
+
+    def size(self, width=None, height=None):
+        return (width or self.xmax) + 2 * MARGIN, (height or self.ymax) + 2 * MARGIN
+
+    def polygon_groups(self):
+        return sorted(self.polygons.items(), key=lambda item: (Z_ORDER[item[0][0]], item[0]))
+
+    def svg(self, width=None, height=None):
+        """The painting as an SVG document."""
+        width, height = self.size(width, height)
+        out = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" '
+               f'viewBox="{-MARGIN} {-MARGIN} {width:.2f} {height:.2f}" font-family="sans-serif">']
+
+        for (kind, fill, alpha, stroke), polygons in self.polygon_groups():
+            d = ''.join(f'M{points(vertices)}Z' for vertices in polygons)
+            out.append(f'<path d="{d}" fill="{fill}" fill-opacity="{alpha:g}" stroke="{stroke}"/>')
+        for (color, linewidth, alpha, dash), segments in sorted(self.lines.items()):
+            d = ''.join(f'M{points(segment)}' for segment in segments)
+            dasharray = f' stroke-dasharray="{DASHES[dash]}"' if dash in DASHES else ''
+            out.append(f'<path d="{d}" fill="none" stroke="{color}" stroke-width="{linewidth:g}" '
+                       f'stroke-opacity="{alpha:g}"{dasharray}/>')
+        for (fill, alpha), ellipses in sorted(self.ellipses.items()):
+            out.append(f'<g fill="{fill}" fill-opacity="{alpha:g}">')
+            out.extend(f'<ellipse cx="{x:.2f}" cy="{y:.2f}" rx="{rx:.2f}" ry="{ry:.2f}"/>'
+                for x, y, rx, ry in ellipses)
+            out.append('</g>')
+        for x, y, text, fontsize, rotation, color in self.texts:
+            rotate = f' transform="rotate({rotation:g} {x:.2f} {y:.2f})"' if rotation else ''
+            out.append(f'<text x="{x:.2f}" y="{y:.2f}" font-size="{fontsize:.2f}" fill="{color}" '
+                       f'dominant-baseline="central"{rotate}>{escape(text)}</text>')
+        out.append('</svg>')
+        return '\n'.join(out) + '\n'
+
+    def figure(self, width=None, height=None, min_fontsize=0):
+        """The painting as a matplotlib figure, one collection per group."""
+        width, height = self.size(width, height)
+        fig = Figure(figsize=(width / DPI, height / DPI), dpi=DPI)
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_xlim(-MARGIN, width - MARGIN)
+        ax.set_ylim(height - MARGIN, -MARGIN)  # y grows downwards, as on screen
+        ax.axis('off')
+
+        for (kind, fill, alpha, stroke), polygons in self.polygon_groups():
+            ax.add_collection(PolyCollection(polygons, facecolors=fill, alpha=alpha,
+                edgecolors=stroke, linewidths=0.5 if stroke != 'none' else 0,
+                zorder=Z_ORDER[kind], antialiased=False))
+        for (color, linewidth, alpha, dash), segments in sorted(self.lines.items()):
+            ax.add_collection(LineCollection(segments, colors=color, linewidths=linewidth,
+                alpha=alpha, linestyles=dash if dash in DASHES else 'solid', zorder=Z_ORDER['line']))
+        for (fill, alpha), ellipses in sorted(self.ellipses.items()):
+            xs, ys, rxs, rys = zip(*ellipses)
+            ax.add_collection(EllipseCollection([2 * rx for rx in rxs], [2 * ry for ry in rys], 0,
+                units='xy', offsets=list(zip(xs, ys)), offset_transform=ax.transData,
+                facecolors=fill, alpha=alpha, zorder=Z_ORDER['ellipse']))
+        for x, y, text, fontsize, rotation, color in self.texts:
+            if fontsize >= min_fontsize:
+                ax.text(x, y, text, fontsize=fontsize, rotation=-rotation, color=color,
+                    va='center', ha='left', rotation_mode='anchor', zorder=Z_ORDER['text'])
+        return fig
+
+    def save(self, path, width=None, height=None):
+        """Write the painting to `path`, as SVG, PNG or PDF after its extension."""
+        file_format = image_format(path)
+        if file_format == 'svg':
+            with open(path, 'w') as f:
+                f.write(self.svg(width, height))
+            return path
+
+        # shrink the images of huge trees to what can be rastered
+        scale = min(1, MAX_PNG_SIDE / max(self.size(width, height))) if file_format == 'png' else 1
+        fig = self.figure(width, height, min_fontsize=MIN_PNG_FSIZE / scale if file_format == 'png' else 0)
+        metadata = {'CreationDate': None} if file_format == 'pdf' else None
+        fig.savefig(path, format=file_format, dpi=DPI * scale, metadata=metadata)
+        return path
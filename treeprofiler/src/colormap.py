@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+from functools import lru_cache
+from collections.abc import Mapping
+
+import numpy as np
+
+from treeprofiler.src import utils
+
+# Gradient lookup tables for the numerical layouts.
+#
+# A gradient of N colors, the {1..N: color} dicts of utils.build_color_gradient
+# and utils.build_custom_gradient, is laid over N evenly spaced steps of a
+# value range, and a value takes the color of its nearest step. The steps
+# are computed once per prop, so the colors of a whole array of values come
+# from one np.searchsorted call instead of an argmin over the steps for
+# every distinct value.
+
+NCOLORS = 40
+NAN_COLOR = '#EBEBEB'
+# steps of the normalized values of each --heatmap normalization method
+NORM_RANGES = {
+    'min-max': (0, 1),
+    'mean': (-1, 1),
+    'zscore': (-3, 3),
+}
+
+@lru_cache(maxsize=None)
+def _gradient(colormap_name, ncolors):
+    return tuple(utils.build_color_gradient(ncolors, colormap_name=colormap_name).items())
+
+@lru_cache(maxsize=None)
+def _custom_gradient(min_color, max_color, mid_color, ncolors):
+    return tuple(utils.build_custom_gradient(ncolors, min_color, max_color, mid_color).items())
+
+def gradient(colormap_name, ncolors=NCOLORS):
+    """utils.build_color_gradient, computed once per colormap."""
+    return dict(_gradient(colormap_name, ncolors))
+
+def custom_gradient(min_color, max_color, mid_color=None, ncolors=NCOLORS):
+    """utils.build_custom_gradient, computed once per set of colors."""
+    return dict(_custom_gradient(min_color, max_color, mid_color, ncolors))
+
+def normalize(values, norm_method, minval, maxval, mean_val=None, std_val=None):
+    """Normalize an array of values the way --heatmap-layout does."""
+    values = np.asarray(values, dtype=np.float64)
+    if norm_method == 'min-max':
+        return np.zeros_like(values) if maxval == minval else (values - minval) / (maxval - minval)
+    elif norm_method == 'mean':
+        return np.zeros_like(values) if maxval == minval else (values - mean_val) / (maxval - minval)
+    elif norm_method == 'zscore':
+        return np.zeros_like(values) if std_val == 0 else (values - mean_val) / std_val
+    raise ValueError("Unsupported normalization method.")
+
+class GradientLUT:
+    def __init__(self, gradient, start=0, stop=1):
+        keys = sorted(gradient)
+        self.gradient = gradient
+        self.colors = np.array([gradient[key] for key in keys], dtype=object)
+        self.start, self.stop = start, stop
+
+        steps = np.linspace(start, stop, len(keys))
+        self.descending = stop < start
+        self.steps = steps[::-1] if self.descending else steps
+
+    def __len__(self):
+        return len(self.colors)
+
+    @property
+    def color_range(self):
+        """Colors of the top, middle and bottom of the range, as the legends take them."""
+        num = len(self.gradient)
+        return [self.gradient[num], self.gradient[num // 2], self.gradient[1]]
+
+    def indices(self, values):
+        """0-based step nearest to every value, the lower one on ties as argmin picks it."""
+        values = np.asarray(values, dtype=np.float64)
+        if self.start == self.stop or len(self.steps) == 1:
+            return np.zeros(values.shape, dtype=np.intp)
+        # the two steps around every value, then the nearest of both
+        steps = self.steps
+        right = np.clip(np.searchsorted(steps, values), 1, len(steps) - 1)
+        to_left, to_right = np.abs(values - steps[right - 1]), np.abs(steps[right] - values)
+        if self.descending:
+            return len(steps) - 1 - (right - (to_left < to_right))
+        return right - (to_left <= to_right)
+
+    def lookup(self, values):
+        """Gradient color of every value."""
+        return self.colors[self.indices(values)]
+
+    def value2color(self, values, transform=None, value2color=None):
+        """
+        ValueColors of the distinct non-NaN `values`, each placed on the
+        gradient at transform(value) when given (its normalized value, for
+        instance). Colors already set in `value2color` are kept.
+        """
+        values = np.unique(np.asarray(values, dtype=np.float64))
+        values = values[~np.isnan(values)]
+        positions = values if transform is None else transform(values)
+        return ValueColors(values, self.lookup(positions), value2color)
+
+class ValueColors(Mapping):
+    """
+    {value: color} of the values of a prop, held as the sorted distinct
+    values and their colors in two aligned arrays, with the explicitly set
+    colors (configured ones, missing values) on top. Layouts use it like
+    the dicts they always took, without one dict entry per value.
+    """
+    def __init__(self, values, colors, overrides=None):
+        self.values = values
+        self.colors = colors
+        self.overrides = dict(overrides or {})
+
+    def _index(self, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        i = np.searchsorted(self.values, value)
+        if i < len(self.values) and self.values[i] == value:
+            return i
+        return None
+
+    def __getitem__(self, value):
+        if value in self.overrides:
+            return self.overrides[value]
+        i = self._index(value)
+        if i is None:
+            raise KeyError(value)
+        return self.colors[i]
+
+    def __setitem__(self, value, color):
+        self.overrides[value] = color
+
+    def _extra_keys(self):
+        return [key for key in self.overrides if self._index(key) is None]
+
+    def __iter__(self):
+        yield from self.values.tolist()
+        yield from self._extra_keys()
+
+    def __len__(self):
+        return len(self.values) + len(self._extra_keys())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
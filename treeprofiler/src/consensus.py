@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import numpy as np
+
+# Consensus sequences of internal nodes for --alignment.
+#
+# The alignment is encoded once as a uint8 matrix of residue codes (one row
+# per sequence, gaps share the last code). Every internal node gets a
+# column x alphabet count profile, built bottom-up by adding the profiles of
+# its children, and its consensus is read from the profile with a vectorized
+# argmax and threshold. The result is the same as Bio.Align.AlignInfo's
+# SummaryInfo.dumb_consensus(threshold, '-'), as get_consensus_seq computes
+# it from a FASTA string of the clade.
+
+GAPS = b'-.'
+GAP = ord('-')
+
+class EncodedAlignment:
+    def __init__(self, names, raw):
+        """Encode a uint8 matrix of aligned characters, one row per name."""
+        self.names = list(names)
+        self.name2row = {name: i for i, name in enumerate(self.names)}
+        self.length = raw.shape[1]
+
+        present = np.bincount(np.asarray(raw).ravel(), minlength=256) > 0
+        present[list(GAPS)] = False
+        self.alphabet = np.flatnonzero(present).astype(np.uint8)
+
+        lookup = np.full(256, len(self.alphabet), dtype=np.uint8)
+        lookup[self.alphabet] = np.arange(len(self.alphabet), dtype=np.uint8)
+        self.codes = lookup[raw]
+
+    @classmethod
+    def from_dict(cls, name2seq):
+        """Encode {name: aligned sequence}, empty sequences are left out."""
+        names = [name for name, seq in name2seq.items() if seq]
+        length = max((len(name2seq[name]) for name in names), default=0)
+
+        # shorter sequences are padded with gaps
+        raw = np.full((len(names), length), GAP, dtype=np.uint8)
+        for i, name in enumerate(names):
+            seq = name2seq[name].encode('latin-1')
+            raw[i, :len(seq)] = np.frombuffer(seq, dtype=np.uint8)
+        return cls(names, raw)
+
+    @classmethod
+    def from_store(cls, store):
+        """Encode an AlignmentStore, empty sequences are left out."""
+        rows = [i for i, name in enumerate(store.names) if store.name2length[name]]
+        return cls([store.names[i] for i in rows], store.encode()[rows])
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def gap_code(self):
+        return len(self.alphabet)
+
+    def empty_profile(self):
+        return np.zeros((self.length, len(self.alphabet) + 1), dtype=np.int32)
+
+    def add_to_profile(self, profile, row):
+        profile[np.arange(self.length), self.codes[row]] += 1
+
+    def consensus(self, profile, threshold=0.7):
+        """Consensus of a count profile: the most frequent residue of each column
+        if it is the only one and covers `threshold` of the residues, '-' otherwise."""
+        counts = profile[:, :-1]
+        if counts.shape[1] == 0:
+            return '-' * self.length
+
+        n_residues = counts.sum(axis=1)
+        top = counts.argmax(axis=1)
+        top_count = counts[np.arange(self.length), top]
+        unique = (counts == top_count[:, None]).sum(axis=1) == 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            called = unique & (n_residues > 0) & (top_count / n_residues >= threshold)
+
+        seq = np.where(called, self.alphabet[top], GAP).astype(np.uint8)
+        return seq.tobytes().decode('latin-1')
+
+def clade_consensus(tree_index, alignment, threshold=0.7):
+    """
+    Yield (node, consensus) for every internal node with at least one
+    sequence below it. Profiles are only kept until they are added to
+    their parent, children are always reached before it.
+    """
+    nodes = tree_index.nodes
+    partials = [None] * len(nodes)
+
+    # descendants always have larger preorder ids
+    for i in range(len(nodes) - 1, 0, -1):
+        parent = tree_index.parents[i]
+        if nodes[i].is_leaf:
+            row = alignment.name2row.get(nodes[i].name)
+            if row is None:
+                continue
+            if partials[parent] is None:
+                partials[parent] = alignment.empty_profile()
+            alignment.add_to_profile(partials[parent], row)
+            continue
+
+        profile = partials[i]
+        if profile is None:
+            continue
+        yield nodes[i], alignment.consensus(profile, threshold=threshold)
+        if partials[parent] is None:
+            partials[parent] = profile
+        else:
+            partials[parent] += profile
+        partials[i] = None
+
+    if partials[0] is not None and not nodes[0].is_leaf:
+        yield nodes[0], alignment.consensus(partials[0], threshold=threshold)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import os
+import logging
+
+import numpy as np
+
+from treeprofiler.src.tree_index import TreeIndex
+
+# Dense data matrices of --data-matrix.
+#
+# A matrix file (one leaf per row, no header) is loaded once into a single
+# contiguous float array, with the leaf names mapped to row indices. It can
+# be cached as a .npy sidecar next to the file, which is then memory-mapped
+# instead of parsed again. Clade statistics are computed bottom-up: every
+# internal node combines the (count, sum, mean, m2, min, max) vectors of
+# its children, as summary does for numerical properties, so no clade
+# matrix is ever rebuilt.
+
+logger = logging.getLogger(__name__)
+
+MATRIX_STATS = ['avg', 'max', 'min', 'sum', 'std']
+ROWS_SUFFIX = '.rows.npy'
+
+class DataMatrix:
+    def __init__(self, names, values):
+        self.names = list(names)
+        self.values = values
+        # later rows win, like the dict they replace
+        self.name2row = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def from_dict(cls, leaf2array, dtype=np.float64):
+        """Build from a {leaf: list of values} dict, leaves with None are left out."""
+        names = [name for name, array in leaf2array.items() if array is not None]
+        values = np.array([leaf2array[name] for name in names], dtype=dtype)
+        return cls(names, values.reshape(len(names), -1))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2row
+
+    @property
+    def n_columns(self):
+        return self.values.shape[1]
+
+    def get(self, name, default=None):
+        """Values of the row of `name` as a list."""
+        row = self.name2row.get(name)
+        if row is None:
+            return default
+        return self.values[row].tolist()
+
+    def items(self):
+        for name, row in self.name2row.items():
+            yield name, self.values[row].tolist()
+
+def parse_row(fields, dtype=np.float64):
+    """Values of one matrix row, empty fields are NaN. Raises ValueError on non-numeric data."""
+    try:
+        return np.fromiter(map(float, fields), dtype=dtype, count=len(fields))
+    except ValueError:
+        return np.array([np.nan if x == '' else x for x in fields]).astype(dtype)
+
+def parse_matrix(input_file, delimiter='\t', dtype=np.float64):
+    """Parse a matrix file into a DataMatrix. Non-numeric and misshapen rows are skipped."""
+    prefix = os.path.basename(input_file)
+    names = []
+    rows = []
+    n_columns = None
+    with open(input_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            node, *fields = line.split(delimiter)
+            if not fields:
+                continue
+            try:
+                row = parse_row(fields, dtype=dtype)
+            except ValueError:
+                logger.warning(f"Warning: Non-numeric data found in {prefix} for node {node}. Skipping.")
+                continue
+            if n_columns is None:
+                n_columns = len(row)
+            elif len(row) != n_columns:
+                logger.warning(f"Warning: {len(row)} values instead of {n_columns} in {prefix} for node {node}. Skipping.")
+                continue
+            names.append(node)
+            rows.append(row)
+
+    values = np.empty((len(rows), n_columns or 0), dtype=dtype)
+    for i, row in enumerate(rows):
+        values[i] = row
+    return DataMatrix(names, values)
+
+def sidecar_paths(input_file):
+    return input_file + '.npy', input_file + ROWS_SUFFIX
+
+def load_matrix(input_file, delimiter='\t', dtype=np.float64, cache=False):
+    """
+    Load a matrix file. With `cache`, the matrix is saved as a .npy sidecar
+    on first use and memory-mapped afterwards, as long as the sidecar is
+    newer than the file and of the same dtype.
+    """
+    values_path, rows_path = sidecar_paths(input_file)
+    if cache and os.path.exists(values_path) and os.path.exists(rows_path) \
+            and os.path.getmtime(values_path) >= os.path.getmtime(input_file):
+        values = np.load(values_path, mmap_mode='r')
+        if values.dtype == np.dtype(dtype):
+            return DataMatrix(np.load(rows_path).tolist(), values)
+
+    matrix = parse_matrix(input_file, delimiter=delimiter, dtype=dtype)
+    if cache:
+        np.save(values_path, matrix.values)
+        np.save(rows_path, np.array(matrix.names, dtype=str))
+        matrix.values = np.load(values_path, mmap_mode='r')
+    return matrix
+
+def combine_stats(a, b):
+    """Combine two (count, sum, mean, m2, min, max) tuples of vectors."""
+    n_a, sum_a, mean_a, m2_a, min_a, max_a = a
+    n_b, sum_b, mean_b, m2_b, min_b, max_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta * delta * (n_a * n_b / n)
+    return (n, sum_a + sum_b, mean, m2, np.minimum(min_a, min_b), np.maximum(max_a, max_b))
+
+def leaf_stats(values):
+    values = np.asarray(values, dtype=np.float64)
+    # zero spread, NaN where the value is NaN
+    return (1, values, values, values - values, values, values)
+
+def clade_stats(tree_index, matrix):
+    """
+    Yield (node, stats) for every internal node with data below it, stats
+    being the (count, sum, mean, m2, min, max) vectors of the rows of its
+    leaves. Children are always reached before their parent.
+    """
+    nodes = tree_index.nodes
+    partials = [None] * len(nodes)
+    for i, leaf in zip(np.flatnonzero(tree_index.leaf_index >= 0), tree_index.leaves):
+        row = matrix.name2row.get(leaf.name)
+        if row is not None:
+            partials[i] = leaf_stats(matrix.values[row])
+
+    # descendants always have larger preorder ids
+    for i in range(len(nodes) - 1, 0, -1):
+        partial = partials[i]
+        if partial is None:
+            continue
+        parent = tree_index.parents[i]
+        partials[parent] = partial if partials[parent] is None else combine_stats(partials[parent], partial)
+        if not nodes[i].is_leaf:
+            yield nodes[i], partial
+        # a node is combined into its parent only once
+        partials[i] = None
+
+    if partials[0] is not None and not nodes[0].is_leaf:
+        yield nodes[0], partials[0]
+
+def stats_values(stats, num_stat):
+    """The requested statistics of a clade as {stat: vector}."""
+    count, total, mean, m2, minimum, maximum = stats
+    available_stats = {
+        'avg': lambda: mean,
+        'max': lambda: maximum,
+        'min': lambda: minimum,
+        'sum': lambda: total,
+        'std': lambda: np.sqrt(m2 / count),
+    }
+    if num_stat == 'all':
+        return {stat: available_stats[stat]() for stat in MATRIX_STATS}
+    return {num_stat: available_stats[num_stat]()}
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import itertools
+from collections import defaultdict
+
+import numpy as np
+
+# Domain tables of eggNOG-mapper (hmmer pfam and SMART outputs).
+#
+# Domain coordinates are raw residue positions of each query. They are
+# translated to alignment columns with the residue columns of each query
+# (see AlignmentStore.residue_columns), computed once per batch and only for
+# the queries of the table, instead of a raw-to-alignment dict over every
+# residue of the alignment. The table is read in batches of rows.
+
+BATCH_SIZE = 100000 # rows
+
+PFAM_COLUMNS = (0, 1, 7, 8) # query, domain, start, end
+SMART_COLUMNS = (0, 1, 2, 3)
+
+def iter_batches(domain_table, columns, batch_size=BATCH_SIZE):
+    """Yield (queries, domains, starts, ends) of batches of the rows of a domain table."""
+    query_col, dom_col, start_col, end_col = columns
+    with open(domain_table) as f_in:
+        rows = (line.strip().split('\t') for line in f_in if line.strip() and not line.startswith('#'))
+        while batch := list(itertools.islice(rows, batch_size)):
+            yield ([info[query_col] for info in batch],
+                [info[dom_col] for info in batch],
+                np.array([int(info[start_col]) for info in batch], dtype=np.int64),
+                np.array([int(info[end_col]) for info in batch], dtype=np.int64))
+
+def translate_domains(domain_table, alignment, columns, batch_size=BATCH_SIZE):
+    """
+    Yield (query, domain, alignment start, alignment end) for the rows of
+    `domain_table` whose query is in `alignment`, in the order of the table.
+    Raises KeyError(query, start, end) on a position outside of the query.
+    """
+    for queries, domains, starts, ends in iter_batches(domain_table, columns, batch_size=batch_size):
+        query2rows = defaultdict(list)
+        for i, query in enumerate(queries):
+            query2rows[query].append(i)
+
+        translated = [None] * len(queries)
+        for query, rows in query2rows.items():
+            if query not in alignment:
+                continue
+            residue_columns = alignment.residue_columns(query)
+            if not len(residue_columns):
+                continue
+            rows = np.array(rows)
+            query_starts, query_ends = starts[rows], ends[rows]
+            outside = (np.minimum(query_starts, query_ends) < 1) | (np.maximum(query_starts, query_ends) > len(residue_columns))
+            if outside.any():
+                first = np.flatnonzero(outside)[0]
+                raise KeyError(query, int(query_starts[first]), int(query_ends[first]))
+            for row, start, end in zip(rows, residue_columns[query_starts - 1], residue_columns[query_ends - 1]):
+                translated[row] = (int(start), int(end))
+
+        for query, domain, positions in zip(queries, domains, translated):
+            if positions is not None:
+                yield query, domain, positions[0], positions[1]
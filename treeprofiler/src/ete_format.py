@@ -1,10 +1,14 @@
 
 import sys
+import os
 import io
 import json
+import mmap
 import pickle
+import struct
 import base64
 import gzip
+import numpy as np
 from ete4 import Tree
 
 def pickle_pack(data):
@@ -75,4 +79,209 @@ def loads(INPUT, encoder='pickle', unpack=False):
                 node.up = id2node[b]
             else: 
                 root = node
-    return root
\ No newline at end of file
+    return root
+
+# Binary columnar format (version 2).
+#
+# Layout: MAGIC, a little-endian uint32 version and uint64 header length,
+# a JSON header, then 8-byte aligned data blocks. The topology is stored as
+# the parent index of every node in preorder (-1 for the root), and every
+# property is a column holding the ids of the nodes that have it plus their
+# values: float64, int64 or bool arrays, dictionary-encoded strings and lists
+# of strings, or pickled values for anything else. The file is memory-mapped
+# on load and only the requested columns are decoded.
+
+MAGIC = b'ETE4COLS'
+VERSION = 2
+BASE_PROPS = ('name', 'dist', 'support')
+
+def _column_kind(values):
+    types = set(type(value) for value in values)
+    if len(types) == 1:
+        value_type = types.pop()
+        if value_type is bool:
+            return 'bool'
+        if value_type is int and all(-2**63 <= value < 2**63 for value in values):
+            return 'int'
+        if value_type is float:
+            return 'float'
+        if value_type is str:
+            return 'str'
+        if value_type is list and all(type(item) is str for value in values for item in value):
+            return 'strlist'
+    return 'pickle'
+
+def _encode_strings(strings):
+    """Concatenated utf-8 bytes of `strings` and their offsets."""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in encoded])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+def _decode_blobs(offsets, blob):
+    blob = blob.tobytes()
+    offsets = offsets.tolist()
+    return [blob[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+def _encode_column(values):
+    """Kind and data arrays of a column with the given values."""
+    kind = _column_kind(values)
+    if kind == 'float':
+        return kind, {'values': np.array(values, dtype=np.float64)}
+    if kind == 'int':
+        return kind, {'values': np.array(values, dtype=np.int64)}
+    if kind == 'bool':
+        return kind, {'values': np.array(values, dtype=np.uint8)}
+    if kind == 'str':
+        vocabulary = {}
+        codes = np.array([vocabulary.setdefault(value, len(vocabulary)) for value in values], dtype=np.int32)
+        offsets, blob = _encode_strings(list(vocabulary))
+        return kind, {'codes': codes, 'offsets': offsets, 'blob': blob}
+    if kind == 'strlist':
+        vocabulary = {}
+        codes = np.array([vocabulary.setdefault(item, len(vocabulary)) for value in values for item in value], dtype=np.int32)
+        lengths = np.zeros(len(values) + 1, dtype=np.int64)
+        lengths[1:] = np.cumsum([len(value) for value in values])
+        offsets, blob = _encode_strings(list(vocabulary))
+        return kind, {'codes': codes, 'lengths': lengths, 'offsets': offsets, 'blob': blob}
+    pickled = [pickle.dumps(value) for value in values]
+    offsets = np.zeros(len(pickled) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in pickled])
+    return kind, {'offsets': offsets, 'blob': np.frombuffer(b''.join(pickled), dtype=np.uint8)}
+
+def _decode_column(kind, arrays):
+    """List of values of a column."""
+    if kind == 'float':
+        return arrays['values'].tolist()
+    if kind == 'int':
+        return arrays['values'].tolist()
+    if kind == 'bool':
+        return arrays['values'].astype(bool).tolist()
+    if kind == 'str':
+        vocabulary = [item.decode('utf-8') for item in _decode_blobs(arrays['offsets'], arrays['blob'])]
+        return [vocabulary[code] for code in arrays['codes'].tolist()]
+    if kind == 'strlist':
+        vocabulary = [item.decode('utf-8') for item in _decode_blobs(arrays['offsets'], arrays['blob'])]
+        items = [vocabulary[code] for code in arrays['codes'].tolist()]
+        lengths = arrays['lengths'].tolist()
+        return [items[start:end] for start, end in zip(lengths[:-1], lengths[1:])]
+    return [pickle.loads(item) for item in _decode_blobs(arrays['offsets'], arrays['blob'])]
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+def dumpb(t):
+    """Serialize tree `t` and all its node properties in the binary columnar format."""
+    nodes = list(t.traverse("preorder"))
+    node2id = {node: i for i, node in enumerate(nodes)}
+    parents = np.array([node2id[n.up] if n is not t and n.up is not None else -1 for n in nodes], dtype=np.int32)
+
+    prop2ids = {}
+    prop2values = {}
+    for i, node in enumerate(nodes):
+        for prop, value in node.props.items():
+            if prop not in prop2ids:
+                prop2ids[prop] = []
+                prop2values[prop] = []
+            prop2ids[prop].append(i)
+            prop2values[prop].append(value)
+
+    blocks = []
+    offset = 0
+    def add_block(array):
+        nonlocal offset
+        array = np.ascontiguousarray(array)
+        offset = _align(offset)
+        block = {'dtype': array.dtype.str, 'count': int(array.size), 'offset': offset}
+        blocks.append((offset, array))
+        offset += array.nbytes
+        return block
+
+    header = {'version': VERSION, 'n_nodes': len(nodes), 'parents': add_block(parents), 'columns': []}
+    for prop, ids in prop2ids.items():
+        kind, arrays = _encode_column(prop2values[prop])
+        column = {'name': prop, 'kind': kind, 'nodes': add_block(np.array(ids, dtype=np.int32))}
+        column['arrays'] = {key: add_block(array) for key, array in arrays.items()}
+        header['columns'].append(column)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    preamble = MAGIC + struct.pack('<IQ', VERSION, len(header_bytes)) + header_bytes
+    data_start = _align(len(preamble))
+
+    out = bytearray(data_start + offset)
+    out[:len(preamble)] = preamble
+    for start, array in blocks:
+        out[data_start + start:data_start + start + array.nbytes] = array.tobytes()
+    return bytes(out)
+
+def dump(t, path):
+    """Write tree `t` to `path` in the binary columnar format."""
+    with open(path, 'wb') as f:
+        f.write(dumpb(t))
+
+def is_columnar(path):
+    """Whether the file at `path` is in the binary columnar format."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (OSError, TypeError):
+        return False
+
+def _read_header(buffer):
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a binary ete file")
+    version, header_length = struct.unpack_from('<IQ', buffer, len(MAGIC))
+    if version != VERSION:
+        raise ValueError(f"Unsupported binary ete version {version}")
+    header_start = len(MAGIC) + struct.calcsize('<IQ')
+    header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode('utf-8'))
+    return header, _align(header_start + header_length)
+
+def _selected(prop, props):
+    """Whether the column `prop` is requested, also matching its suffixed variants such as `prop_counter`."""
+    return props is None or prop in BASE_PROPS or any(prop == p or prop.startswith(p + '_') for p in props)
+
+def _load_buffer(buffer, props=None):
+    header, data_start = _read_header(buffer)
+
+    def array(block):
+        return np.frombuffer(buffer, dtype=block['dtype'], count=block['count'],
+                             offset=data_start + block['offset'])
+
+    nodes = [Tree() for _ in range(header['n_nodes'])]
+    for i, parent in enumerate(array(header['parents']).tolist()):
+        if parent >= 0:
+            nodes[parent].add_child(nodes[i])
+
+    for column in header['columns']:
+        if not _selected(column['name'], props):
+            continue
+        arrays = {key: array(block) for key, block in column['arrays'].items()}
+        values = _decode_column(column['kind'], arrays)
+        prop = column['name']
+        for i, value in zip(array(column['nodes']).tolist(), values):
+            nodes[i].props[prop] = value
+    return nodes[0] if nodes else None
+
+def loadb(data, props=None):
+    """
+    Load a tree from bytes in the binary columnar format. If `props` is
+    given, only those properties (and their suffixed variants, plus name,
+    dist and support) are decoded.
+    """
+    return _load_buffer(memoryview(data), props=props)
+
+def load(path, props=None):
+    """Memory-map and load a tree in the binary columnar format, see loadb."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("Empty binary ete file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return _load_buffer(buffer, props=props)
+
+def column_kinds(path):
+    """Kind of every property column stored in a binary ete file, without decoding them."""
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            header, _ = _read_header(buffer)
+    return {column['name']: column['kind'] for column in header['columns']}
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+import itertools
+import math
+from collections import Counter
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+from treeprofiler.src import summary
+from treeprofiler.src.tree_index import TreeIndex
+from treeprofiler.src.utils import children_prop_array, children_prop_array_missing
+
+# Columnar leaf table shared by parallel annotation workers.
+#
+# Nodes are numbered in preorder (see tree_index), so every clade is a contiguous range of
+# node ids and of leaf ids. Leaf metadata is packed once into typed columns
+# (int32 codes for categorical values, float64 for numerical values and
+# offsets + codes for multi-valued text) inside a single shared memory block.
+# Workers attach to the block and only receive (node_start, node_end) ranges,
+# so no ete4 node is ever pickled.
+
+MISSING_CODE = -1
+
+class LeafTable:
+    def __init__(self, arrays, vocabularies, text_prop=[], multiple_text_prop=[], bool_prop=[], num_prop=[]):
+        self.arrays = arrays
+        self.vocabularies = vocabularies
+        self.text_prop = list(text_prop)
+        self.multiple_text_prop = list(multiple_text_prop)
+        self.bool_prop = list(bool_prop)
+        self.num_prop = list(num_prop)
+        self.parents = arrays['parents']
+        self.leaf_index = arrays['leaf_index']
+        self.node_end = arrays['node_end']
+
+    @classmethod
+    def from_tree(cls, tree, text_prop=[], multiple_text_prop=[], bool_prop=[], num_prop=[]):
+        """Number the nodes of `tree` in preorder and encode leaf properties as columns."""
+        index = TreeIndex(tree)
+        nodes = index.nodes
+        leaves = index.leaves
+
+        arrays = {'parents': index.parents, 'leaf_index': index.leaf_index, 'node_end': index.node_end}
+        vocabularies = {}
+
+        for prop in itertools.chain(text_prop, bool_prop):
+            values = [children_prop_array_missing([leaf], prop)[0] for leaf in leaves]
+            arrays[('codes', prop)], vocabularies[prop] = encode_values(values)
+
+        for prop in multiple_text_prop:
+            items = [list(itertools.chain.from_iterable(children_prop_array([leaf], prop))) for leaf in leaves]
+            offsets = np.zeros(len(items) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(item) for item in items])
+            codes, vocabularies[prop] = encode_values(list(itertools.chain.from_iterable(items)), missing_values=())
+            arrays[('offsets', prop)] = offsets
+            arrays[('codes', prop)] = codes
+
+        for prop in num_prop:
+            column = np.full(len(leaves), np.nan, dtype=np.float64)
+            for i, leaf in enumerate(leaves):
+                values = children_prop_array([leaf], prop)
+                if values:
+                    column[i] = float(values[0])
+            arrays[('values', prop)] = column
+
+        return cls(arrays, vocabularies, text_prop, multiple_text_prop, bool_prop, num_prop), nodes
+
+    def leaf_partial(self, leaf):
+        """Partial aggregate of leaf id `leaf`, in the format of summary.leaf_partial."""
+        text_counters = {prop: self._code_counter(prop, leaf) for prop in self.text_prop}
+        bool_counters = {prop: self._code_counter(prop, leaf) for prop in self.bool_prop}
+        multitext_counters = {}
+        for prop in self.multiple_text_prop:
+            offsets = self.arrays[('offsets', prop)]
+            codes = self.arrays[('codes', prop)][offsets[leaf]:offsets[leaf + 1]]
+            vocabulary = self.vocabularies[prop]
+            multitext_counters[prop] = Counter(vocabulary[code] for code in codes.tolist())
+        num_stats = {}
+        for prop in self.num_prop:
+            value = float(self.arrays[('values', prop)][leaf])
+            num_stats[prop] = None if math.isnan(value) else (1, value, value, 0.0, value, value)
+        return text_counters, multitext_counters, bool_counters, num_stats
+
+    def _code_counter(self, prop, leaf):
+        code = int(self.arrays[('codes', prop)][leaf])
+        if code == MISSING_CODE:
+            return Counter()
+        return Counter({self.vocabularies[prop][code]: 1})
+
+    # shared memory
+    def to_shared_memory(self):
+        """Copy all columns into one shared memory block. Returns (shm, layout)."""
+        layout = {}
+        offset = 0
+        for key, array in self.arrays.items():
+            offset = _align(offset, array.dtype.itemsize)
+            layout[key] = (array.dtype.str, array.shape, offset)
+            offset += array.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for key, array in self.arrays.items():
+            dtype, shape, start = layout[key]
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = array
+        return shm, layout
+
+    @classmethod
+    def from_shared_memory(cls, shm, layout, vocabularies, text_prop=[], multiple_text_prop=[], bool_prop=[], num_prop=[]):
+        arrays = {key: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+                  for key, (dtype, shape, start) in layout.items()}
+        return cls(arrays, vocabularies, text_prop, multiple_text_prop, bool_prop, num_prop)
+
+def _align(offset, itemsize):
+    return (offset + itemsize - 1) // itemsize * itemsize
+
+def encode_values(values, missing_values=(None, 'NaN')):
+    """Dictionary-encode values as int32 codes, missing values become MISSING_CODE."""
+    vocabulary = []
+    value2code = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        if value in missing_values:
+            codes[i] = MISSING_CODE
+            continue
+        code = value2code.get(value)
+        if code is None:
+            code = value2code[value] = len(vocabulary)
+            vocabulary.append(value)
+        codes[i] = code
+    return codes, vocabulary
+
+def summarize_range(table, node_ids, format_kwargs, partials=None):
+    """
+    Combine partial aggregates bottom-up over `node_ids`, given in decreasing
+    preorder so children are always visited before their parent.
+
+    `partials` may hold precomputed aggregates of whole clades; a node found
+    there is taken as is. Returns ({node_id: internal_props}, {node_id: partial})
+    where the second dict holds the aggregates of nodes whose parent was not
+    visited.
+    """
+    pending = dict(partials or {})
+    visited = set(node_ids)
+    results = {}
+    roots = {}
+    for i in node_ids:
+        leaf = table.leaf_index[i]
+        if i in pending:
+            partial = pending.pop(i)
+            if leaf < 0 and i not in (partials or {}):
+                results[i] = summary.summarize_props(partial, **format_kwargs)
+        else:
+            partial = table.leaf_partial(leaf)
+
+        parent = int(table.parents[i])
+        if parent < 0 or parent not in visited:
+            roots[i] = partial
+        elif parent in pending:
+            pending[parent] = summary.combine_partials([pending[parent], partial])
+        else:
+            pending[parent] = partial
+    return results, roots
+
+def split_clades(table, max_leaves):
+    """
+    Split the tree into disjoint clades of at most `max_leaves` leaves.
+    Returns the (node_start, node_end) ranges of the clades and the node ids
+    that are not covered by any of them, in preorder.
+    """
+    leaf_cumsum = np.concatenate(([0], np.cumsum(table.leaf_index >= 0)))
+    clades = []
+    top = []
+    i = 0
+    n_nodes = len(table.parents)
+    while i < n_nodes:
+        end = int(table.node_end[i])
+        if leaf_cumsum[end] - leaf_cumsum[i] <= max_leaves:
+            clades.append((i, end))
+            i = end
+        else:
+            top.append(i)
+            i += 1
+    return clades, top
+
+# worker side
+_worker = {}
+
+def _init_worker(shm_name, layout, vocabularies, prop_lists, format_kwargs):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker['shm'] = shm
+    _worker['table'] = LeafTable.from_shared_memory(shm, layout, vocabularies, **prop_lists)
+    _worker['format_kwargs'] = format_kwargs
+
+def _summarize_clade(node_range):
+    node_start, node_end = node_range
+    table = _worker['table']
+    node_ids = range(node_end - 1, node_start - 1, -1)
+    return summarize_range(table, node_ids, _worker['format_kwargs'])
+
+def parallel_merge_annotations(tree, text_prop=[], multiple_text_prop=[], bool_prop=[], num_prop=[],
+        column2method={}, acr_discrete_columns=None, emapper_mode=False, threads=2, chunks_per_thread=4,
+        min_leaves_per_thread=5000):
+    """
+    Parallel version of summary.merge_annotations.
+
+    Leaf properties are encoded once into a shared memory LeafTable, the tree
+    is split into clades that are summarized by the workers, and the nodes
+    above those clades are combined in the main process. Trees with less than
+    `min_leaves_per_thread` leaves per thread are summarized sequentially.
+
+    Yields (node, internal_props) for every internal node.
+    """
+    num_prop = [prop for prop in num_prop if prop not in ('dist', 'support')]
+    prop_lists = dict(text_prop=text_prop, multiple_text_prop=multiple_text_prop,
+        bool_prop=bool_prop, num_prop=num_prop)
+    format_kwargs = dict(prop_lists, column2method=column2method,
+        acr_discrete_columns=set(acr_discrete_columns or []), emapper_mode=emapper_mode)
+
+    n_leaves = sum(1 for _ in tree.leaves())
+    if n_leaves < threads * min_leaves_per_thread:
+        yield from summary.merge_annotations(tree, **format_kwargs)
+        return
+
+    table, nodes = LeafTable.from_tree(tree, **prop_lists)
+    max_leaves = max(1, math.ceil(n_leaves / (threads * chunks_per_thread)))
+    clades, top = split_clades(table, max_leaves)
+
+    shm, layout = table.to_shared_memory()
+    try:
+        with Pool(threads, initializer=_init_worker,
+                  initargs=(shm.name, layout, table.vocabularies, prop_lists, format_kwargs)) as pool:
+            clade_partials = {}
+            for results, roots in pool.imap_unordered(_summarize_clade, clades):
+                for node_id, internal_props in results.items():
+                    yield nodes[node_id], internal_props
+                clade_partials.update(roots)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # nodes above the clades, combined from the clade aggregates
+    node_ids = sorted(itertools.chain(top, clade_partials), reverse=True)
+    results, _ = summarize_range(table, node_ids, format_kwargs, partials=clade_partials)
+    for node_id, internal_props in results.items():
+        yield nodes[node_id], internal_props
@@ -4,7 +4,10 @@ try:
 except ImportError:
     from treeprofiler.src.utils import strtobool
     
+import numpy as np
+
 from treeprofiler.src.utils import add_suffix
+from treeprofiler.src.tree_index import TreeIndex
 
 # Lineage specificity analysis
 # Function to calculate precision, sensitivity, and F1 score
@@ -38,35 +41,83 @@ def bool_checker(node, prop):
             return False
     return False
 
+def trait_matrix(tree_index, props):
+    """
+    Boolean (n_leaves, n_props) matrix of `props` for the leaves of
+    `tree_index`, with the same interpretation as bool_checker. Each distinct
+    value is parsed only once.
+    """
+    value2bool = {}
+    def to_bool(value):
+        if value is None:
+            return False
+        value = str(value)
+        result = value2bool.get(value)
+        if result is None:
+            try:
+                result = bool(strtobool(value))
+            except ValueError:
+                result = False
+            value2bool[value] = result
+        return result
+
+    matrix = np.zeros((tree_index.n_leaves, len(props)), dtype=bool)
+    for j, prop in enumerate(props):
+        matrix[:, j] = [to_bool(leaf.props.get(prop)) for leaf in tree_index.leaves]
+    return matrix
+
+def ls_metrics(tree_index, matrix):
+    """
+    Precision, sensitivity and F1 score of every (node, prop) pair as
+    (n_nodes, n_props) arrays indexed by node id, for the boolean leaf
+    `matrix` built by trait_matrix. Undefined ratios are 0.
+    """
+    clade_with_trait = tree_index.clade_counts(matrix).astype(np.float64)
+    clade_total = (tree_index.leaf_end - tree_index.leaf_start).astype(np.float64)[:, None]
+    total_with_trait = matrix.sum(axis=0).astype(np.float64)[None, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(clade_total > 0, clade_with_trait / clade_total, 0.0)
+        sensitivity = np.where(total_with_trait > 0, clade_with_trait / total_with_trait, 0.0)
+        denominator = precision + sensitivity
+        f1 = np.where(denominator > 0, 2 * (precision * sensitivity) / denominator, 0.0)
+    return precision, sensitivity, f1
+
 ###### start lineage specificity analysis ######
 def run_ls(tree, props, precision_cutoff=0.95, sensitivity_cutoff=0.95):
     best_node = None
     qualified_nodes = []
     best_f1 = -1
-    for prop in props:
-        total_with_trait = get_total_trait(tree, prop)
-        # Calculating metrics for each clade
-        for node in tree.traverse("postorder"):
-            if not node.is_leaf:
-                #node.add_prop(trait=int(node.name[-1]) if node.is_leaf else 0)
-                precision, sensitivity, f1 = calculate_metrics(node, total_with_trait, prop)
-                node.add_prop(add_suffix(prop, "prec"), precision)
-                node.add_prop(add_suffix(prop, "sens"), sensitivity)
-                node.add_prop(add_suffix(prop, "f1"), f1)
-                #node.add_prop(precision=precision, sensitivity=sensitivity, f1_score=f1)
-                #print(f"Node: {node.name} , Precision: {precision}, Sensitivity: {sensitivity}, F1 Score: {f1}")
+    if not props:
+        return best_node, qualified_nodes
+
+    tree_index = TreeIndex(tree)
+    matrix = trait_matrix(tree_index, props)
+    precision, sensitivity, f1 = ls_metrics(tree_index, matrix)
+    has_trait = matrix.any(axis=0)
+    qualified = (precision >= precision_cutoff) & (sensitivity >= sensitivity_cutoff)
+
+    internal_ids = [tree_index.node_id(node) for node in tree.traverse("postorder") if not node.is_leaf]
+    root_id = tree_index.node_id(tree)
+    for j, prop in enumerate(props):
+        prop_precision = precision[internal_ids, j].tolist()
+        prop_sensitivity = sensitivity[internal_ids, j].tolist()
+        prop_f1 = f1[internal_ids, j].tolist()
+        prop_qualified = qualified[internal_ids, j].tolist()
+        for k, i in enumerate(internal_ids):
+            node = tree_index.nodes[i]
+            node.add_prop(add_suffix(prop, "prec"), prop_precision[k])
+            # undefined ratios are kept as integer 0, as in calculate_metrics
+            node.add_prop(add_suffix(prop, "sens"), prop_sensitivity[k] if has_trait[j] else 0)
+            node.add_prop(add_suffix(prop, "f1"), prop_f1[k] if prop_precision[k] + prop_sensitivity[k] else 0)
 
-                # Check if the node meets the lineage-specific criteria
-                if not node.is_root:
-                    if precision >= precision_cutoff and sensitivity >= sensitivity_cutoff:
-                        node.add_prop(add_suffix(prop, "ls_clade"), True)
-                        qualified_nodes.append(node)
-                        if f1 > best_f1:
-                            best_f1 = f1
-                            best_node = node
-        # if best_node:
-        #     print(f"Root of Lineage-Specific Clade of {prop} Trait with f1 score {best_node.props.get(add_suffix(prop, 'f1'))}")
-        #     best_node.add_prop(add_suffix(prop, "ls_clade"), True)
+            # Check if the node meets the lineage-specific criteria
+            if i != root_id and prop_qualified[k]:
+                node.add_prop(add_suffix(prop, "ls_clade"), True)
+                qualified_nodes.append(node)
+                if prop_f1[k] > best_f1:
+                    best_f1 = prop_f1[k]
+                    best_node = node
 
     return best_node, qualified_nodes
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import csv
+import io
+import tarfile
+from collections.abc import MutableMapping
+
+# Streaming reader of metadata tables.
+#
+# Tables are read in fixed-size chunks and cut into lines. When the caller
+# only wants some nodes, a line is dropped by looking at its first field
+# before the rest of it is split. Column types are inferred from the values
+# as they go by (see type_inference), so no column is ever kept in full:
+# only the rows of the wanted nodes end up in memory.
+#
+# Lines are the unit of the reader, so quoted fields spanning several lines
+# are not supported.
+
+CHUNK_SIZE = 1 << 22 # characters
+COMMENT_PREFIX = '##'
+
+def iter_lines(stream, chunk_size=CHUNK_SIZE):
+    """Yield the lines of a text `stream`, without newline, reading `chunk_size` characters at a time."""
+    tail = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+def iter_batches(stream, delimiter='\t', target_nodes=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield the first line of the table, then lists of kept lines, one list per
+    chunk. Empty and commented lines are skipped, and so are the lines whose
+    first field is not in `target_nodes` (when given).
+    """
+    lines = iter_lines(stream, chunk_size)
+    for line in lines:
+        if line and not line.startswith(COMMENT_PREFIX):
+            yield line
+            break
+    else:
+        return
+
+    batch = []
+    size = 0
+    for line in lines:
+        if not line or line.startswith(COMMENT_PREFIX):
+            continue
+        # quoted names need the csv parser, keep them
+        if target_nodes and not line.startswith('"'):
+            end = line.find(delimiter)
+            if (line if end < 0 else line[:end]) not in target_nodes:
+                continue
+        batch.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+def open_tables(input_file):
+    """Yield a text stream for every table of `input_file`, a plain file or the .tsv members of a tar.gz."""
+    if tarfile.is_tarfile(input_file):
+        with tarfile.open(input_file, 'r:*') as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith('.tsv'):
+                    with io.TextIOWrapper(tar.extractfile(member), encoding='utf-8') as stream:
+                        yield stream
+    else:
+        with open(input_file, 'r') as stream:
+            yield stream
+
+def iter_rows(stream, delimiter='\t', no_headers=False, target_nodes=None, chunk_size=CHUNK_SIZE):
+    """
+    Parse a table from a text `stream`. Returns (headers, rows) where rows is
+    an iterator over batches of field lists of the kept lines.
+    """
+    batches = iter_batches(stream, delimiter=delimiter, target_nodes=target_nodes, chunk_size=chunk_size)
+    first_line = next(batches, None)
+    if first_line is None:
+        return [], iter(())
+
+    first_row = next(csv.reader([first_line], delimiter=delimiter))
+    if no_headers:
+        headers = [f'col{i}' for i in range(len(first_row))]
+        name = first_row[0] if first_row else ''
+        first = [[first_row]] if not target_nodes or name in target_nodes else []
+    else:
+        headers = first_row
+        first = []
+
+    def rows():
+        yield from first
+        for batch in batches:
+            yield list(csv.reader(batch, delimiter=delimiter))
+
+    return headers, rows()
+
+class MetadataColumns(MutableMapping):
+    """
+    Values of every property in `metadata` ({node: {prop: value}}), as
+    {prop: [value, ...]}. A column is only gathered from the rows when it is
+    looked up; assigned columns are kept as they are.
+    """
+    def __init__(self, metadata, props=()):
+        self.metadata = metadata
+        self.props = dict.fromkeys(props)
+        self.assigned = {}
+
+    def __getitem__(self, prop):
+        if prop in self.assigned:
+            return self.assigned[prop]
+        if prop not in self.props:
+            raise KeyError(prop)
+        return [row[prop] for row in self.metadata.values() if prop in row]
+
+    def __setitem__(self, prop, values):
+        self.props[prop] = None
+        self.assigned[prop] = values
+
+    def __delitem__(self, prop):
+        del self.props[prop]
+        self.assigned.pop(prop, None)
+
+    def __iter__(self):
+        return iter(self.props)
+
+    def __len__(self):
+        return len(self.props)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.stats import beta
+
+from treeprofiler.src import utils
+from treeprofiler.src.tree_index import LCAIndex
+from treeprofiler.src.phylosignal import run_acr_discrete, run_delta, DELTA_CHAINS
+
+# Permutation engine for delta statistic p-values.
+#
+# Every worker keeps one prepared copy of the tree, with the nodes of every
+# annotated identifier resolved once. An iteration only shuffles the state
+# vectors of the discrete columns with its own seed, writes them on those
+# nodes, reruns ACR + delta and clears the extra features written by pastml.
+# Deltas are streamed back as they complete, and the permutations can stop
+# early once every p-value is known to be on one side of the significance
+# level.
+
+PERMUTATION_SEED = 42
+COMMON_ANCESTOR_SEPARATOR = '||'
+
+def permutation_rng(seed, iteration):
+    """Random generator of permutation `iteration`, independent of the order the iterations run."""
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(iteration,)))
+
+def shuffle_states(column2states, seed, iteration):
+    """Shuffled state vector of every column for permutation `iteration`."""
+    rng = permutation_rng(seed, iteration)
+    return {column: [states[i] for i in rng.permutation(len(states))]
+            for column, states in column2states.items()}
+
+def resolve_targets(tree, identifiers):
+    """Nodes annotated by every identifier, as load_metadata_to_tree does."""
+    name2node = {}
+    for node in tree.traverse():
+        if node.name:
+            name2node.setdefault(node.name, []).append(node)
+
+    targets = []
+    lca_index = None
+    for identifier in identifiers:
+        if identifier in name2node:
+            targets.append(name2node[identifier])
+        elif COMMON_ANCESTOR_SEPARATOR in identifier:
+            if lca_index is None:
+                lca_index = LCAIndex(tree)
+            targets.append([lca_index.common_ancestor(identifier.split(COMMON_ANCESTOR_SEPARATOR))])
+        else:
+            targets.append([])
+    return targets
+
+def pvalue_interval(exceed, total, confidence=0.99):
+    """Clopper-Pearson interval of a p-value estimated as exceed / total."""
+    tail = (1 - confidence) / 2
+    lower = beta.ppf(tail, exceed, total - exceed + 1) if exceed > 0 else 0.0
+    upper = beta.ppf(1 - tail, exceed + 1, total - exceed) if exceed < total else 1.0
+    return lower, upper
+
+def pvalue_decided(exceed, total, alpha=0.05, confidence=0.99):
+    """Whether the p-value interval lies entirely below or above `alpha`."""
+    lower, upper = pvalue_interval(exceed, total, confidence)
+    return upper < alpha or lower > alpha
+
+class PermutationWorker:
+    def __init__(self, tree, column2identifiers, column2states, prediction_method="MPPA", model="F81",
+            ent_type='SE', lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1,
+            chains=DELTA_CHAINS, seed=PERMUTATION_SEED):
+        self.tree = tree
+        self.column2states = column2states
+        self.column2targets = {column: resolve_targets(tree, identifiers)
+                               for column, identifiers in column2identifiers.items()}
+        self.acr_options = dict(prediction_method=prediction_method, model=model, threads=threads)
+        self.delta_options = dict(ent_type=ent_type, lambda0=lambda0, se=se, sim=sim,
+                                  burn=burn, thin=thin, threads=threads, chains=chains)
+        self.seed = seed
+
+    def run(self, iteration):
+        """Delta of every column after shuffling its states. Returns (iteration, {prop: delta})."""
+        shuffled = shuffle_states(self.column2states, self.seed, iteration)
+        for column, states in shuffled.items():
+            for nodes, state in zip(self.column2targets[column], states):
+                for node in nodes:
+                    node.add_prop(column, state)
+
+        random_acr_results, tree = run_acr_discrete(self.tree, shuffled, outdir=None, **self.acr_options)
+        random_delta = run_delta(random_acr_results, tree, **self.delta_options)
+
+        # only keep the prepared tree for the next iteration
+        utils.clear_extra_features([self.tree], ["name", "dist", "support"])
+        return iteration, random_delta
+
+# worker side
+_worker = {}
+
+def _init_worker(tree, column2identifiers, column2states, options):
+    _worker['permutation'] = PermutationWorker(tree, column2identifiers, column2states, **options)
+
+def _run_permutation(iteration):
+    return _worker['permutation'].run(iteration)
+
+def iter_permutation_deltas(tree, column2identifiers, column2states, iterations=100, threads=1, **options):
+    """
+    Yield (iteration, {prop: delta}) for every permutation as it completes.
+    Iterations may complete out of order when `threads` > 1. `tree` is not
+    modified.
+    """
+    options = dict(options, threads=threads)
+    if threads > 1:
+        with Pool(threads, initializer=_init_worker,
+                  initargs=(tree, column2identifiers, column2states, options)) as pool:
+            yield from pool.imap_unordered(_run_permutation, range(iterations))
+    else:
+        worker = PermutationWorker(tree.copy(), column2identifiers, column2states, **options)
+        for iteration in range(iterations):
+            yield worker.run(iteration)
+
+def permutation_deltas(tree, column2identifiers, column2states, observed_deltas=None, iterations=100,
+        threads=1, alpha=0.05, confidence=0.99, min_iterations=20, **options):
+    """
+    Deltas of up to `iterations` permutations, as {prop: [delta, ...]} in
+    iteration order.
+
+    When `observed_deltas` are given, the permutations stop as soon as the
+    p-value of every prop (the fraction of permuted deltas above the observed
+    one) is decided against `alpha` with the given `confidence`, after at
+    least `min_iterations` iterations. The decision is made on the first
+    iterations in order, so the result does not depend on `threads`.
+    """
+    completed = {}
+    prop2delta_array = {}
+    prop2exceed = {}
+    next_iteration = 0
+    deltas = iter_permutation_deltas(tree, column2identifiers, column2states,
+        iterations=iterations, threads=threads, **options)
+    try:
+        for iteration, delta_result in deltas:
+            completed[iteration] = delta_result
+            # consume the completed iterations in order
+            while next_iteration in completed:
+                for prop, result in completed.pop(next_iteration).items():
+                    prop2delta_array.setdefault(prop, []).append(result)
+                    if observed_deltas is not None:
+                        prop2exceed[prop] = prop2exceed.get(prop, 0) + (result > observed_deltas[prop])
+                next_iteration += 1
+
+            if observed_deltas is not None and next_iteration >= min_iterations and prop2exceed and all(
+                    pvalue_decided(exceed, next_iteration, alpha, confidence) for exceed in prop2exceed.values()):
+                break
+    finally:
+        # stops the pending permutations
+        deltas.close()
+
+    return prop2delta_array
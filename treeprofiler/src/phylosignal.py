@@ -3,6 +3,7 @@ import os, math, re
 from multiprocessing.pool import ThreadPool
 import numpy as np
 from scipy.stats import entropy
+from scipy.special import gammaln
 import math
 #from numba import njit, float64, int64
 
@@ -14,7 +15,7 @@ from pastml import col_name2cat
 from collections import defaultdict, Counter
 
 from treeprofiler.src.utils import add_suffix
-from treeprofiler.src.acr_continuous import ml_acr, by_acr
+from treeprofiler.src.acr_continuous import ml_acr, by_acr, pruning_acr
 
 ''' ADDITIONAL INFORMATION
 
@@ -120,6 +121,86 @@ def emcmc(params):
             
     return np.asarray(gibbs)
 
+# Vectorized Metropolis-Hastings over many independent chains
+DELTA_CHAINS = 100
+
+def delta_sample_count(sim, thin, burn):
+    """Number of samples kept by one emcmc chain."""
+    n_size = np.linspace(burn, sim, int((sim - burn) / thin + 1))
+    return len(np.unique(np.round(n_size, 0).astype(int)))
+
+def emcmc_chains(x, l0, se, sim, thin, burn, chains=DELTA_CHAINS, seed=None):
+    """
+    Metropolis-Hastings algorithm for alpha and beta parameters, advancing
+    all chains at once as NumPy arrays.
+
+    The sufficient statistics sum(log(x)) and sum(log(1 - x)) are computed
+    once. The chains share the samples of the two sequential emcmc chains:
+    every chain is burned-in and then keeps its part of them, every `thin`
+    iterations.
+    
+    Parameters:
+    - x: An array of data points used in the acceptance ratio computations.
+    - l0: A constant value used in the acceptance ratio computations.
+    - se: The standard deviation for the random walk in the Metropolis-Hastings algorithm.
+    - sim, thin, burn: Iterations, thinning and burn-in of emcmc.
+    - chains: Number of chains.
+    - seed: Seed of the chains, every chain gets its own stream spawned from it.
+      If None, it is drawn from np.random, so np.random.seed still applies.
+    
+    Returns:
+    - Samples as an array of shape (chains, samples, 2) of (alpha, beta).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    cost_a = l0 - np.sum(np.log(x))
+    cost_b = l0 - np.sum(np.log(1 - x))
+
+    chains = max(1, int(chains))
+    samples = max(1, math.ceil(2 * delta_sample_count(sim, thin, burn) / chains))
+    iterations = burn + (samples - 1) * thin + 1
+
+    if seed is None:
+        seed = np.random.randint(0, 2**32 - 1)
+    generators = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(chains)]
+
+    # every chain draws its whole random stream upfront
+    alpha = np.array([g.exponential() for g in generators])
+    beta = np.array([g.exponential() for g in generators])
+    steps = np.stack([g.normal(0, se, size=(iterations, 2)) for g in generators], axis=1)
+    log_uniforms = np.log(np.stack([g.uniform(0, 1, size=(iterations, 2)) for g in generators], axis=1))
+
+    def propose(value, step, i, column, other, accept_term):
+        proposal = value * np.exp(step)
+        log_ratio = accept_term(proposal, other) - accept_term(value, other)
+        # like mhalpha/mhbeta, a proposal is redrawn while the ratio is NaN
+        for k in np.flatnonzero(np.isnan(log_ratio)):
+            while np.isnan(log_ratio[k]):
+                proposal[k] = value[k] * np.exp(generators[k].normal(0, se))
+                log_ratio[k] = accept_term(proposal[k:k + 1], other[k:k + 1])[0] - \
+                    accept_term(value[k:k + 1], other[k:k + 1])[0]
+        return np.where(log_uniforms[i, :, column] < log_ratio, proposal, value)
+
+    def alpha_term(a, b):
+        return n * (gammaln(a + b) - gammaln(a)) - a * cost_a
+
+    def beta_term(b, a):
+        return n * (gammaln(a + b) - gammaln(b)) - b * cost_b
+
+    keep = np.zeros(iterations, dtype=bool)
+    keep[burn::thin] = True
+    gibbs = np.empty((chains, samples, 2))
+    p = 0
+    for i in range(iterations):
+        alpha = propose(alpha, steps[i, :, 0], i, 0, beta, alpha_term)
+        beta = propose(beta, steps[i, :, 1], i, 1, alpha, beta_term)
+        if keep[i] and p < samples:
+            gibbs[:, p, 0] = alpha
+            gibbs[:, p, 1] = beta
+            p += 1
+
+    return gibbs
+
 # def parallel_emcmc(threads, alpha, beta, x, l0, se, sim, thin, burn):
 #     params = [(alpha, beta, x, l0, se, sim, thin, burn) for _ in range(threads)]
 #     with ThreadPool(processes=threads-1) as pool:
@@ -167,22 +248,18 @@ def entropy_type(prob, ent_type):
 
 
 # Calculate delta-statistic after an MCMC step
-def delta(x,lambda0,se,sim,thin,burn,ent_type, threads=1):
+def delta(x,lambda0,se,sim,thin,burn,ent_type, threads=1, chains=DELTA_CHAINS, seed=None):
     '''x     = A matrix of ancestral probabilities.
     lambda0  = A constant value used in the acceptance ratio computations.
     se       = The standard deviation used for the random walk in the Metropolis-Hastings algorithm.
     sim      = The number of total iterations in the Markov Chain Monte Carlo (MCMC) simulation.
     thin     = The thinning parameter, i.e., the number of iterations to discard between saved samples.
     burn     = The number of burn-in iterations to discard at the beginning of the simulation.
-    ent_type = A string specifying the type of entropy calculation (options: 'LSE', 'SE', or any other value for Gini impurity).'''
-    params = (np.random.exponential(),np.random.exponential(),entropy_type(x, ent_type),lambda0,se,sim,thin,burn)
-    # if threads > 1:
-    #     mc1    = parallel_emcmc(threads,np.random.exponential(),np.random.exponential(),entropy_type(x, ent_type),lambda0,se,sim,thin,burn)
-    #     mc2    = parallel_emcmc(threads,np.random.exponential(),np.random.exponential(),entropy_type(x, ent_type),lambda0,se,sim,thin,burn)
-    # else:
-    mc1    = emcmc(params)
-    mc2    = emcmc(params)
-    mchain = np.concatenate((mc1,mc2), axis=0)
+    ent_type = A string specifying the type of entropy calculation (options: 'LSE', 'SE', or any other value for Gini impurity).
+    chains   = The number of Metropolis-Hastings chains advanced together.
+    seed     = Seed of the chains, see emcmc_chains.'''
+    mchain = emcmc_chains(entropy_type(x, ent_type), lambda0, se, sim, thin, burn, chains=chains, seed=seed)
+    mchain = mchain.reshape(-1, 2)
     
     deltaA = (np.mean(mchain[:,1]))/(np.mean(mchain[:,0]))
     
@@ -222,12 +299,15 @@ def run_acr_continuous(tree, transformed_dict, model="BM", prediction_method="ML
             tree, acr_result = ml_acr(tree, key, observed_traits, model=model, sigma=sigma, alpha=alpha, theta=theta)
         elif prediction_method == 'BAYESIAN':
             tree, acr_result = by_acr(tree, key, observed_traits, model=model, sigma_prior=sigma_prior, sigma_drift=sigma_drift, alpha=alpha, theta=theta)
+        elif prediction_method == 'PRUNING':
+            # BM drift rate is estimated from the data
+            tree, acr_result = pruning_acr(tree, key, observed_traits, model=model, sigma=sigma if model == 'OU' else None, alpha=alpha, theta=theta)
         acr_results[key] = acr_result
 
     return acr_result, tree
 
 # Calculate delta-statistic of marginal probabilities each discrete trait
-def run_delta(acr_results, tree, run_whole_tree=False, ent_type='LSE', lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1):
+def run_delta(acr_results, tree, run_whole_tree=False, ent_type='LSE', lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1, chains=DELTA_CHAINS):
     prop2delta = {}
     prop2marginals = {}
     leafnames = tree.leaf_names()
@@ -250,7 +330,7 @@ def run_delta(acr_results, tree, run_whole_tree=False, ent_type='LSE', lambda0=0
                 # run delta for each discrete trait
                 # load annotations to leaves
                 np.random.seed(42)  # or any integer seed you prefer
-                delta_result = delta(marginal_probs, lambda0, se, sim, burn, thin, ent_type, threads)
+                delta_result = delta(marginal_probs, lambda0, se, sim, thin=thin, burn=burn, ent_type=ent_type, threads=threads, chains=chains)
                 node.add_prop(add_suffix(prop, "delta"), delta_result)
     else:
         # this is the case when we only want to calculate delta for the root
@@ -260,7 +340,7 @@ def run_delta(acr_results, tree, run_whole_tree=False, ent_type='LSE', lambda0=0
             # run delta for each discrete trait
             # load annotations to leaves
             np.random.seed(42)  # or any integer seed you prefer
-            delta_result = delta(marginal_probs, lambda0, se, sim, burn, thin, ent_type, threads)
+            delta_result = delta(marginal_probs, lambda0, se, sim, thin=thin, burn=burn, ent_type=ent_type, threads=threads, chains=chains)
             #tree.add_prop(add_suffix(prop, "delta"), delta_result)
             prop2delta[prop] = delta_result
         return prop2delta
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+from collections.abc import Mapping
+
+import numpy as np
+from scipy import sparse
+
+# Sparse presence/absence profiles of multi-valued properties.
+#
+# The terms of a property (GO terms, KEGG orthologs, categories...) are
+# interned to column ids once, and every leaf holding the property becomes
+# a CSR row with the ids of its terms. The row of an internal node counts
+# the leaves below it holding each term, summed bottom-up from the rows of
+# its children over the preorder index (see tree_index), and is kept as
+# the ratio of those leaves. Only the terms actually present are stored,
+# a dense row is built when a layout or an output asks for one node.
+
+LIST_SEPARATOR = '||'
+
+def node_terms(value, list_type=False):
+    """Terms of a property value: its items if it is a list, else the value itself."""
+    if isinstance(value, (list, tuple, set)):
+        return value
+    if list_type:
+        return value.split(LIST_SEPARATOR)
+    return (value,)
+
+def leaf_presence(leaf_values, term2id, list_type=False):
+    """CSR matrix of the terms of every leaf value, None values giving empty rows."""
+    indptr = [0]
+    indices = []
+    for value in leaf_values:
+        if value:
+            indices.extend(sorted({term2id[term] for term in node_terms(value, list_type) if term in term2id}))
+        indptr.append(len(indices))
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(len(leaf_values), len(term2id)))
+
+def clade_counts(tree_index, presence):
+    """
+    {term id: leaves} of every internal node, None for the leaves, summing
+    the rows of the children bottom-up.
+    """
+    nodes = tree_index.nodes
+    node2id = tree_index.node2id
+    rows = [None] * len(nodes)
+
+    # descendants always have larger preorder ids
+    for i in range(len(nodes) - 1, -1, -1):
+        node = nodes[i]
+        if node.is_leaf:
+            continue
+        children = []
+        for child in node.children:
+            j = node2id[child]
+            if rows[j] is not None:
+                children.append(rows[j])
+            else:
+                leaf = tree_index.leaf_index[j]
+                start, end = presence.indptr[leaf], presence.indptr[leaf + 1]
+                children.append(dict.fromkeys(presence.indices[start:end].tolist(), 1))
+
+        # add the smaller children into a copy of the largest one
+        children.sort(key=len, reverse=True)
+        counts = dict(children[0]) if children else {}
+        for child in children[1:]:
+            for term, count in child.items():
+                counts[term] = counts.get(term, 0) + count
+        rows[i] = counts
+    return rows
+
+class ProfileMatrix(Mapping):
+    """
+    {node name: row} of a presence/absence profile: 1 or 0 per term for the
+    leaves, the ratio of leaves below with each term for the internal nodes.
+    Rows are only made dense when they are looked up.
+    """
+    def __init__(self, terms, leaf_names, presence, node_names, ratios):
+        self.terms = terms
+        self.presence = presence
+        self.ratios = ratios
+        # later nodes with the same name take its row, as in a dict built over the tree
+        self.name2row = {}
+        for i, name in enumerate(node_names):
+            self.name2row[name] = (self.ratios, i)
+        for i, name in enumerate(leaf_names):
+            self.name2row[name] = (self.presence, i)
+
+    @property
+    def ncols(self):
+        return len(self.terms)
+
+    def row(self, name):
+        """Dense numpy row of the node `name`."""
+        matrix, i = self.name2row[name]
+        return matrix[i].toarray()[0]
+
+    def distinct_values(self):
+        """Distinct values of the profile, without building any row."""
+        full = [np.diff(matrix.indptr) == self.ncols for matrix in (self.presence, self.ratios)]
+        data = np.concatenate([self.presence.data.astype(np.float64), self.ratios.data])
+        if not all(rows.all() for rows in full):
+            data = np.append(data, 0)
+        return np.unique(data)
+
+    def __getitem__(self, name):
+        return self.row(name).tolist()
+
+    def __iter__(self):
+        return iter(self.name2row)
+
+    def __len__(self):
+        return len(self.name2row)
+
+def build_profile(tree_index, prop, terms, list_type=False, clade_total=True, minimum=0):
+    """
+    ProfileMatrix of `prop` over the `terms` columns. The ratios of internal
+    nodes are out of all their leaves with `clade_total`, else out of the
+    leaves holding the property, and are raised to `minimum` when lower.
+    """
+    terms = list(dict.fromkeys(terms))
+    term2id = {term: i for i, term in enumerate(terms)}
+
+    leaf_values = [leaf.props.get(prop) for leaf in tree_index.leaves]
+    presence = leaf_presence(leaf_values, term2id, list_type)
+    has_value = np.array([bool(value) for value in leaf_values], dtype=bool)
+
+    # leaves holding the property below every node
+    valued = np.concatenate([[0], np.cumsum(has_value)])
+    valued = valued[tree_index.leaf_end] - valued[tree_index.leaf_start]
+
+    counts = clade_counts(tree_index, presence)
+    internal_ids = [i for i, row in enumerate(counts) if row is not None and valued[i] > 0]
+    if clade_total:
+        totals = tree_index.leaf_end - tree_index.leaf_start
+    else:
+        totals = valued
+
+    lengths = np.array([len(counts[i]) for i in internal_ids], dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    indices = np.fromiter((term for i in internal_ids for term in counts[i]), dtype=np.int32, count=indptr[-1])
+    data = np.fromiter((count for i in internal_ids for count in counts[i].values()), dtype=np.float64, count=indptr[-1])
+    data /= np.repeat(totals[internal_ids], lengths)
+    if minimum:
+        data = np.maximum(data, minimum)
+    ratios = sparse.csr_matrix((data, indices, indptr), shape=(len(internal_ids), len(terms)))
+    ratios.sort_indices()
+
+    leaf_rows = np.flatnonzero(has_value)
+    return ProfileMatrix(terms,
+        [tree_index.leaves[i].name for i in leaf_rows], presence[leaf_rows],
+        [tree_index.nodes[i].name for i in internal_ids], ratios)
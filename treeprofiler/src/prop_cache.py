@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import numpy as np
+
+from treeprofiler.src.tree_index import TreeIndex
+
+# Property columns of a tree for the plot layouts.
+#
+# A plot run reads the same properties over and over: every layout builder
+# asks utils.tree_prop_array for the values of its prop and of its internal
+# summary (prop_avg, prop_counter...), often several times. While a tree is
+# registered here, those calls are served from columns read once over the
+# preorder node list of a tree index, one list per property aligned with
+# the node ids, and the compacted arrays derived from them are kept per
+# (prop, leaf_only, numeric, list_type). Pruning the tree invalidates them.
+
+LIST_SEPARATOR = '||'
+
+# {tree: PropCache} of the trees being plotted
+_caches = {}
+
+class PropCache:
+    def __init__(self, tree, tree_index=None):
+        self.tree = tree
+        self._tree_index = tree_index
+        self.columns = {}
+        self.arrays = {}
+
+    @property
+    def tree_index(self):
+        if self._tree_index is None:
+            self._tree_index = TreeIndex(self.tree)
+        return self._tree_index
+
+    def clear(self):
+        """Forget the index and every column, they are rebuilt on the next read."""
+        self._tree_index = None
+        self.columns.clear()
+        self.arrays.clear()
+
+    def preload(self, props):
+        """Read several property columns in one pass over the nodes."""
+        props = [prop for prop in props if prop not in self.columns]
+        if not props:
+            return
+        columns = [[] for _ in props]
+        for node in self.tree_index.nodes:
+            node_props = node.props
+            for column, prop in zip(columns, props):
+                column.append(node_props.get(prop))
+        self.columns.update(zip(props, columns))
+
+    def column(self, prop, leaf_only=False):
+        """Values of `prop` aligned with the node ids (or the leaf ids), None where missing."""
+        if prop not in self.columns:
+            self.columns[prop] = [node.props.get(prop) for node in self.tree_index.nodes]
+        column = self.columns[prop]
+        if leaf_only:
+            key = (prop, 'leaves')
+            if key not in self.arrays:
+                is_leaf = self.tree_index.leaf_index >= 0
+                self.arrays[key] = [value for value, leaf in zip(column, is_leaf) if leaf]
+            column = self.arrays[key]
+        return column
+
+    def present(self, prop, leaf_only=False):
+        """Mask of the nodes (or leaves) where `prop` is set."""
+        key = (prop, leaf_only, 'present')
+        if key not in self.arrays:
+            self.arrays[key] = np.array([value is not None for value in self.column(prop, leaf_only)], dtype=bool)
+        return self.arrays[key]
+
+    def numeric_column(self, prop, leaf_only=False):
+        """Float array of `prop` aligned with the node ids (or the leaf ids), NaN where missing."""
+        key = (prop, leaf_only, 'numeric')
+        if key not in self.arrays:
+            column = self.column(prop, leaf_only)
+            values = np.full(len(column), np.nan)
+            values[self.present(prop, leaf_only)] = to_numbers([value for value in column if value is not None])
+            self.arrays[key] = values
+        return self.arrays[key]
+
+    def prop_array(self, prop, leaf_only=False, numeric=False, list_type=False):
+        """The values utils.tree_prop_array returns, the missing ones left out."""
+        key = (prop, leaf_only, numeric, list_type)
+        if key not in self.arrays:
+            array = None
+            if numeric and not list_type:
+                try:
+                    array = self.numeric_column(prop, leaf_only)[self.present(prop, leaf_only)]
+                except TypeError:
+                    # sets of values, or values that are not numbers
+                    pass
+
+            if array is None:
+                column = [value for value in self.column(prop, leaf_only) if value is not None]
+                if list_type:
+                    array = [value.split(LIST_SEPARATOR) for value in column]
+                    if numeric:
+                        array = [[to_number(p) if p else np.nan for p in value] for value in array]
+                else:
+                    array = []
+                    for value in column:
+                        if isinstance(value, set):
+                            array.extend(value)
+                        else:
+                            array.append(to_number(value) if numeric else value)
+            self.arrays[key] = array
+        array = self.arrays[key]
+        # callers get their own list, as from a fresh traversal
+        return array.tolist() if isinstance(array, np.ndarray) else list(array)
+
+def to_number(value):
+    if value == 'NaN':
+        return np.nan
+    try:
+        return float(value)
+    except ValueError:
+        raise TypeError(f"Cannot treat value '{value}' as a number. Please check data type or use --numerical-matrix-layout")
+
+def to_numbers(values):
+    """Float array of `values`, converted by numpy unless one of them needs a closer look."""
+    try:
+        array = np.array(values, dtype=np.float64)
+        if array.ndim == 1:
+            return array
+    except ValueError:
+        pass
+    return np.array([to_number(value) for value in values], dtype=np.float64)
+
+def register(tree, props=None):
+    """Serve the property arrays of `tree` from a cache until it is unregistered."""
+    cache = _caches[tree] = PropCache(tree)
+    if props:
+        cache.preload(props)
+    return cache
+
+def lookup(node):
+    """The cache of `node` if it is a registered tree, else None."""
+    return _caches.get(node)
+
+def invalidate(tree):
+    """Drop the cached columns of `tree` after its structure or properties changed."""
+    cache = _caches.get(tree)
+    if cache is not None:
+        cache.clear()
+
+def unregister(tree):
+    _caches.pop(tree, None)
+
+def tree_index(tree):
+    """The index of a registered tree, or a new one."""
+    cache = _caches.get(tree)
+    return cache.tree_index if cache is not None else TreeIndex(tree)
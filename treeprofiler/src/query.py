@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+import operator
+
+import numpy as np
+
+from treeprofiler.src.tree_index import TreeIndex
+
+# Compiled node queries for --pruned-by, --highlighted-by and --collapsed-by.
+#
+# The [left, op, right] conditions of utils.to_code are compiled once into
+# predicates with their datatype, operator and parsed right value resolved.
+# A query is evaluated over columns of node properties (one list per
+# property, counter properties split into {key: value} once per node) and
+# returns a boolean mask over the nodes, the AND of its predicates. With a
+# preorder tree index, the mask gives the clades to detach in one sweep and
+# the ancestors to mark for highlighting without walking up from each match.
+
+PAIR_DELIMITER = '--'
+ITEM_SEPARATOR = '||'
+NUM_OPERATORS = {'<', '<=', '>', '>='}
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+def is_missing(value):
+    return value is None or (isinstance(value, (str, list)) and not value)
+
+def parse_counter(value):
+    """{key: count string} of a counter property like 'a--1||b--2'."""
+    if not isinstance(value, str) or not value:
+        return None
+    counter = {}
+    for item in value.split(ITEM_SEPARATOR):
+        key, _, count = item.rpartition(PAIR_DELIMITER)
+        counter[key] = count
+    return counter
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+class NodeColumns:
+    """Property values of a list of nodes, read once per property."""
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.columns = {}
+        self.counters = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, prop):
+        if prop not in self.columns:
+            self.columns[prop] = [node.props.get(prop) for node in self.nodes]
+        return self.columns[prop]
+
+    def counter(self, prop):
+        if prop not in self.counters:
+            self.counters[prop] = [parse_counter(value) for value in self.get(prop)]
+        return self.counters[prop]
+
+class Never:
+    """A condition that cannot hold for its datatype, like '<' on text."""
+    def __init__(self, prop):
+        self.prop = prop
+
+    def evaluate(self, columns):
+        return np.zeros(len(columns), dtype=bool)
+
+class Compare:
+    """`prop op value` on text or list properties, 'contains' and 'in' included."""
+    def __init__(self, prop, op, value):
+        self.prop = prop
+        self.value = value
+        if op in ('contains', 'in'):
+            self.test = lambda left: isinstance(left, (str, list, tuple, set)) and value in left
+        else:
+            compare = OPERATORS[op]
+            self.test = lambda left: bool(compare(left, value))
+
+    def evaluate(self, columns):
+        test = self.test
+        return np.fromiter((not is_missing(left) and test(left) for left in columns.get(self.prop)),
+            dtype=bool, count=len(columns))
+
+class NumericCompare:
+    """`prop op number` on numerical properties."""
+    def __init__(self, prop, op, value):
+        self.prop = prop
+        self.compare = OPERATORS[op]
+        self.value = float(value)
+
+    def evaluate(self, columns):
+        column = columns.get(self.prop)
+        present = np.fromiter((not is_missing(left) for left in column), dtype=bool, count=len(columns))
+        values = np.fromiter((to_float(left) for left in column), dtype=float, count=len(columns))
+        with np.errstate(invalid='ignore'):
+            return present & self.compare(values, self.value)
+
+class CounterCompare:
+    """`prop:key op number` on the count of `key` in a counter property."""
+    def __init__(self, prop, key, op, value):
+        self.prop = prop
+        self.key = key
+        self.compare = OPERATORS[op]
+        self.value = float(value)
+
+    def evaluate(self, columns):
+        key = self.key
+        counts = np.fromiter((to_float(counter[key]) if counter and key in counter else np.nan
+            for counter in columns.counter(self.prop)), dtype=float, count=len(columns))
+        with np.errstate(invalid='ignore'):
+            return ~np.isnan(counts) & self.compare(counts, self.value)
+
+def compile_condition(condition, prop2type):
+    left, op, right = condition
+    if op == 'in':
+        # `value in prop`, the value is on the left of the condition
+        prop, value = right, left
+    else:
+        prop, value = left, right
+
+    if op != 'in' and ':' in left:
+        prop, key = left.split(':')
+        if prop2type[prop] != str or op not in OPERATORS:
+            return Never(prop)
+        return CounterCompare(prop, key, op, value)
+
+    datatype = prop2type.get(prop)
+    if datatype == float:
+        if op not in OPERATORS:
+            return Never(prop)
+        return NumericCompare(prop, op, value)
+    if datatype == str or datatype is None:
+        if op in NUM_OPERATORS:
+            return Never(prop)
+        return Compare(prop, op, value)
+    if datatype == list and op == 'contains':
+        return Compare(prop, op, value)
+    return Never(prop)
+
+class Query:
+    def __init__(self, predicates):
+        self.predicates = predicates
+
+    @property
+    def props(self):
+        return sorted({predicate.prop for predicate in self.predicates})
+
+    def evaluate(self, nodes):
+        """Boolean mask of the `nodes` matching every predicate, an empty query matches nothing."""
+        columns = nodes if isinstance(nodes, NodeColumns) else NodeColumns(nodes)
+        mask = np.zeros(len(columns), dtype=bool)
+        if self.predicates:
+            mask[:] = True
+            for predicate in self.predicates:
+                mask &= predicate.evaluate(columns)
+                if not mask.any():
+                    break
+        return mask
+
+    def match(self, node):
+        return bool(self.evaluate([node])[0])
+
+def compile_query(conditions, prop2type):
+    """Compile the [left, op, right] conditions of utils.to_code into one Query."""
+    prop2type = prop2type or {}
+    return Query([compile_condition(condition, prop2type) for condition in conditions])
+
+def matched_below(tree_index, mask):
+    """Mask of the nodes with at least one matching node strictly below them."""
+    counts = np.concatenate([[0], np.cumsum(mask)])
+    ids = np.arange(len(tree_index.nodes))
+    return counts[tree_index.node_end] - counts[ids + 1] > 0
+
+def prune(tree, query, tree_index=None):
+    """Detach every non-root node matching `query`, the clades of the
+    detached nodes are skipped instead of being evaluated again."""
+    tree_index = tree_index or TreeIndex(tree)
+    mask = query.evaluate(tree_index.nodes)
+    i = 1
+    while i < len(tree_index.nodes):
+        if mask[i]:
+            tree_index.nodes[i].detach()
+            i = tree_index.node_end[i]
+        else:
+            i += 1
+    return tree
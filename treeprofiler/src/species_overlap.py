@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Species overlap of the two sides of every bifurcation.
+#
+# Species codes are interned to bit positions, and the species set of a
+# clade is an integer bitset, OR-ed bottom-up from its children over the
+# preorder index (see tree_index). A bitset is dropped as soon as its parent
+# is built, so the memory is that of the bitsets still waiting for a
+# sibling, never one set of leaf or species names per node.
+
+class SpeciesIndex:
+    def __init__(self):
+        self.species = []
+        self.species2bit = {}
+
+    def __len__(self):
+        return len(self.species)
+
+    def bit(self, species):
+        """Bitset of a single species, interning it the first time it is seen."""
+        position = self.species2bit.get(species)
+        if position is None:
+            position = self.species2bit[species] = len(self.species)
+            self.species.append(species)
+        return 1 << position
+
+    def decode(self, bits):
+        """Species of a bitset, in the order they were interned."""
+        names = []
+        while bits:
+            low = bits & -bits
+            names.append(self.species[low.bit_length() - 1])
+            bits ^= low
+        return names
+
+def species_overlaps(tree_index, leaf2species, species_index=None):
+    """
+    Yield (node, shared, total) for every node with two children, the
+    bitsets of the species found on both sides and on either side.
+    `leaf2species` gives the species code of a leaf.
+    """
+    species_index = species_index if species_index is not None else SpeciesIndex()
+    nodes = tree_index.nodes
+    node2id = tree_index.node2id
+    bits = [0] * len(nodes)
+
+    # descendants always have larger preorder ids
+    for i in range(len(nodes) - 1, -1, -1):
+        node = nodes[i]
+        if node.is_leaf:
+            bits[i] = species_index.bit(leaf2species(node))
+            continue
+
+        child_ids = [node2id[child] for child in node.children]
+        if len(child_ids) == 2:
+            left, right = bits[child_ids[0]], bits[child_ids[1]]
+            yield node, left & right, left | right
+
+        clade = 0
+        for child_id in child_ids:
+            clade |= bits[child_id]
+            bits[child_id] = 0
+        bits[i] = clade
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+import itertools
+import math
+from collections import Counter
+
+from treeprofiler.src.utils import add_suffix, children_prop_array, children_prop_array_missing
+
+# Bottom-up summary of leaf annotations into internal nodes.
+#
+# Each node keeps a partial aggregate of the leaves below it: a Counter for
+# categorical properties and (count, sum, mean, m2, min, max) sufficient
+# statistics for numerical properties. The aggregate of an internal node is
+# obtained by combining the aggregates of its children, so the whole tree is
+# summarized in one postorder traversal instead of rescanning every
+# descendant leaf for every internal node.
+
+PAIR_SEPARATOR = "--"
+ITEM_SEPARATOR = "||"
+
+def get_top_keys(counter, max_keys=2, separator="||", suffix="..."):
+    """Returns the top keys with the highest counts, sorted, and limited to max_keys, only when tied."""
+    if not counter:
+        return None  # Handle empty counter case
+
+    max_count = max(counter.values())
+    top_keys = sorted([key for key, value in counter.items() if value == max_count])  # Sort alphabetically
+
+    # If only one key has the highest count, return it directly
+    if len(top_keys) == 1:
+        return top_keys[0]
+
+    # If there is a tie, return up to max_keys, adding suffix if needed
+    if len(top_keys) > max_keys:
+        return separator.join(top_keys[:max_keys]) + separator + suffix
+    return separator.join(top_keys)
+
+# leaf aggregates
+def leaf_text_counter(leaf, prop):
+    counter = Counter(children_prop_array_missing([leaf], prop))
+    counter.pop('NaN', None)
+    return counter
+
+def leaf_multitext_counter(leaf, prop):
+    return Counter(itertools.chain.from_iterable(children_prop_array([leaf], prop)))
+
+def leaf_num_stats(leaf, prop):
+    """
+    Sufficient statistics of a leaf numerical property as
+    (count, sum, mean, m2, min, max), or None if missing or NaN.
+    """
+    values = children_prop_array([leaf], prop)
+    stats = None
+    for value in values:
+        value = float(value)
+        if math.isnan(value):
+            continue
+        stats = combine_num_stats(stats, (1, value, value, 0.0, value, value))
+    return stats
+
+# combining aggregates
+def combine_counters(counters):
+    """
+    Sum children counters into a new counter. The largest counter is reused
+    as accumulator, so it must not be used afterwards by the caller.
+    """
+    counters = [c for c in counters if c]
+    if not counters:
+        return Counter()
+    counters.sort(key=len, reverse=True)
+    merged = counters[0]
+    for counter in counters[1:]:
+        merged.update(counter)
+    return merged
+
+def combine_num_stats(a, b):
+    """
+    Combine two (count, sum, mean, m2, min, max) tuples using the parallel
+    variance formula of Chan et al.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    n_a, sum_a, mean_a, m2_a, min_a, max_a = a
+    n_b, sum_b, mean_b, m2_b, min_b, max_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta * delta * n_a * n_b / n
+    return (n, sum_a + sum_b, mean, m2, min(min_a, min_b), max(max_a, max_b))
+
+# formatting aggregates into internal node properties
+def text_counter_props(counter, target_prop, counter_stat, acr_discrete_columns=(), emapper_mode=False):
+    internal_props = {}
+    if counter_stat in {'raw', 'dominant'}:
+        # Emapper mode handling
+        if emapper_mode and counter and target_prop not in acr_discrete_columns:
+            internal_props[target_prop] = get_top_keys(counter)
+        elif counter_stat == 'dominant':
+            internal_props[target_prop] = get_top_keys(counter)
+        else:
+            sorted_items = sorted(counter.items())
+            internal_props[add_suffix(target_prop, 'counter')] = ITEM_SEPARATOR.join(
+                f"{key}{PAIR_SEPARATOR}{value}" for key, value in sorted_items
+            )
+
+    elif counter_stat == 'relative':
+        total = sum(counter.values())
+        if total > 0:  # Avoid division by zero
+            sorted_items = sorted(counter.items())
+            internal_props[add_suffix(target_prop, 'counter')] = ITEM_SEPARATOR.join(
+                f"{key}{PAIR_SEPARATOR}{value / total:.2f}" for key, value in sorted_items
+            )
+
+    elif counter_stat == 'none':
+        pass
+
+    else:
+        raise ValueError(f"Invalid counter_stat '{counter_stat}'")
+
+    return internal_props
+
+def multitext_counter_props(counter, target_prop, counter_stat):
+    internal_props = {}
+    if counter_stat in {'raw', 'relative'}:
+        sorted_items = sorted(counter.items())
+
+        if counter_stat == 'raw':
+            internal_props[add_suffix(target_prop, 'counter')] = ITEM_SEPARATOR.join(
+                f"{key}{PAIR_SEPARATOR}{value}" for key, value in sorted_items
+            )
+
+        elif counter_stat == 'relative':
+            total = sum(counter.values())
+            if total > 0:  # Avoid division by zero
+                internal_props[add_suffix(target_prop, 'counter')] = ITEM_SEPARATOR.join(
+                    f"{key}{PAIR_SEPARATOR}{value / total:.2f}" for key, value in sorted_items
+                )
+
+    return internal_props
+
+def num_stats_props(stats, target_prop, num_stat):
+    internal_props = {}
+    if stats is None:
+        return internal_props
+
+    count, prop_sum, prop_mean, m2, prop_min, prop_max = stats
+    prop_avg = prop_sum / count
+    prop_std = math.sqrt(m2 / (count - 1)) if count > 1 else 0  # Sample standard deviation
+
+    # Populate results based on requested stat method
+    if num_stat == 'all':
+        internal_props[add_suffix(target_prop, 'avg')] = prop_avg
+        internal_props[add_suffix(target_prop, 'sum')] = prop_sum
+        internal_props[add_suffix(target_prop, 'max')] = prop_max
+        internal_props[add_suffix(target_prop, 'min')] = prop_min
+        internal_props[add_suffix(target_prop, 'std')] = prop_std
+    elif num_stat == 'avg':
+        internal_props[add_suffix(target_prop, 'avg')] = prop_avg
+    elif num_stat == 'sum':
+        internal_props[add_suffix(target_prop, 'sum')] = prop_sum
+    elif num_stat == 'max':
+        internal_props[add_suffix(target_prop, 'max')] = prop_max
+    elif num_stat == 'min':
+        internal_props[add_suffix(target_prop, 'min')] = prop_min
+    elif num_stat == 'std':
+        internal_props[add_suffix(target_prop, 'std')] = prop_std
+
+    return internal_props
+
+def summarize_props(partial, text_prop=[], multiple_text_prop=[], bool_prop=[], num_prop=[],
+        column2method={}, acr_discrete_columns=(), emapper_mode=False):
+    """Format the partial aggregate of a node as its internal properties."""
+    text_counters, multitext_counters, bool_counters, num_stats = partial
+    internal_props = {}
+    for prop in text_prop:
+        internal_props.update(text_counter_props(text_counters[prop], prop,
+            column2method.get(prop, "raw"), acr_discrete_columns, emapper_mode=emapper_mode))
+    for prop in multiple_text_prop:
+        internal_props.update(multitext_counter_props(multitext_counters[prop], prop,
+            column2method.get(prop, "raw")))
+    for prop in bool_prop:
+        internal_props.update(text_counter_props(bool_counters[prop], prop,
+            column2method.get(prop, "raw"), acr_discrete_columns, emapper_mode=emapper_mode))
+    for prop in num_prop:
+        internal_props.update(num_stats_props(num_stats[prop], prop, column2method.get(prop, None)))
+    return internal_props
+
+def leaf_partial(leaf, text_prop=[], multiple_text_prop=[], bool_prop=[], num_prop=[]):
+    """Partial aggregate of a single leaf for the properties that need a summary."""
+    return (
+        {prop: leaf_text_counter(leaf, prop) for prop in text_prop},
+        {prop: leaf_multitext_counter(leaf, prop) for prop in multiple_text_prop},
+        {prop: leaf_text_counter(leaf, prop) for prop in bool_prop},
+        {prop: leaf_num_stats(leaf, prop) for prop in num_prop},
+    )
+
+def combine_partials(partials):
+    """Combine children partial aggregates into the aggregate of their parent."""
+    text_counters, multitext_counters, bool_counters, num_stats = partials[0]
+    combined = (
+        {prop: combine_counters([p[0][prop] for p in partials]) for prop in text_counters},
+        {prop: combine_counters([p[1][prop] for p in partials]) for prop in multitext_counters},
+        {prop: combine_counters([p[2][prop] for p in partials]) for prop in bool_counters},
+        {},
+    )
+    for prop in num_stats:
+        stats = None
+        for p in partials:
+            stats = combine_num_stats(stats, p[3][prop])
+        combined[3][prop] = stats
+    return combined
+
+def merge_annotations(tree, text_prop=[], multiple_text_prop=[], bool_prop=[], num_prop=[],
+        column2method={}, acr_discrete_columns=None, emapper_mode=False):
+    """
+    Summarize leaf annotations into every internal node with a single
+    postorder traversal.
+
+    Yields (node, internal_props) for every internal node in postorder. The
+    properties are the same `_counter`, `_avg`, `_sum`, `_max`, `_min` and
+    `_std` values computed by merging every descendant leaf.
+    """
+    acr_discrete_columns = set(acr_discrete_columns or [])
+    num_prop = [prop for prop in num_prop if prop not in ('dist', 'support')]
+    summary_props = dict(text_prop=text_prop, multiple_text_prop=multiple_text_prop,
+        bool_prop=bool_prop, num_prop=num_prop)
+
+    node2partial = {}
+    for node in tree.traverse("postorder"):
+        if node.is_leaf:
+            node2partial[node] = leaf_partial(node, **summary_props)
+        else:
+            # children aggregates are consumed by their parent
+            partial = combine_partials([node2partial.pop(child) for child in node.children])
+            node2partial[node] = partial
+            yield node, summarize_props(partial, **summary_props, column2method=column2method,
+                acr_discrete_columns=acr_discrete_columns, emapper_mode=emapper_mode)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from ete4 import GTDBTaxa, NCBITaxa
+
+# Bulk resolution of NCBI taxids to ranks and names.
+#
+# All the taxids of the lineages of a tree are resolved together, with one
+# get_rank and one get_taxid_translator query for the ones never seen
+# before. Results are memoized for the whole process and, with `cache`, in
+# a JSON file of the cache directory keyed by the version of the taxonomy
+# database, so later runs over related trees rarely touch the database.
+#
+# The cache directory also keeps the taxonomy databases built from dump
+# files, one per dump under taxonomy/<sha256 of the dump>/, so a dump is
+# imported once and later runs pointing at the same dump open its database
+# directly.
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = 'TREEPROFILER_CACHE_DIR'
+DATABASES_DIR = 'taxonomy'
+DUMPS_DIR = 'dumps'
+DBFILE = 'taxa.sqlite'
+INFOFILE = 'info.json'
+TAXA_CLASSES = {'GTDB': GTDBTaxa, 'MOTUS': GTDBTaxa, 'NCBI': NCBITaxa}
+
+# {database version: {'rank': {taxid: rank}, 'name': {taxid: name}}}
+_lookups = {}
+
+def default_cache_dir():
+    return os.environ.get(CACHE_DIR_ENV) or os.path.join(os.path.expanduser('~'), '.cache', 'treeprofiler')
+
+def databases_dir(cache_dir=None):
+    return os.path.join(cache_dir or default_cache_dir(), DATABASES_DIR)
+
+def dumps_dir(cache_dir=None):
+    """Where downloaded dumps are kept between runs."""
+    path = os.path.join(cache_dir or default_cache_dir(), DUMPS_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def dump_checksum(dump_file, block_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(dump_file, 'rb') as f:
+        while block := f.read(block_size):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def read_info(path):
+    with open(os.path.join(path, INFOFILE)) as f:
+        return json.load(f)
+
+def write_info(path, info):
+    with open(os.path.join(path, INFOFILE), 'w') as f:
+        json.dump(info, f, indent=1)
+
+def cached_database(taxadb, dump_file, cache_dir=None):
+    """
+    Path of the taxonomy database built from `dump_file`, importing the dump
+    into the cache directory only the first time it is seen.
+    """
+    checksum = dump_checksum(dump_file)
+    path = os.path.join(databases_dir(cache_dir), checksum)
+    dbfile = os.path.join(path, DBFILE)
+    if os.path.exists(dbfile):
+        logger.info(f"Using cached {taxadb} database of {dump_file} from {path}")
+        info = read_info(path)
+        info['last_used'] = time.time()
+        write_info(path, info)
+        return dbfile
+
+    logger.info(f"Importing {taxadb} database dump file {dump_file} into {path}...")
+    os.makedirs(databases_dir(cache_dir), exist_ok=True)
+    # build aside and move in place, so a killed import leaves no half database
+    tmp_path = tempfile.mkdtemp(prefix=f'.{checksum}.', dir=databases_dir(cache_dir))
+    try:
+        TAXA_CLASSES[taxadb](dbfile=os.path.join(tmp_path, DBFILE), taxdump_file=dump_file)
+        now = time.time()
+        write_info(tmp_path, {'taxadb': taxadb, 'dump': os.path.abspath(dump_file),
+            'checksum': checksum, 'created': now, 'last_used': now})
+        os.rename(tmp_path, path)
+    except OSError:
+        # imported meanwhile by another run
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(dbfile):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return dbfile
+
+def list_databases(cache_dir=None):
+    """Info of the cached databases, with their path and size, oldest used first."""
+    root = databases_dir(cache_dir)
+    if not os.path.isdir(root):
+        return []
+    databases = []
+    for checksum in os.listdir(root):
+        path = os.path.join(root, checksum)
+        if checksum.startswith('.') or not os.path.exists(os.path.join(path, INFOFILE)):
+            continue
+        info = read_info(path)
+        info['path'] = path
+        info['size'] = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        databases.append(info)
+    return sorted(databases, key=lambda info: info['last_used'])
+
+def prune_databases(cache_dir=None, keep=None, older_than=None, checksums=None):
+    """
+    Remove cached databases: the given `checksums` (or prefixes of them), the
+    ones not used for `older_than` days, and all but the `keep` most recently
+    used. Returns the removed ones.
+    """
+    databases = list_databases(cache_dir)
+    removed = []
+    for i, info in enumerate(databases):
+        if (checksums is not None and any(info['checksum'].startswith(c) for c in checksums)) \
+                or (older_than is not None and time.time() - info['last_used'] > older_than * 86400) \
+                or (keep is not None and i < len(databases) - keep):
+            shutil.rmtree(info['path'])
+            removed.append(info)
+    return removed
+
+def database_version(taxa):
+    """Key of the taxonomy database of `taxa`, it changes whenever the database is rebuilt."""
+    dbfile = os.path.abspath(taxa.dbfile)
+    stat = os.stat(dbfile)
+    return hashlib.md5(f'{dbfile}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+
+class TaxonomyResolver:
+    def __init__(self, ncbi, cache=False, cache_dir=None):
+        self.ncbi = ncbi
+        self.version = database_version(ncbi)
+        self.cache_path = None
+        if cache:
+            self.cache_path = os.path.join(cache_dir or default_cache_dir(), f'ncbi_lookup_{self.version}.json')
+
+        if self.version not in _lookups:
+            _lookups[self.version] = self.load_cache()
+        self.lookup = _lookups[self.version]
+
+    def load_cache(self):
+        lookup = {'rank': {}, 'name': {}}
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    saved = json.load(f)
+                for key in lookup:
+                    lookup[key] = {int(taxid): value for taxid, value in saved[key].items()}
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Ignoring unreadable taxonomy lookup cache {self.cache_path}: {e}")
+        return lookup
+
+    def save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.lookup, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def resolve(self, taxids):
+        """Query the database once for all the taxids that were never resolved."""
+        taxid2rank, taxid2name = self.lookup['rank'], self.lookup['name']
+        missing = {taxid for taxid in taxids if taxid not in taxid2rank and taxid not in taxid2name}
+        missing.discard(None)
+        missing.discard('')
+        if not missing:
+            return
+
+        logger.info(f"Resolving {len(missing)} taxids from the NCBI database...")
+        taxid2rank.update(self.ncbi.get_rank(missing))
+        taxid2name.update(self.ncbi.get_taxid_translator(missing))
+        if self.cache_path:
+            self.save_cache()
+
+    def ranks(self, lineage):
+        """{taxid: rank} of a lineage, ordered by taxid as get_rank returns it."""
+        taxid2rank = self.lookup['rank']
+        return {taxid: taxid2rank[taxid] for taxid in sorted(set(lineage)) if taxid in taxid2rank}
+
+    def names(self, lineage):
+        """{taxid: name} of a lineage, ordered by taxid as get_taxid_translator returns it."""
+        taxid2name = self.lookup['name']
+        return {taxid: taxid2name[taxid] for taxid in sorted(set(lineage)) if taxid in taxid2name}
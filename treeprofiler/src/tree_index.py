@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import numpy as np
+
+# Preorder leaf-interval index of a tree.
+#
+# Nodes are numbered in preorder, so the descendants of node i are the node
+# ids [i, node_end[i]) and the leaves below it are a contiguous interval
+# [leaf_start[i], leaf_end[i]) of the preorder leaf array. Any per-leaf array
+# built once with `leaf_prop_array` can then be sliced per clade in O(1)
+# instead of walking the tree with node.leaves() or get_cached_content().
+
+class TreeIndex:
+    def __init__(self, tree):
+        self.tree = tree
+        self.nodes = list(tree.traverse("preorder"))
+        self.node2id = {node: i for i, node in enumerate(self.nodes)}
+        self.leaves = [node for node in self.nodes if node.is_leaf]
+
+        n_nodes = len(self.nodes)
+        self.parents = np.full(n_nodes, -1, dtype=np.int32)
+        self.leaf_index = np.full(n_nodes, -1, dtype=np.int32)
+        self.leaf_start = np.zeros(n_nodes, dtype=np.int32)
+        self.node_end = np.arange(1, n_nodes + 1, dtype=np.int32)
+
+        leaf_id = 0
+        for i, node in enumerate(self.nodes):
+            self.leaf_start[i] = leaf_id
+            if node is not tree and node.up is not None:
+                self.parents[i] = self.node2id[node.up]
+            if node.is_leaf:
+                self.leaf_index[i] = leaf_id
+                leaf_id += 1
+
+        # close the intervals bottom-up, descendants always have larger ids
+        self.leaf_end = self.leaf_start + (self.leaf_index >= 0)
+        for i in range(n_nodes - 1, 0, -1):
+            parent = self.parents[i]
+            self.node_end[parent] = max(self.node_end[parent], self.node_end[i])
+            self.leaf_end[parent] = max(self.leaf_end[parent], self.leaf_end[i])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def n_leaves(self):
+        return len(self.leaves)
+
+    def node_id(self, node):
+        return self.node2id[node]
+
+    def leaf_range(self, node):
+        """Return the [start, end) interval of `node` over the preorder leaf array."""
+        i = self.node2id[node]
+        return int(self.leaf_start[i]), int(self.leaf_end[i])
+
+    def clade_slice(self, node):
+        return slice(*self.leaf_range(node))
+
+    def clade_size(self, node):
+        """Number of leaves under `node`."""
+        start, end = self.leaf_range(node)
+        return end - start
+
+    def clade_leaves(self, node):
+        return self.leaves[self.clade_slice(node)]
+
+    def clade_leaf_names(self, node):
+        return [leaf.name for leaf in self.clade_leaves(node)]
+
+    def clade_nodes(self, node):
+        """All nodes of the clade rooted at `node`, in preorder."""
+        i = self.node2id[node]
+        return self.nodes[i:self.node_end[i]]
+
+    def leaf_prop_array(self, prop, dtype=object, default=None):
+        """Values of `prop` for every leaf, in preorder leaf order."""
+        values = [leaf.props.get(prop, default) for leaf in self.leaves]
+        if dtype is not object:
+            return np.array(values, dtype=dtype)
+        # keep list values as single elements instead of a 2D array
+        array = np.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            array[i] = value
+        return array
+
+    def clade_values(self, array, node):
+        """Slice a per-leaf array to the leaves under `node`."""
+        return array[self.clade_slice(node)]
+
+    def clade_counts(self, mask):
+        """
+        Number of True values of the per-leaf boolean `mask` under every node,
+        as an array indexed by node id. A 2D (n_leaves, k) mask gives a
+        (n_nodes, k) array with the counts of every column.
+        """
+        mask = np.asarray(mask)
+        cumsum = np.zeros((len(mask) + 1,) + mask.shape[1:], dtype=np.int64)
+        np.cumsum(mask, axis=0, dtype=np.int64, out=cumsum[1:])
+        return cumsum[self.leaf_end] - cumsum[self.leaf_start]
+
+# Lowest common ancestor index.
+#
+# With nodes in preorder, the LCA of nodes u < v is the parent of the
+# shallowest node in (u, v], so LCA queries are range-minimum queries over
+# the preorder depths, answered in O(1) from a sparse table built in
+# O(n log n). The MRCA of any set of nodes is the LCA of its first and last
+# nodes in preorder, so it costs one query whatever the size of the set.
+
+class LCAIndex(TreeIndex):
+    def __init__(self, tree):
+        super().__init__(tree)
+        n_nodes = len(self.nodes)
+
+        # topological and branch length depths, parents come before children
+        self.depths = np.zeros(n_nodes, dtype=np.int32)
+        self.root_distances = np.zeros(n_nodes, dtype=np.float64)
+        dists = np.array([node.dist or 0.0 for node in self.nodes], dtype=np.float64)
+        for i in range(1, n_nodes):
+            parent = self.parents[i]
+            self.depths[i] = self.depths[parent] + 1
+            self.root_distances[i] = self.root_distances[parent] + dists[i]
+
+        self.name2ids = {}
+        for i, node in enumerate(self.nodes):
+            if node.name:
+                self.name2ids.setdefault(node.name, []).append(i)
+
+        # table[k][i] is the shallowest node of [i, i + 2**k)
+        self.table = [np.arange(n_nodes, dtype=np.int32)]
+        width = 1
+        while 2 * width <= n_nodes:
+            previous = self.table[-1]
+            left, right = previous[:-width], previous[width:]
+            self.table.append(np.where(self.depths[left] <= self.depths[right], left, right))
+            width *= 2
+
+    def resolve(self, node):
+        """Node id of `node`, given as a node or as a node name."""
+        if isinstance(node, str):
+            ids = self.name2ids.get(node)
+            if not ids:
+                raise KeyError(node)
+            if len(ids) > 1:
+                raise ValueError(f"Ambiguous node name: {node}")
+            return ids[0]
+        return self.node2id[node]
+
+    def lca_id(self, u, v):
+        """LCA id of node ids `u` and `v`."""
+        if u == v:
+            return u
+        start, end = min(u, v) + 1, max(u, v) + 1
+        k = (end - start).bit_length() - 1
+        left = self.table[k][start]
+        right = self.table[k][end - (1 << k)]
+        return int(self.parents[left if self.depths[left] <= self.depths[right] else right])
+
+    def lca_ids(self, u, v):
+        """LCA ids of the arrays of node ids `u` and `v`."""
+        u, v = np.asarray(u), np.asarray(v)
+        start = np.minimum(u, v) + 1
+        end = np.maximum(u, v) + 1
+        # u == v is its own LCA, the range (u, v] is empty
+        same = start >= end
+        start = np.where(same, end - 1, start)
+        level = np.floor(np.log2(end - start)).astype(np.int32)
+        width = 1 << level
+
+        result = np.empty(start.shape, dtype=np.int32)
+        for k in np.unique(level):
+            selected = level == k
+            left = self.table[k][start[selected]]
+            right = self.table[k][end[selected] - width[selected]]
+            shallowest = np.where(self.depths[left] <= self.depths[right], left, right)
+            result[selected] = self.parents[shallowest]
+        return np.where(same, np.minimum(u, v), result)
+
+    def lca(self, u, v):
+        """Lowest common ancestor of two nodes (or node names)."""
+        return self.nodes[self.lca_id(self.resolve(u), self.resolve(v))]
+
+    def common_ancestor(self, nodes):
+        """Most recent common ancestor of `nodes` (nodes or node names)."""
+        ids = [self.resolve(node) for node in nodes]
+        if not ids:
+            raise ValueError("No common ancestor for nodes: []")
+        return self.nodes[self.lca_id(min(ids), max(ids))]
+
+    def shared_path_length(self, u, v):
+        """Branch length from the root to the LCA of two nodes (or node names)."""
+        return float(self.root_distances[self.lca_id(self.resolve(u), self.resolve(v))])
+
+    def path_length(self, u, v):
+        """Branch length of the path between two nodes (or node names)."""
+        u, v = self.resolve(u), self.resolve(v)
+        lca = self.lca_id(u, v)
+        return float(self.root_distances[u] + self.root_distances[v] - 2 * self.root_distances[lca])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import time
+
+# Column type inference of metadata tables.
+#
+# A column is list if any value holds a comma, bool if all its values are
+# one true and one false representation, float if all of them parse as
+# numbers and str otherwise. The checks are made on the distinct values of
+# every batch in one pass, so categorical columns cost one set construction.
+# Once a check fails it is never made again: after the first rows of a
+# column, confirming its type over the remaining rows usually takes one or
+# two cheap checks. Types can also be inferred from a sample of the first
+# rows only.
+
+SAMPLE_SIZE = 10000
+LIST_SEPARATOR = ','
+
+TRUE_VALUES = {'true', 't', 'yes', 'y', '1'}
+FALSE_VALUES = {'false', 'f', 'no', 'n', '0'}
+IGNORE_VALUES = {'nan', 'none', ''}
+
+def is_float(values):
+    """Whether all `values` parse as floats."""
+    try:
+        for _ in map(float, values):
+            pass
+    except ValueError:
+        return False
+    return True
+
+class ColumnType:
+    """Incrementally inferred type (list, bool, float or str) of one column."""
+    def __init__(self):
+        self.is_list = False
+        self.is_bool = True
+        self.is_float = True
+        self.true_representations = set()
+        self.false_representations = set()
+        self.seen = 0
+        self.elapsed = 0.0
+
+    def update(self, values):
+        start = time.perf_counter()
+        self.seen += len(values)
+        if values and not self.is_list:
+            if self.is_bool or self.is_float:
+                self.check(set(values))
+            elif LIST_SEPARATOR in '\n'.join(values):
+                self.is_list = True
+        self.elapsed += time.perf_counter() - start
+        return self
+
+    def check(self, distinct):
+        if LIST_SEPARATOR in '\n'.join(distinct):
+            self.is_list = True
+            return
+        if self.is_bool:
+            for value in distinct:
+                str_val = value.strip()
+                lower = str_val.lower()
+                if lower in IGNORE_VALUES:
+                    continue
+                if lower in TRUE_VALUES:
+                    self.true_representations.add(str_val)
+                elif lower in FALSE_VALUES:
+                    self.false_representations.add(str_val)
+                else:
+                    self.is_bool = False
+                    break
+            if len(self.true_representations) > 1 or len(self.false_representations) > 1:
+                self.is_bool = False
+        if self.is_float and not self.is_bool:
+            self.is_float = is_float(distinct)
+        elif self.is_float:
+            # only the values that are not bool representations may fail
+            self.is_float = is_float(self.true_representations | self.false_representations | {
+                value for value in distinct if value.strip().lower() in IGNORE_VALUES})
+
+    @property
+    def dtype(self):
+        if self.is_list:
+            return list
+        if self.is_bool:
+            return bool
+        if self.is_float:
+            return float
+        return str
+
+class TypeInference:
+    """
+    Types of the columns of a table, fed batch by batch. All values confirm
+    the inferred types unless `confirm` is False, in which case only the
+    first `sample_size` values of every column are used.
+    """
+    def __init__(self, sample_size=SAMPLE_SIZE, confirm=True):
+        self.sample_size = sample_size
+        self.confirm = confirm
+        self.columns = {}
+
+    def add_column(self, prop):
+        return self.columns.setdefault(prop, ColumnType())
+
+    def update(self, prop, values):
+        column = self.add_column(prop)
+        if not self.confirm:
+            budget = self.sample_size - column.seen
+            if budget <= 0:
+                return
+            values = values[:budget]
+        column.update(values)
+
+    def dtypes(self):
+        """Inferred type of every column, as {prop: type}."""
+        return {prop: column.dtype for prop, column in self.columns.items()}
+
+    def timings(self):
+        """Seconds spent inferring the type of every column, as {prop: seconds}."""
+        return {prop: column.elapsed for prop, column in self.columns.items()}
+
+def infer_dtype(values):
+    """Type (list, bool, float or str) of a column from all its values."""
+    return ColumnType().update(list(values)).dtype
@@ -1,5 +1,7 @@
 from __future__ import annotations
 from treeprofiler.src import ete_format
+from treeprofiler.src.query import compile_query, prune
+from treeprofiler.src import prop_cache
 from ete4.parser.newick import NewickError
 from ete4.core.operations import remove
 from ete4 import Tree, PhyloTree
@@ -17,23 +19,12 @@ from scipy import stats
 import numbers
 import random
 import colorsys
-import operator
 import math
 import Bio
 import re
 import sys, os
 from io import StringIO
 
-# conditional syntax calling
-operator_dict = {
-                '<':operator.lt,
-                '<=':operator.le,
-                '=':operator.eq,
-                '!=':operator.ne,
-                '>':operator.gt,
-                '>=':operator.ge,
-                }
-
 _true_set = {'yes', 'true', 't', 'y', '1'}
 _false_set = {'no', 'false', 'f', 'n', '0'}
 
@@ -72,62 +63,6 @@ def check_nan(value):
     except ValueError:
         return False
 
-def counter_call(node, internal_prop, leaf_prop, datatype, operator_string, right_value):
-    pair_delimiter = "--"
-    item_seperator = "||"
-    if datatype == str:
-        counter_props = node.props.get(internal_prop)
-            
-        if counter_props:
-            counter_datas = counter_props.split(item_seperator)
-            for counter_data in counter_datas:
-                k, v = counter_data.split(pair_delimiter)
-                if k == leaf_prop:
-                    left_value = float(v)
-                    return operator_dict[operator_string](left_value, float(right_value))
-                else:
-                    pass
-        else:    
-            return False
-        
-    else:
-        return False
-
-def call(node, prop, datatype, operator_string, right_value):
-    num_operators = [ '<', '<=', '>', '>=' ] 
-    if datatype == str or datatype is None:
-        if operator_string in num_operators:
-            return False
-        elif operator_string == 'contains':
-            left_value = node.props.get(prop)
-            if left_value:
-                return right_value in left_value 
-        elif operator_string == 'in':
-            left_value = right_value
-            right_value = node.props.get(prop)
-            if right_value:
-                return left_value in right_value 
-        else:
-            left_value = node.props.get(prop)
-            if left_value:
-                return operator_dict[operator_string](left_value, right_value)
-    
-    elif datatype == float:
-        left_value = node.props.get(prop)
-        if left_value:
-            return operator_dict[operator_string](float(left_value), float(right_value))
-        else:
-            return False
-    
-    elif datatype == list:
-        if operator_string in num_operators:
-            return False
-        elif operator_string == 'contains':
-            left_value = node.props.get(prop)
-            if left_value:
-                return right_value in left_value 
-        
-
 def to_code(condition_strings):
     conditional_output = []
     operators = [ '<', '<=', '>', '>=', '=', '!=', 'contains'] 
@@ -234,10 +169,21 @@ def merge_dictionaries(dict1, dict2):
 class TreeFormatError(Exception):
     pass
 
-def validate_tree(tree_path, input_type, internal_parser=None):
+def validate_tree(tree_path, input_type, internal_parser=None, props=None):
+    """
+    Load a tree in ete (binary columnar or text) or newick format. For binary
+    ete files, `props` restricts the decoded properties, see ete_format.load.
+    """
     tree = None  # Initialize tree to None
     eteformat_flag = False
-    if input_type in ['ete', 'auto']:
+    if input_type in ['ete', 'auto'] and ete_format.is_columnar(tree_path):
+        try:
+            tree = ete_format.load(tree_path, props=props)
+            eteformat_flag = True
+        except Exception as e:
+            raise TreeFormatError(f"Error loading tree in 'ete' format: {e}")
+
+    if input_type in ['ete', 'auto'] and tree is None:
         try:
             with open(tree_path, 'r') as f:
                 file_content = f.read()
@@ -325,49 +271,13 @@ def taxatree_prune(tree, rank_limit='subspecies'):
                     for ch in children:
                         print("prune", ch.name)
                         remove(ch)
+    prop_cache.invalidate(tree)
     return tree, taxon2values
 
 def conditional_prune(tree, conditions_input, prop2type):
-    conditional_output = []
-    single_one = to_code(conditions_input)
-    conditional_output.append(single_one)
-
-    ex = False
-    while not ex:
-        ex = True
-        for n in tree.traverse():
-            if not n.is_root:
-                final_call = False
-                for or_condition in conditional_output:
-                    for condition in or_condition:
-                        op = condition[1]
-                        if op == 'in':
-                            value = condition[0]
-                            prop = condition[2]
-                            datatype = prop2type.get(prop)
-                            final_call = call(n, prop, datatype, op, value)
-                        elif ":" in condition[0]:
-                            internal_prop, leaf_prop = condition[0].split(':')
-                            value = condition[2]
-                            datatype = prop2type[internal_prop]
-                            final_call = counter_call(n, internal_prop, leaf_prop, datatype, op, value)
-                        else:
-                            prop = condition[0]
-                            value = condition[2]
-                            datatype = prop2type.get(prop)
-                            final_call = call(n, prop, datatype, op, value)
-                        if final_call == False:
-                            break
-                        else:
-                            continue
-                    if final_call:
-                        n.detach()
-                        ex = False
-                    else:
-                        pass
-            # else:
-            #     if n.dist == 0: 
-            #         n.dist = 1
+    query = compile_query(to_code(conditions_input), prop2type)
+    prune(tree, query)
+    prop_cache.invalidate(tree)
     return tree
 
 # def _tree_prop_array(node, prop, leaf_only=False, numeric=False, list_type=False):
@@ -433,6 +343,11 @@ def conditional_prune(tree, conditions_input, prop2type):
 #     return array
 
 def tree_prop_array(node, prop, leaf_only=False, numeric=False, list_type=False):
+    # served from the property columns of a tree being plotted
+    cache = prop_cache.lookup(node)
+    if cache is not None:
+        return cache.prop_array(prop, leaf_only=leaf_only, numeric=numeric, list_type=list_type)
+
     array = []
     list_sep = '||'
     
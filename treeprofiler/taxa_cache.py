@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import sys
+import time
+import logging
+
+from treeprofiler.src import taxonomy
+
+DESC = "manage the taxonomy database cache"
+
+logger = logging.getLogger(__name__)
+
+def populate_cache_args(parser):
+    parser.add_argument('--cache-dir', default=None,
+        help=f"cache directory [default: ${taxonomy.CACHE_DIR_ENV} or ~/.cache/treeprofiler]")
+    subparser = parser.add_subparsers(title="AVAILABLE ACTIONS", dest='action')
+
+    subparser.add_parser('list', description='list the cached taxonomy databases')
+
+    prune_args_p = subparser.add_parser('prune', description='remove cached taxonomy databases')
+    prune_args_p.add_argument('checksums', nargs='*',
+        help="checksums (or their prefixes) of the databases to remove")
+    prune_args_p.add_argument('--keep', type=int, default=None,
+        help="keep only the N most recently used databases")
+    prune_args_p.add_argument('--older-than', type=float, default=None,
+        help="remove the databases not used for DAYS days")
+    prune_args_p.add_argument('--all', action='store_true',
+        help="remove every cached database")
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}TB'
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+def run(args):
+    if args.action == 'list':
+        databases = taxonomy.list_databases(args.cache_dir)
+        if not databases:
+            print(f"No cached taxonomy databases in {taxonomy.databases_dir(args.cache_dir)}")
+        for info in databases:
+            print(info['checksum'][:12], info['taxadb'], format_size(info['size']),
+                f"last used {format_time(info['last_used'])}", info['dump'], sep='\t')
+
+    elif args.action == 'prune':
+        if args.all:
+            removed = taxonomy.prune_databases(args.cache_dir, keep=0)
+        elif args.checksums or args.keep is not None or args.older_than is not None:
+            removed = taxonomy.prune_databases(args.cache_dir, keep=args.keep,
+                older_than=args.older_than, checksums=args.checksums or None)
+        else:
+            logger.error("Please specify which databases to prune: checksums, --keep, --older-than or --all")
+            sys.exit(1)
+        for info in removed:
+            print(f"Removed {info['checksum'][:12]}\t{info['taxadb']}\t{info['dump']}")
+        print(f"Freed {format_size(sum(info['size'] for info in removed))}")
+
+    else:
+        logger.error("Please specify an action: list or prune")
+        sys.exit(1)
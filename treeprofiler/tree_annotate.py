@@ -6,7 +6,6 @@ import sys
 import time
 import random
 import csv
-import tarfile
 
 from collections import defaultdict, Counter
 import itertools
@@ -15,16 +14,27 @@ from scipy import stats
 import requests
 
 from ete4.parser.newick import NewickError
-from ete4 import SeqGroup
 from ete4 import Tree, PhyloTree
-from ete4.phylo.evolevents import EvolEvent
 from ete4 import GTDBTaxa
 from ete4 import NCBITaxa
 
 from treeprofiler.src import utils
-from treeprofiler.src.phylosignal import run_acr_discrete, run_acr_continuous, run_delta
+from treeprofiler.src.phylosignal import run_acr_discrete, run_acr_continuous, run_delta, DELTA_CHAINS
 from treeprofiler.src.ls import run_ls
 from treeprofiler.src import ete_format
+from treeprofiler.src import summary
+from treeprofiler.src import leaf_table
+from treeprofiler.src.tree_index import TreeIndex, LCAIndex
+from treeprofiler.src import permutation
+from treeprofiler.src import metadata_reader
+from treeprofiler.src import data_matrix
+from treeprofiler.src import consensus
+from treeprofiler.src.alignment_store import AlignmentStore
+from treeprofiler.src import domain_table
+from treeprofiler.src import taxonomy
+from treeprofiler.src.taxonomy import TaxonomyResolver
+from treeprofiler.src import species_overlap
+from treeprofiler.src import type_inference
 
 from multiprocessing import Pool
 
@@ -56,7 +66,7 @@ DISCRETE_METHODS = ['MPPA', 'MAP', 'JOINT', 'DOWNPASS', 'ACCTRAN', 'DELTRAN', 'C
 DISCRETE_MODELS = ['JC', 'F81', 'EFT']
 
 # Continuous traits
-CONTINUOUS_METHODS = ['ML', 'BAYESIAN']
+CONTINUOUS_METHODS = ['ML', 'BAYESIAN', 'PRUNING']
 CONTINUOUS_MODELS = ['BM', 'OU']
 
 # Set up the logger with INFO level by default
@@ -80,12 +90,18 @@ def populate_annotate_args(parser):
     #     help="<metadata.csv> .csv, .tsv. optional input")
     add('--data-matrix',  nargs='+',
         help="<datamatrix.csv> .csv, .tsv. matrix data metadata table as array to tree, please do not provide column headers in this file")
+    add('--data-matrix-dtype', default='float64', choices=['float64', 'float32'],
+        help="float type used to load --data-matrix, float32 halves the memory [default: float64]")
+    add('--data-matrix-cache', action='store_true',
+        help="save each --data-matrix as a .npy file next to it and memory-map it on later runs instead of parsing it again")
     add('-s', '--metadata-sep', default='\t',
         help="column separator of metadata table [default: \\t]")
     add('--no-headers', action='store_true',
         help="metadata table doesn't contain columns name, namespace col+index will be assigned as the key of property such as col1.")
     add('--duplicate', action='store_true',
         help="treeprofiler will aggregate duplicated metadata to a list as a property if metadata contains duplicated row")
+    add('--type-sample-size', type=int, default=None,
+        help="infer the data type of each column from its first N values only, instead of confirming it over all rows [default: all rows]")
     add('--text-prop', nargs='+',
         help=("<col1> <col2> names, column index or index range of columns which "
               "need to be read as categorical data"))
@@ -128,6 +144,8 @@ def populate_annotate_args(parser):
         help="field of taxa name after delimiter. [default: 0]")
     add('--ignore-unclassified', action='store_true',
         help="Ignore unclassified taxa in taxonomic annotation")
+    add('--taxa-cache', action='store_true',
+        help="keep resolved NCBI taxid ranks and names on disk (in $TREEPROFILER_CACHE_DIR or ~/.cache/treeprofiler) for later runs")
     add('--sos-thr', type=float, default=0.0,
         help="Threshold for species overlap in evolutionary events [default: 0.0]")
     add('--emapper-annotations',
@@ -142,6 +160,8 @@ def populate_annotate_args(parser):
         type=float, 
         default=0.7,
         help='Consensus cutoff for alignment annotation. If cutoff is 0.0 means no consensus sequences in ancestor nodes. [default: 0.7]')
+    add('--alignment-cache', action='store_true',
+        help="save the --alignment as .npy files next to it and memory-map them on later runs instead of reading the fasta again")
     annotation_group = parser.add_argument_group(title='Internal nodes annotation arguments',
         description="Annotation parameters")
     annotation_group.add_argument('--column-summary-method', 
@@ -232,6 +252,10 @@ def populate_annotate_args(parser):
         type=int, 
         default=100, 
         help='Burned-in iterates.')
+    delta_group.add_argument('--delta-chains', 
+        type=int, 
+        default=DELTA_CHAINS, 
+        help=f'Number of MCMC chains advanced together, the kept iterates are split between them. [default: {DELTA_CHAINS}]')
     ls_group = parser.add_argument_group(title='Lineage Specificity Analysis arguments',
         description="ls parameters")
     ls_group.add_argument('--prec-cutoff',
@@ -263,15 +287,15 @@ def populate_annotate_args(parser):
 def run_tree_annotate(tree, input_annotated_tree=False,
         metadata_dict={}, node_props=[], columns={}, prop2type={},
         text_prop=[], text_prop_idx=[], multiple_text_prop=[], num_prop=[], num_prop_idx=[],
-        bool_prop=[], bool_prop_idx=[], prop2type_file=None, alignment=None, consensus_cutoff=0.7,
+        bool_prop=[], bool_prop_idx=[], prop2type_file=None, alignment=None, consensus_cutoff=0.7, alignment_cache=False,
         emapper_mode=False, emapper_pfam=None, emapper_smart=None, 
         counter_stat='raw', num_stat='all', column2method={},
         taxadb='GTDB', gtdb_version=None, taxa_dump=None, taxon_column=None,
-        taxon_delimiter='', taxa_field=0, ignore_unclassified=False,
+        taxon_delimiter='', taxa_field=0, ignore_unclassified=False, taxa_cache=False,
         sos_thr=0.0, rank_limit=None, pruned_by=None, 
         acr_discrete_columns=[], acr_continuous_columns=[], prediction_method="MPPA", model="F81", 
         delta_stats=False, ent_type="SE", 
-        iteration=100, lambda0=0.1, se=0.5, thin=10, burn=100, 
+        iteration=100, lambda0=0.1, se=0.5, thin=10, burn=100, delta_chains=DELTA_CHAINS, 
         ls_columns=None, prec_cutoff=0.95, sens_cutoff=0.95, 
         threads=1, outdir='./'):
 
@@ -400,9 +424,10 @@ def run_tree_annotate(tree, input_annotated_tree=False,
     # alignment annotation
     if alignment:
         alignment_prop = 'alignment'
-        name2seq = parse_fasta(alignment)
+        if not isinstance(alignment, AlignmentStore):
+            alignment = AlignmentStore(alignment, cache=alignment_cache)
         for leaf in tree.leaves():
-            leaf.add_prop(alignment_prop, name2seq.get(leaf.name,''))
+            leaf.add_prop(alignment_prop, alignment.get(leaf.name, ''))
         prop2type.update({
             alignment_prop:str
             })
@@ -485,7 +510,7 @@ def run_tree_annotate(tree, input_annotated_tree=False,
                 logger.info(f"Performing Delta Statistic analysis with Character {acr_discrete_columns}...\n")
                 prop2delta = run_delta(acr_results, annotated_tree, ent_type=ent_type, 
                 lambda0=lambda0, se=se, sim=iteration, burn=burn, thin=thin, 
-                threads=threads)
+                threads=threads, chains=delta_chains)
 
                 for prop, delta_result in prop2delta.items():
                     logger.info(f"Delta statistic of {prop} is: {delta_result}")
@@ -510,7 +535,7 @@ def run_tree_annotate(tree, input_annotated_tree=False,
                 prop2delta_array = get_pval(prop2array, dump_tree, acr_discrete_columns_dict, \
                     iteration=100, prediction_method=prediction_method, model=model,
                     ent_type=ent_type, lambda0=lambda0, se=se, sim=iteration, burn=burn, thin=thin, 
-                    threads=threads)
+                    threads=threads, chains=delta_chains, observed_deltas=prop2delta)
 
                 for prop, delta_array in prop2delta_array.items():
                     p_value = np.sum(np.array(delta_array) > prop2delta[prop]) / len(delta_array)
@@ -603,32 +628,28 @@ def run_tree_annotate(tree, input_annotated_tree=False,
             prop2type[utils.add_suffix(prop, column2method[prop])] = float
 
     if not input_annotated_tree:
-        node2leaves = annotated_tree.get_cached_content()
-
-        # Prepare data for all nodes
-        nodes_data = []
-        nodes = []
-
-        for node in annotated_tree.traverse("postorder"):
-            if not node.is_leaf:
-                nodes.append(node)
-                node_data = (node, node2leaves[node], text_prop, multiple_text_prop, bool_prop, num_prop, acr_discrete_columns, column2method, alignment if 'alignment' in locals() else None, name2seq if 'name2seq' in locals() else None, consensus_cutoff, emapper_mode)
-                nodes_data.append(node_data)
-        
-        # Process nodes in parallel if more than one thread is specified
+        # Summarize leaf annotations into internal nodes in one postorder pass,
+        # split by clades over a shared memory leaf table if more than one thread is specified
+        summary_options = dict(text_prop=text_prop, multiple_text_prop=multiple_text_prop,
+            bool_prop=bool_prop, num_prop=num_prop, column2method=column2method,
+            acr_discrete_columns=acr_discrete_columns, emapper_mode=emapper_mode)
         if threads > 1:
-            with Pool(threads) as pool:
-                results = pool.map(process_node, nodes_data)
+            merged_annotations = leaf_table.parallel_merge_annotations(annotated_tree, threads=threads, **summary_options)
         else:
-            # For single-threaded execution, process nodes sequentially
-            results = map(process_node, nodes_data)
-
-        # Integrate the results back into tree
-        for node, result in zip(nodes, results):
-            internal_props, consensus_seq = result
-            for key, value in internal_props.items():
-                node.add_prop(key, value)
-            if consensus_seq:
+            merged_annotations = summary.merge_annotations(annotated_tree, **summary_options)
+        try:
+            for node, internal_props in merged_annotations:
+                for key, value in internal_props.items():
+                    node.add_prop(key, value)
+        except ValueError as e:
+            logger.error(e)
+            sys.exit(1)
+
+        # Generate consensus sequences of internal nodes from bottom-up residue profiles
+        if alignment and consensus_cutoff:
+            encoded_alignment = consensus.EncodedAlignment.from_store(alignment)
+            tree_index = TreeIndex(annotated_tree)
+            for node, consensus_seq in consensus.clade_consensus(tree_index, encoded_alignment, threshold=consensus_cutoff):
                 node.add_prop(alignment_prop, consensus_seq)
 
     else:
@@ -645,6 +666,8 @@ def run_tree_annotate(tree, input_annotated_tree=False,
             logger.error('Please specify which taxa db using --taxadb <GTDB|NCBI>')
             sys.exit(1)
         else:
+            # dumps are imported once into the taxonomy cache and reused afterwards
+            taxa_dbfile = None
             if taxadb == 'GTDB':
                 if gtdb_version and taxa_dump:
                     logger.error('Please specify either GTDB version or taxa dump file, not both.')
@@ -653,10 +676,10 @@ def run_tree_annotate(tree, input_annotated_tree=False,
                     # get taxadump from ete-data
                     gtdbtaxadump = get_gtdbtaxadump(gtdb_version)
                     logger.info(f"Loading GTDB database dump file {gtdbtaxadump}...")
-                    GTDBTaxa().update_taxonomy_database(gtdbtaxadump)
+                    taxa_dbfile = taxonomy.cached_database(taxadb, gtdbtaxadump)
                 elif taxa_dump:
                     logger.info(f"Loading GTDB database dump file {taxa_dump}...")
-                    GTDBTaxa().update_taxonomy_database(taxa_dump)
+                    taxa_dbfile = taxonomy.cached_database(taxadb, taxa_dump)
                 else:
                     logger.info("No specific version or dump file provided; using latest GTDB data...")
                     GTDBTaxa().update_taxonomy_database()
@@ -666,21 +689,21 @@ def run_tree_annotate(tree, input_annotated_tree=False,
                     sys.exit(1)
                 if taxa_dump:
                     logger.info(f"Loading GTDB database dump file {taxa_dump}...")
-                    GTDBTaxa().update_taxonomy_database(taxa_dump)
+                    taxa_dbfile = taxonomy.cached_database(taxadb, taxa_dump)
                 else:
                     logger.info("No specific version or dump file provided; using latest GTDB data...")
                     motus_dump = download_motus_dump()
-                    GTDBTaxa().update_taxonomy_database(motus_dump)
+                    taxa_dbfile = taxonomy.cached_database(taxadb, motus_dump)
             elif taxadb == 'NCBI':
                 if taxa_dump:
                     logger.info(f"Loading NCBI database dump file {taxa_dump}...")
-                    NCBITaxa().update_taxonomy_database(taxa_dump)
+                    taxa_dbfile = taxonomy.cached_database(taxadb, taxa_dump)
                 # else:
                 #     NCBITaxa().update_taxonomy_database()
 
             annotated_tree, rank2values = annotate_taxa(annotated_tree, db=taxadb, \
                     taxid_attr=taxon_column, sp_delimiter=taxon_delimiter, sp_field=taxa_field, \
-                    ignore_unclassified=ignore_unclassified)
+                    ignore_unclassified=ignore_unclassified, taxa_cache=taxa_cache, dbfile=taxa_dbfile)
                 
         # evolutionary events annotation
         annotated_tree = annotate_evol_events(annotated_tree, taxid_attr=taxon_column, sos_thr=sos_thr, sp_delimiter=taxon_delimiter, sp_field=taxa_field)
@@ -706,33 +729,30 @@ def run_tree_annotate(tree, input_annotated_tree=False,
 
 
 def run_array_annotate(tree, array_dict, num_stat='none', column2method={}, prop2type={}):
-    matrix_props = list(array_dict.keys())
+    prop2matrix = {prop: matrix if isinstance(matrix, data_matrix.DataMatrix) else data_matrix.DataMatrix.from_dict(matrix)
+                   for prop, matrix in array_dict.items()}
     # annotate to the leaves
     start = time.time()
-    for node in tree.traverse():
-        if node.is_leaf:
-            for filename, array in array_dict.items():
-                if array.get(node.name):
-                    node.add_prop(filename, array.get(node.name))
-
-    # merge annotations to internal nodes
-    for node in tree.traverse():
-        if not node.is_leaf:
-            for prop in matrix_props:
-                
-                # get the array from the children leaf nodes
-                arrays = [child.get_prop(prop) for child in node.leaves() if child.get_prop(prop) is not None]
-                
-                if column2method.get(prop) is not None:
-                    num_stat = column2method.get(prop)
+    for leaf in tree.leaves():
+        for prop, matrix in prop2matrix.items():
+            values = matrix.get(leaf.name)
+            if values:
+                leaf.add_prop(prop, values)
+
+    # merge annotations to internal nodes, bottom-up over the matrix rows
+    tree_index = TreeIndex(tree)
+    for prop, matrix in prop2matrix.items():
+        prop_stat = column2method.get(prop, num_stat)
+        if prop_stat == 'none' or matrix.n_columns == 0:
+            continue
+        if prop_stat != 'all' and prop_stat not in data_matrix.MATRIX_STATS:
+            logger.error(f"Unsupported stat '{prop_stat}'. Supported stats are 'avg', 'max', 'min', 'sum', 'std', or 'all'.")
+            sys.exit(1)
 
-                stats = compute_matrix_statistics(arrays, num_stat=num_stat)
-                
-                if stats:
-                    for stat, value in stats.items():
-                        
-                        node.add_prop(utils.add_suffix(prop, stat), value.tolist())
-                        prop2type[utils.add_suffix(prop, stat)] = list
+        for node, stats in data_matrix.clade_stats(tree_index, matrix):
+            for stat, value in data_matrix.stats_values(stats, prop_stat).items():
+                node.add_prop(utils.add_suffix(prop, stat), value.tolist())
+                prop2type[utils.add_suffix(prop, stat)] = list
     end = time.time()
     logger.info(f'Time for run_array_annotate to run: {end - start}')
     return tree
@@ -804,7 +824,8 @@ def run(args):
     # parsing metadata
     if args.metadata: # make a series of metadatas
         metadata_dict, node_props, columns, metadata_prop2type = parse_csv(args.metadata, delimiter=args.metadata_sep, \
-        no_headers=args.no_headers, duplicate=args.duplicate, target_nodes=node_names)
+        no_headers=args.no_headers, duplicate=args.duplicate, target_nodes=node_names,
+        type_sample_size=args.type_sample_size)
         
         prop2type.update(metadata_prop2type)
     else: # annotated_tree
@@ -812,7 +833,8 @@ def run(args):
         columns = {}
     
     if args.data_matrix:
-        array_dict = parse_tsv_to_array(args.data_matrix, delimiter=args.metadata_sep)
+        array_dict = parse_tsv_to_array(args.data_matrix, delimiter=args.metadata_sep,
+            dtype=np.dtype(args.data_matrix_dtype), cache=args.data_matrix_cache)
     end = time.time()
     logger.info(f'Time for parse_csv to run: {end - start}')
     
@@ -879,6 +901,7 @@ def run(args):
         "se": args.se,
         "thin": args.thin,
         "burn": args.burn,
+        "delta_chains": args.delta_chains,
         "ls_columns": args.ls_columns,
         "prec_cutoff": args.prec_cutoff,
         "sens_cutoff": args.sens_cutoff,
@@ -893,6 +916,7 @@ def run(args):
         "taxon_delimiter": args.taxon_delimiter,
         "taxa_field": args.taxa_field,
         "ignore_unclassified": args.ignore_unclassified,
+        "taxa_cache": args.taxa_cache,
         "sos_thr": args.sos_thr,
     }
 
@@ -907,6 +931,7 @@ def run(args):
     alignment_options = {
         "alignment": args.alignment,
         "consensus_cutoff": args.consensus_cutoff,
+        "alignment_cache": args.alignment_cache,
     }
 
     # Group output and miscellaneous options
@@ -953,8 +978,7 @@ def run(args):
                 f.write("{}\t{}\n".format(key, value.__name__))
 
         ### out ete
-        with open(os.path.join(args.outdir, base+'_annotated.ete'), 'w') as f:
-            f.write(ete_format.dumps(annotated_tree, encoder='pickle', pack=False))
+        ete_format.dump(annotated_tree, os.path.join(args.outdir, base+'_annotated.ete'))
 
         ### out tsv
         prop_keys = list(prop2type.keys())
@@ -1033,108 +1057,79 @@ def check_missing(input_string):
         return False
 
 
-def check_tar_gz(file_path):
-    try:
-        with tarfile.open(file_path, 'r:gz') as tar:
-            return True
-    except tarfile.ReadError:
-        return False
-
-
-
-def parse_csv(input_files, delimiter='\t', no_headers=False, duplicate=False, target_nodes=set()):
+def parse_csv(input_files, delimiter='\t', no_headers=False, duplicate=False, target_nodes=set(),
+        chunk_size=metadata_reader.CHUNK_SIZE, type_sample_size=None):
     """
     Parses metadata and filters nodes based on `target_nodes`.
-    Handles metadata with varying fields efficiently.
+    Files are streamed in chunks of `chunk_size` characters, rows of other
+    nodes are dropped before being split and column types are inferred
+    incrementally, so memory only grows with the kept rows. Types are
+    confirmed over all kept rows, or only inferred from the first
+    `type_sample_size` values of every column when given.
     
     Returns:
     - metadata: dict {nodename: {property: value(s)}}
     - node_props: list of unique column names
-    - columns: dict {property: list of values}
+    - columns: mapping {property: list of values}, gathered from metadata on lookup
     - prop2type: dict {property: inferred data type}
     """
     metadata = defaultdict(dict)
-    columns = defaultdict(list)
-    prop2type = {}
+    props = {}
+    if type_sample_size:
+        inference = type_inference.TypeInference(sample_size=type_sample_size, confirm=False)
+    else:
+        inference = type_inference.TypeInference()
 
     # Convert target_nodes to set for fast lookup
     if target_nodes is not None and not isinstance(target_nodes, set):
         target_nodes = set(target_nodes)
 
-    def update_metadata(reader, node_header):
-        for row in reader:
-            if row[node_header].startswith('##'):
-                continue  # Skip commented lines
-
-            nodename = row[node_header]
-            del row[node_header]
-
-            # Skip nodes that are not in target_nodes
-            if target_nodes and nodename not in target_nodes:
-                continue  
-
-            # Remove missing values
-            row = {k: v for k, v in row.items() if not check_missing(v)}
-
-            if nodename not in metadata:
-                metadata[nodename] = defaultdict(list) if duplicate else {}
-
-            for prop, value in row.items():
-                if duplicate:
-                    metadata[nodename][prop].append(value)
-                else:
-                    metadata[nodename][prop] = value
-                columns[prop].append(value)
-            
-    def update_prop2type(node_props):
-        for prop in node_props:
-            if set(columns[prop]) == {'NaN'}:
-                prop2type[prop] = str
-            else:
-                prop2type[prop] = infer_dtype(columns[prop])
-
     for input_file in input_files:
-        if check_tar_gz(input_file):
-            with tarfile.open(input_file, 'r:gz') as tar:
-                for member in tar.getmembers():
-                    if member.isfile() and member.name.endswith('.tsv'):
-                        with tar.extractfile(member) as tsv_file:
-                            tsv_text = tsv_file.read().decode('utf-8').splitlines()
-                            tsv_text = [line for line in tsv_text if not line.startswith('##')]
-
-                            if no_headers:
-                                fields_len = len(tsv_text[0].split(delimiter))
-                                headers = [f'col{i}' for i in range(fields_len)]
-                                reader = csv.DictReader(tsv_text, delimiter=delimiter, fieldnames=headers)
-                            else:
-                                reader = csv.DictReader(tsv_text, delimiter=delimiter)
-                                headers = reader.fieldnames
-
-                            node_header, node_props = headers[0], headers[1:]
-                            update_metadata(reader, node_header)
-
-                        update_prop2type(node_props)
-
-        else:
-            with open(input_file, 'r') as f:
-                lines = f.readlines()
-
-            lines = [line for line in lines if not line.startswith('##')]
+        for stream in metadata_reader.open_tables(input_file):
+            headers, batches = metadata_reader.iter_rows(stream, delimiter=delimiter,
+                no_headers=no_headers, target_nodes=target_nodes, chunk_size=chunk_size)
+            node_props = headers[1:]
+            for prop in node_props:
+                inference.add_column(prop)
+
+            for batch in batches:
+                prop2values = defaultdict(list)
+                for fields in batch:
+                    nodename = fields[0]
+                    # Skip nodes that are not in target_nodes
+                    if target_nodes and nodename not in target_nodes:
+                        continue
+
+                    if nodename not in metadata:
+                        metadata[nodename] = defaultdict(list) if duplicate else {}
+                    node_metadata = metadata[nodename]
+
+                    if len(fields) != len(headers):
+                        logger.warning(f"Warning: {len(fields)} fields instead of {len(headers)} in {input_file} for node {nodename}.")
+
+                    for prop, value in zip(node_props, fields[1:]):
+                        # Remove missing values
+                        if check_missing(value):
+                            continue
+                        if duplicate:
+                            node_metadata[prop].append(value)
+                        else:
+                            node_metadata[prop] = value
+                        prop2values[prop].append(value)
 
-            first_line = lines[0].strip()
-            fields_len = len(first_line.split(delimiter))
+                for prop, values in prop2values.items():
+                    props.setdefault(prop, None)
+                    inference.update(prop, values)
 
-            if no_headers:
-                headers = [f'col{i}' for i in range(fields_len)]
-                reader = csv.DictReader(lines, delimiter=delimiter, fieldnames=headers)
-            else:
-                reader = csv.DictReader(lines, delimiter=delimiter)
-                headers = reader.fieldnames
+            # columns without any value are still listed
+            for prop in node_props:
+                props.setdefault(prop, None)
 
-            node_header, node_props = headers[0], headers[1:]
-            update_metadata(reader, node_header)
-            
-            update_prop2type(node_props)
+    prop2type = inference.dtypes()
+    prop2seconds = inference.timings()
+    logger.info(f'Time for type inference to run: {sum(prop2seconds.values())}')
+    for prop, seconds in sorted(prop2seconds.items(), key=lambda item: item[1], reverse=True):
+        logger.debug(f'Time for type inference of {prop}: {seconds}')
 
     # Convert lists back to strings at the end
     if duplicate:
@@ -1142,41 +1137,23 @@ def parse_csv(input_files, delimiter='\t', no_headers=False, duplicate=False, ta
             for prop in metadata[nodename]:
                 metadata[nodename][prop] = ','.join(metadata[nodename][prop])
                 prop2type[prop] = list
-                
-    return metadata, list(columns.keys()), columns, prop2type
 
-def parse_tsv_to_array(input_files, delimiter='\t', no_headers=True):
+    return metadata, list(props), metadata_reader.MetadataColumns(metadata, props), prop2type
+
+def parse_tsv_to_array(input_files, delimiter='\t', no_headers=True, dtype=np.float64, cache=False):
     """
-    Parses a TSV file into a dictionary with the first item of each row as the key
-    and the rest of the items in the row as a list in the value.
+    Parses TSV matrix files, with the node name as first item of each row and
+    its values in the rest of the row.
 
-    :param filename: Path to the TSV file to be parsed.
-    :return: A dictionary with keys as the first item of each row and values as lists of the remaining items.
+    :param input_files: Paths to the TSV files to be parsed.
+    :param dtype: float dtype of the loaded matrices.
+    :param cache: Save each matrix as a .npy sidecar and memory-map it on later runs.
+    :return: A dictionary with file names as keys and DataMatrix objects (leaf name to row) as values.
     """
-    is_float = True
     matrix2array = {}
-    
     for input_file in input_files:
-        leaf2array = {}
         prefix = os.path.basename(input_file)
-        with open(input_file, 'r') as file:
-            for line in file:
-                # Split each line by tab, strip removes trailing newline
-                row = line.strip().split(delimiter)
-                node = row[0]  
-                value = row[1:]  # The rest of the items as value
-                # Replace empty string with np.nan
-                value_list = [np.nan if x == '' else x for x in value]
-                try:
-                    np_array = np.array(value_list).astype(np.float64)
-                    leaf2array[node] = np_array.tolist()
-                except ValueError:
-                    # Handle the case where conversion fails
-                    logger.warning(f"Warning: Non-numeric data found in {prefix} for node {node}. Skipping.")
-                    leaf2array[node] = None
-                    is_float = False
-
-        matrix2array[prefix] = leaf2array        
+        matrix2array[prefix] = data_matrix.load_matrix(input_file, delimiter=delimiter, dtype=dtype, cache=cache)
     return matrix2array
 
 def process_column_summary_methods(column_summary_methods):
@@ -1191,12 +1168,6 @@ def process_column_summary_methods(column_summary_methods):
                 sys.exit(1)
     return column_methods
 
-def get_comma_separated_values(lst):
-    for item in lst:
-        if isinstance(item, str) and any(',' in x for x in item.split()):
-            return True
-    return False
-
 def can_convert_to_bool(column):
     true_values = {'true', 't', 'yes', 'y', '1'}
     false_values = {'false', 'f', 'no', 'n', '0'}
@@ -1221,14 +1192,6 @@ def can_convert_to_bool(column):
     return len(true_representations) <= 1 and len(false_representations) <= 1
 
 
-def convert_column_data(column, np_dtype):
-    #np_dtype = np.dtype(dtype).type
-    try:
-        data = np.array(column).astype(np_dtype)
-        return np_dtype
-    except ValueError as e:
-        return None
-
 def convert_to_prop_array(metadata_dict, prop):
     """
     Convert a dictionary of metadata to a structured array format.
@@ -1271,22 +1234,7 @@ def convert_back_to_original(prop2array):
     return metadata_dict
 
 def infer_dtype(column):
-    if get_comma_separated_values(column):
-        return list
-    elif can_convert_to_bool(column):
-        return bool
-    else:
-        dtype_dict = {
-            float:np.float64,
-            str:np.str_
-            }
-        #dtype_order = ['float64', 'str']
-        for dtype, np_dtype in dtype_dict.items():
-            result = convert_column_data(column, np_dtype)
-            if result is not None:
-                # Successful inference, exit from the loop
-                return dtype
-        return None
+    return type_inference.infer_dtype(column)
 
 def load_metadata_to_tree(tree, metadata_dict, prop2type={}, taxon_column=None, taxon_delimiter='', taxa_field=0, ignore_unclassified=False):
     #name2leaf = {}
@@ -1298,6 +1246,8 @@ def load_metadata_to_tree(tree, metadata_dict, prop2type={}, taxon_column=None,
     for node in tree.traverse():
         if node.name:
             name2node[node.name].append(node)
+    # built on the first common ancestor key
+    lca_index = None
 
     # load all metadata to leaf nodes
     for node, props in metadata_dict.items():
@@ -1338,7 +1288,9 @@ def load_metadata_to_tree(tree, metadata_dict, prop2type={}, taxon_column=None,
             if common_ancestor_seperator in node:
                 # get the common ancestor
                 children = node.split(common_ancestor_seperator)
-                target_node = tree.common_ancestor(children)
+                if lca_index is None:
+                    lca_index = LCAIndex(tree)
+                target_node = lca_index.common_ancestor(children)
                 for key,value in props.items():
                     # taxa
                     if key == taxon_column:
@@ -1387,228 +1339,6 @@ def load_metadata_to_tree(tree, metadata_dict, prop2type={}, taxon_column=None,
 
     return tree
 
-def process_node(node_data):
-    node, node_leaves, text_prop, multiple_text_prop, bool_prop, num_prop, acr_discrete_columns, column2method, alignment, name2seq, consensus_cutoff, emapper_mode = node_data
-    internal_props = {}
-
-    # Process text, multitext, bool, and num properties
-    if text_prop:
-        internal_props_text = merge_text_annotations(node_leaves, text_prop, column2method, acr_discrete_columns, emapper_mode=emapper_mode)
-        internal_props.update(internal_props_text)
-
-    if multiple_text_prop:
-        internal_props_multi = merge_multitext_annotations(node_leaves, multiple_text_prop, column2method)
-        internal_props.update(internal_props_multi)
-
-    if bool_prop:
-        internal_props_bool = merge_text_annotations(node_leaves, bool_prop, column2method, acr_discrete_columns, emapper_mode=emapper_mode)
-        internal_props.update(internal_props_bool)
-
-    if num_prop:
-        internal_props_num = merge_num_annotations(node_leaves, num_prop, column2method)
-        if internal_props_num:
-            internal_props.update(internal_props_num)
-        
-    # Generate consensus sequence
-    consensus_seq = None
-    if alignment and name2seq is not None:  # Check alignment and name2seq together
-        aln_sum = column2method.get('alignment')
-        if aln_sum is None or aln_sum != 'none' or consensus_cutoff is not None:
-            if consensus_cutoff != 0:
-                matrix_string = build_matrix_string(node, name2seq)  # Assuming 'name2seq' is accessible here
-                consensus_seq = utils.get_consensus_seq(matrix_string, threshold=consensus_cutoff)
-
-    return internal_props, consensus_seq
-
-def get_top_keys(counter, max_keys=2, separator="||", suffix="..."):
-    """Returns the top keys with the highest counts, sorted, and limited to max_keys, only when tied."""
-    if not counter:
-        return None  # Handle empty counter case
-
-    max_count = max(counter.values())
-    top_keys = sorted([key for key, value in counter.items() if value == max_count])  # Sort alphabetically
-
-    # If only one key has the highest count, return it directly
-    if len(top_keys) == 1:
-        return top_keys[0]
-
-    # If there is a tie, return up to max_keys, adding suffix if needed
-    if len(top_keys) > max_keys:
-        return separator.join(top_keys[:max_keys]) + separator + suffix
-    return separator.join(top_keys)
-
-def merge_text_annotations(nodes, target_props, column2method, acr_discrete_columns=None, emapper_mode=False):
-    pair_separator = "--"
-    item_separator = "||"
-    internal_props = {}
-    counters = {}
-
-    acr_discrete_columns = set(acr_discrete_columns or [])  # Convert once for fast lookup
-
-    for target_prop in target_props:
-        counter_stat = column2method.get(target_prop, "raw")  # Store in local var
-
-        # Collect property values and count occurrences
-        prop_list = utils.children_prop_array_missing(nodes, target_prop)
-        counter = Counter(prop_list)
-        counter.pop('NaN', None)  # Remove 'NaN' efficiently
-
-        # Store the counter result
-        counters[target_prop] = counter
-
-        if counter_stat in {'raw', 'dominant'}:
-            # Emapper mode handling
-            if emapper_mode and counter and target_prop not in acr_discrete_columns:
-                internal_props[target_prop] = get_top_keys(counter)
-            elif counter_stat == 'dominant':
-                internal_props[target_prop] = get_top_keys(counter)
-            else:
-                # Sort and process counter items
-                sorted_items = sorted(counter.items())
-                internal_props[utils.add_suffix(target_prop, 'counter')] = item_separator.join(
-                    f"{key}{pair_separator}{value}" for key, value in sorted_items
-                )
-
-        elif counter_stat == 'relative':
-            total = sum(counter.values())
-            if total > 0:  # Avoid division by zero
-                sorted_items = sorted(counter.items())
-                internal_props[utils.add_suffix(target_prop, 'counter')] = item_separator.join(
-                    f"{key}{pair_separator}{value / total:.2f}" for key, value in sorted_items
-                )
-
-        elif counter_stat == 'none':
-            continue
-
-        else:
-            logger.error("Invalid counter_stat")
-            sys.exit(1)
-
-    return internal_props
-
-def merge_multitext_annotations(nodes, target_props, column2method):
-    multi_text_separator = ','
-    pair_separator = "--"
-    item_separator = "||"
-
-    internal_props = {}
-    counters = {}
-
-    for target_prop in target_props:
-        counter_stat = column2method.get(target_prop, "raw")
-
-        # Get multi-text properties and flatten using itertools (faster)
-        prop_list = utils.children_prop_array(nodes, target_prop)
-        multi_prop_list = list(itertools.chain.from_iterable(prop_list))  # Flatten efficiently
-
-        counter = Counter(multi_prop_list)  # Count occurrences
-        counters[target_prop] = counter  # Store counter result
-
-        if counter_stat in {'raw', 'relative'}:
-            sorted_items = sorted(counter.items())  # Sort only once
-
-            if counter_stat == 'raw':
-                internal_props[utils.add_suffix(target_prop, 'counter')] = item_separator.join(
-                    f"{key}{pair_separator}{value}" for key, value in sorted_items
-                )
-
-            elif counter_stat == 'relative':
-                total = sum(counter.values())
-                if total > 0:  # Avoid division by zero
-                    internal_props[utils.add_suffix(target_prop, 'counter')] = item_separator.join(
-                        f"{key}{pair_separator}{value / total:.2f}" for key, value in sorted_items
-                    )
-
-    return internal_props
-
-def merge_num_annotations(nodes, target_props, column2method):
-    internal_props = {}
-
-    for target_prop in target_props:
-        num_stat = column2method.get(target_prop, None)
-        if num_stat == 'none':
-            continue
-
-        if target_prop in ('dist', 'support'):
-            continue  # Skip 'dist' and 'support'
-
-        # Get numeric values as NumPy array
-        prop_array = np.array(utils.children_prop_array(nodes, target_prop), dtype=np.float64)
-        prop_array = prop_array[~np.isnan(prop_array)]  # Remove NaNs
-
-        if prop_array.size == 0:
-            continue  # Skip if array is empty after NaN removal
-
-        # Compute basic statistics efficiently using NumPy
-        prop_sum = np.sum(prop_array)
-        prop_min = np.min(prop_array)
-        prop_max = np.max(prop_array)
-        prop_avg = np.mean(prop_array)
-        prop_std = np.std(prop_array, ddof=1) if prop_array.size > 1 else 0  # Sample standard deviation
-
-        # Populate results based on requested stat method
-        if num_stat == 'all':
-            internal_props[utils.add_suffix(target_prop, 'avg')] = prop_avg
-            internal_props[utils.add_suffix(target_prop, 'sum')] = prop_sum
-            internal_props[utils.add_suffix(target_prop, 'max')] = prop_max
-            internal_props[utils.add_suffix(target_prop, 'min')] = prop_min
-            internal_props[utils.add_suffix(target_prop, 'std')] = prop_std
-        elif num_stat == 'avg':
-            internal_props[utils.add_suffix(target_prop, 'avg')] = prop_avg
-        elif num_stat == 'sum':
-            internal_props[utils.add_suffix(target_prop, 'sum')] = prop_sum
-        elif num_stat == 'max':
-            internal_props[utils.add_suffix(target_prop, 'max')] = prop_max
-        elif num_stat == 'min':
-            internal_props[utils.add_suffix(target_prop, 'min')] = prop_min
-        elif num_stat == 'std':
-            internal_props[utils.add_suffix(target_prop, 'std')] = prop_std
-
-    return internal_props if internal_props else None
-
-def compute_matrix_statistics(matrix, num_stat=None):
-    """
-    Computes specified statistics for the given matrix based on the num_stat parameter.
-    
-    :param matrix: A list of lists representing the matrix.
-    :param num_stat: Specifies which statistics to compute. Can be "avg", "max", "min", "sum", "std", "all", or None.
-    :return: A dictionary with the requested statistics or an empty dict/message.
-    """
-    
-    stats = {}
-
-    if num_stat == 'none':
-        return stats  # Return an empty dictionary if no statistics are requested
-    
-    # Replace None with np.nan or another appropriate value before creating the array
-    if matrix is not None:
-        cleaned_matrix = [[0 if x is None else x for x in row] for row in matrix]
-        np_matrix = np.array(cleaned_matrix, dtype=np.float64)
-    else:
-        return {}  # Return an empty dictionary if the matrix is empty
-
-    if np_matrix.size == 0:
-        return {}  # Return an empty dictionary if the matrix is empty
-
- 
-    if np_matrix.ndim == 2 and np_matrix.shape[1] > 0:
-        available_stats = {
-            'avg': np_matrix.mean(axis=0),
-            'max': np_matrix.max(axis=0),
-            'min': np_matrix.min(axis=0),
-            'sum': np_matrix.sum(axis=0),
-            'std': np_matrix.std(axis=0)
-        }
-
-        if num_stat == "all":
-            return available_stats
-        elif num_stat in available_stats:
-            stats[num_stat] = available_stats[num_stat]
-        else:
-            logger.error(f"Unsupported stat '{num_stat}'. Supported stats are 'avg', 'max', 'min', 'sum', 'std', or 'all'.")
-            sys.exit(1)
-    return stats
-
 def name_nodes(tree):
     for i, node in enumerate(tree.traverse("postorder")):
         if not node.name or node.name == 'None':
@@ -1632,13 +1362,16 @@ def gtdb_accession_to_taxid(accession):
 
 def get_gtdbtaxadump(version):
     url = f"https://github.com/etetoolkit/ete-data/raw/main/gtdb_taxonomy/gtdb{version}/gtdb{version}dump.tar.gz"
-    fname = f"gtdb{version}dump.tar.gz"
-    logger.info(f'Downloading GTDB taxa dump fname from {url} ...')
-    with open(fname, 'wb') as f:
-        f.write(requests.get(url).content)
+    fname = os.path.join(taxonomy.dumps_dir(), f"gtdb{version}dump.tar.gz")
+    # released versions never change, download them once
+    if not os.path.exists(fname):
+        logger.info(f'Downloading GTDB taxa dump fname from {url} ...')
+        with open(fname + '.part', 'wb') as f:
+            f.write(requests.get(url).content)
+        os.replace(fname + '.part', fname)
     return fname
 
-def annotate_taxa(tree, db="GTDB", taxid_attr="name", sp_delimiter='.', sp_field=0, ignore_unclassified=False):
+def annotate_taxa(tree, db="GTDB", taxid_attr="name", sp_delimiter='.', sp_field=0, ignore_unclassified=False, taxa_cache=False, dbfile=None):
     global rank2values
     logger.info(f"\n==============Annotating tree with {db} taxonomic database============")
     
@@ -1677,7 +1410,7 @@ def annotate_taxa(tree, db="GTDB", taxid_attr="name", sp_delimiter='.', sp_field
 
 
     if db == "GTDB" or "MOTUS":
-        gtdb = GTDBTaxa()
+        gtdb = GTDBTaxa(dbfile=dbfile if db != "NCBI" else None)
         tree.set_species_naming_function(return_spcode_gtdb)
         gtdb.annotate_tree(tree,  taxid_attr="species", ignore_unclassified=ignore_unclassified)
         suffix_to_rank_dict = {
@@ -1705,19 +1438,21 @@ def annotate_taxa(tree, db="GTDB", taxid_attr="name", sp_delimiter='.', sp_field
                 n.add_prop("lca", utils.dict_to_string(lca_dict))
 
     if db == "NCBI":
-        ncbi = NCBITaxa()
+        ncbi = NCBITaxa(dbfile=dbfile)
         # extract sp codes from leaf names
         tree.set_species_naming_function(return_spcode_ncbi)
         ncbi.annotate_tree(tree, taxid_attr="species", ignore_unclassified=ignore_unclassified)
-        for n in tree.traverse():
-            if n.props.get('lineage') and n.props.get('lineage') != ['']:
-                lca_dict = {}
-                #for taxa in n.props.get("lineage"):
-                lineage2rank = ncbi.get_rank(n.props.get("lineage"))
-                taxid2name = ncbi.get_taxid_translator(n.props.get("lineage"))
-                lca_dict = merge_dictionaries(lineage2rank, taxid2name)
-                n.add_prop("named_lineage", list(taxid2name.values()))
-                n.add_prop("lca", utils.dict_to_string(lca_dict))
+        lineage_nodes = [n for n in tree.traverse() if n.props.get('lineage') and n.props.get('lineage') != ['']]
+
+        # resolve the taxids of all lineages at once
+        resolver = TaxonomyResolver(ncbi, cache=taxa_cache)
+        resolver.resolve(itertools.chain.from_iterable(n.props.get('lineage') for n in lineage_nodes))
+        for n in lineage_nodes:
+            lineage2rank = resolver.ranks(n.props.get("lineage"))
+            taxid2name = resolver.names(n.props.get("lineage"))
+            lca_dict = merge_dictionaries(lineage2rank, taxid2name)
+            n.add_prop("named_lineage", list(taxid2name.values()))
+            n.add_prop("lca", utils.dict_to_string(lca_dict))
 
     # tree.annotate_gtdb_taxa(taxid_attr='name')
     # assign internal node as sci_name
@@ -1741,13 +1476,21 @@ def download_motus_dump():
     import requests
 
     url = "https://github.com/dengzq1234/ete-data/raw/refs/heads/main/motus_taxonomy/motus_latest_dump.tar.gz"
-    fname = './motus_latest_dump.tar.gz'
+    fname = os.path.join(taxonomy.dumps_dir(), 'motus_latest_dump.tar.gz')
+    md5_fname = fname + '.md5'
     if not os.path.exists(fname):
         print(f'Downloading {fname} from {url} ...')
         with open(fname, 'wb') as f:
             f.write(requests.get(url).content)
     else:
-        md5_local = md5(open(fname, 'rb').read()).hexdigest()
+        # the local md5 is computed once per download
+        if os.path.exists(md5_fname) and os.path.getmtime(md5_fname) >= os.path.getmtime(fname):
+            with open(md5_fname) as f:
+                md5_local = f.read().strip()
+        else:
+            md5_local = md5(open(fname, 'rb').read()).hexdigest()
+            with open(md5_fname, 'w') as f:
+                f.write(md5_local)
         md5_remote = requests.get(url + '.md5').text.split()[0]
 
         if md5_local != md5_remote:
@@ -1765,16 +1508,8 @@ def annotate_evol_events(tree, taxid_attr="name", sos_thr=0.0, sp_delimiter='.',
         except (IndexError, ValueError):
             return str(leaf.props.get(taxid_attr))
 
-    tree.set_species_naming_function(return_spcode)
-    
-    # Get species for each node
-    node2species = tree.get_cached_content('species')
-    
-    # idetify the smallest outgroup
-    root = tree.root
-
     # Checks that is actually rooted
-    outgroups = root.get_children()
+    outgroups = tree.root.get_children()
     if len(outgroups) != 2:
         logger.warning(
             "Tree appears to be unrooted (root has %d children). This may affect duplication/speciation inference. "
@@ -1783,57 +1518,28 @@ def annotate_evol_events(tree, taxid_attr="name", sos_thr=0.0, sp_delimiter='.',
             len(outgroups)
         )
 
-    outgroup1 = set([n.name for n in root.children[0].leaves()])
-    outgroup2 = set([n.name for n in root.children[1].leaves()])
-    outgroup = outgroup1 if len(outgroup1) < len(outgroup2) else outgroup2
-
-    # Family size
-    fSize = len(list(tree.leaves()))
-
-    # List to store evolutionary events
-    all_events = []
     for n in tree.traverse():
-        n.props['species'] = node2species[n]
-        
-        if len(n.children) == 2:
-            left_child, right_child = n.children
-            left_species = node2species[left_child]
-            right_species = node2species[right_child]
-
-            # Determine species overlap
-            shared_species = left_species & right_species
-            total_species = left_species | right_species
-            sos = len(shared_species) / len(total_species) if total_species else 0
-
-            # Create an EvolEvent object
-            event = EvolEvent()
-            event.famSize = fSize
-            event.branch_supports = [n.support, left_child.support, right_child.support]
-            event.sos = sos
-            event.outgroup_spcs = outgroup
-            event.in_seqs = set([n.name for n in left_child.leaves()])
-            event.out_seqs = set([n.name for n in right_child.leaves()])
-            event.inparalogs = event.in_seqs
-
-            if sos > sos_thr:  # Duplication
-                event.etype = "D"
-                event.outparalogs = event.out_seqs
-                event.orthologs = set()
-                n.props['evoltype'] = 'D'
-                if shared_species and shared_species != {None}:
-                    n.props['dup_sp'] = ','.join(shared_species)
-                    n.props['dup_percent'] = round((len(shared_species) / len(total_species)) * 100, 3) if total_species else 0
-            else:  # Speciation
-                event.etype = "S"
-                event.orthologs = event.out_seqs
-                event.outparalogs = set()
-                n.props['evoltype'] = 'S'
-            
-            event.node = n
-            all_events.append(event)
-
+        if n.is_leaf:
+            n.props['species'] = {return_spcode(n)}
         # Cleanup after species processing
-        n.del_prop('_speciesFunction')
+        if '_speciesFunction' in n.props:
+            n.del_prop('_speciesFunction')
+
+    # Species overlap of both sides of each bifurcation, over bitsets of interned species codes
+    tree_index = TreeIndex(tree)
+    species_index = species_overlap.SpeciesIndex()
+    for n, shared_species, total_species in species_overlap.species_overlaps(tree_index, return_spcode, species_index):
+        n_total = total_species.bit_count()
+        n_shared = shared_species.bit_count()
+        sos = n_shared / n_total if n_total else 0
+
+        if sos > sos_thr:  # Duplication
+            n.props['evoltype'] = 'D'
+            if n_shared:
+                n.props['dup_sp'] = ','.join(species_index.decode(shared_species))
+                n.props['dup_percent'] = round((n_shared / n_total) * 100, 3)
+        else:  # Speciation
+            n.props['evoltype'] = 'S'
     return tree
 
 def get_range(input_range):
@@ -1883,38 +1589,24 @@ def parse_emapper_annotations(input_file, delimiter='\t', no_headers=False, targ
 
     return metadata, node_props, columns
 
+def translate_domain_table(table, fasta, columns, pair_delimiter="@"):
+    # domain coordinates translated from raw residue positions to alignment columns
+    seq2doms = defaultdict(list)
+    try:
+        for seq_name, dom_name, trans_dom_start, trans_dom_end in domain_table.translate_domains(table, fasta, columns):
+            seq2doms[seq_name].append(pair_delimiter.join([dom_name, str(trans_dom_start), str(trans_dom_end)]))
+    except KeyError as e:
+        seq_name, dom_start, dom_end = e.args
+        logger.error(f"Cannot find {dom_start} or {dom_end} in {seq_name}")
+        sys.exit(1)
+    return seq2doms
+
 def annot_tree_pfam_table(post_tree, pfam_table, alg_fasta, domain_prop='dom_arq'):
     pair_delimiter = "@"
     item_seperator = "||"
-    fasta = SeqGroup(alg_fasta) # aligned_fasta
-    raw2alg = defaultdict(dict)
-    len_alg = 0   
-    for num, (name, seq, _) in enumerate(fasta):
-        p_raw = 1
-        for p_alg, (a) in enumerate(seq, 1):
-            if a != '-':
-                raw2alg[name][p_raw] = p_alg
-                p_raw +=1
-        len_alg = len(seq)
-    
-    seq2doms = defaultdict(list)
-    with open(pfam_table) as f_in:
-        for line in f_in:
-            if not line.startswith('#'):
-                info = line.strip().split('\t')
-                seq_name = info[0]
-                dom_name = info[1]
-                dom_start = int(info[7])
-                dom_end = int(info[8])
-                if raw2alg.get(seq_name):
-                    try:
-                        trans_dom_start = raw2alg[seq_name][dom_start]
-                        trans_dom_end = raw2alg[seq_name][dom_end]
-                        dom_info_string = pair_delimiter.join([dom_name, str(trans_dom_start), str(trans_dom_end)])
-                        seq2doms[seq_name].append(dom_info_string)
-                    except KeyError:
-                        logger.error(f"Cannot find {dom_start} or {dom_end} in {seq_name}")
-                        sys.exit(1)
+    fasta = alg_fasta if isinstance(alg_fasta, AlignmentStore) else AlignmentStore(alg_fasta) # aligned_fasta
+    len_alg = fasta.length
+    seq2doms = translate_domain_table(pfam_table, fasta, domain_table.PFAM_COLUMNS, pair_delimiter=pair_delimiter)
 
     for l in post_tree:
         if l.name in seq2doms.keys():
@@ -1941,30 +1633,8 @@ def annot_tree_pfam_table(post_tree, pfam_table, alg_fasta, domain_prop='dom_arq
 def annot_tree_smart_table(post_tree, smart_table, alg_fasta, domain_prop='dom_arq'):
     pair_delimiter = "@"
     item_seperator = "||"
-    fasta = SeqGroup(alg_fasta) # aligned_fasta
-    raw2alg = defaultdict(dict)
-    for num, (name, seq, _) in enumerate(fasta):
-        p_raw = 1
-        for p_alg, (a) in enumerate(seq, 1):
-            if a != '-':
-                raw2alg[name][p_raw] = p_alg
-                p_raw +=1
-
-    seq2doms = defaultdict(list)
-    with open(smart_table) as f_in:
-        for line in f_in:
-            if not line.startswith('#'):
-                info = line.strip().split('\t')
-                seq_name = info[0]
-                dom_name = info[1]
-                dom_start = int(info[2])
-                dom_end = int(info[3])
-                if raw2alg.get(seq_name):
-                    trans_dom_start = raw2alg[seq_name][dom_start]
-                    trans_dom_end = raw2alg[seq_name][dom_end]
-
-                dom_info_string = pair_delimiter.join([dom_name, str(trans_dom_start), str(trans_dom_end)])
-                seq2doms[seq_name].append(dom_info_string)
+    fasta = alg_fasta if isinstance(alg_fasta, AlignmentStore) else AlignmentStore(alg_fasta) # aligned_fasta
+    seq2doms = translate_domain_table(smart_table, fasta, domain_table.SMART_COLUMNS, pair_delimiter=pair_delimiter)
 
     for l in post_tree:
         if l.name in seq2doms.keys():
@@ -1976,98 +1646,31 @@ def annot_tree_smart_table(post_tree, smart_table, alg_fasta, domain_prop='dom_a
         # get the most common domain
         if not n.is_leaf:
             prop_list = utils.children_prop_array(n, domain_prop)
-            counter = dict(Counter(prop_list))
-            most_common_key = max(counter, key=counter.get)
-            n.add_prop(domain_prop, most_common_key)
+            if prop_list:
+                counter = dict(Counter(prop_list))
+                most_common_key = max(counter, key=counter.get)
+                n.add_prop(domain_prop, most_common_key)
 
     # for n in post_tree.traverse():
     #     print(n.name, n.props.get('dom_arq'))
 
 def parse_fasta(fastafile):
-    fasta_dict = {}
-    with open(fastafile,'r') as f:
-        head = ''
-        seq = ''
-        for line in f:
-            line = line.strip()
-            if line.startswith('>'):
-                if seq != '':
-                    fasta_dict[head] = seq
-                    seq = ''
-                    head = line[1:]
-                else:
-                    head = line[1:]
-            else:
-                seq += line
-    fasta_dict[head] = seq
-    return fasta_dict
+    return dict(AlignmentStore(fastafile).items())
 
-def _worker_function(iteration_data):
-
-    import hashlib
-    # Derive a unique seed per worker using time or iteration data
-    unique_string = str(iteration_data) + str(time.time())
-    seed = int(hashlib.sha256(unique_string.encode()).hexdigest(), 16) % (2**32)
-    np.random.seed(seed)
-    
-    # Unpack the necessary data for one iteration
-    prop2array, dump_tree, acr_discrete_columns_dict, prediction_method, model, ent_type, lambda0, se, sim, burn, thin, threads = iteration_data
-
-    shuffled_dict = {}
-    for column, trait in acr_discrete_columns_dict.items():
-        # Shuffle traits
-        shuffled_trait = np.random.choice(trait, len(trait), replace=False)
-        prop2array[column][1] = list(shuffled_trait)
-        shuffled_dict[column] = list(shuffled_trait)
-
-    # Converting back to the original dictionary format
-    new_metadata_dict = convert_back_to_original(prop2array)
-    updated_tree = load_metadata_to_tree(dump_tree, new_metadata_dict)
-
-    # Run ACR
-    random_acr_results, updated_tree = run_acr_discrete(updated_tree, shuffled_dict, 
-                                                        prediction_method=prediction_method, 
-                                                        model=model, threads=threads, outdir=None)
-    random_delta = run_delta(random_acr_results, updated_tree, ent_type=ent_type, 
-                             lambda0=lambda0, se=se, sim=sim, burn=burn, thin=thin, 
-                             threads=threads)
-
-    # Clear extra features from the tree
-    utils.clear_extra_features([updated_tree], ["name", "dist", "support"])
-    return random_delta
-    
 def get_pval(prop2array, dump_tree, acr_discrete_columns_dict, iteration=100, 
              prediction_method="MPPA", model="F81", ent_type='SE', 
-             lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1):
-    prop2delta_array = {}
-
-    # Prepare data for each iteration
-    iteration_data = [(prop2array, dump_tree, acr_discrete_columns_dict, prediction_method, model, ent_type, lambda0, se, sim, burn, thin, threads) for _ in range(iteration)]
-
-    # Use multiprocessing pool
-    if threads > 1:
-        with Pool(threads) as pool:
-            results = pool.map(_worker_function, iteration_data)
-    else:
-        results = map(_worker_function, iteration_data)
-
-    # Aggregate results
-    for delta_result in results:
-        for prop, result in delta_result.items():
-            if prop in prop2delta_array:
-                prop2delta_array[prop].append(result)
-            else:
-                prop2delta_array[prop] = [result]
-
-    return prop2delta_array
-
-# Function to build the matrix string for a node
-def build_matrix_string(node, name2seq):
-    matrix = ''
-    for leaf in node.leaves():
-        if name2seq.get(leaf.name):
-            matrix += f">{leaf.name}\n{name2seq.get(leaf.name)}\n"
-    return matrix
+             lambda0=0.1, se=0.5, sim=10000, burn=100, thin=10, threads=1, chains=DELTA_CHAINS,
+             observed_deltas=None, seed=permutation.PERMUTATION_SEED):
+    """
+    Deltas of the discrete columns after shuffling their states, as
+    {prop: [delta, ...]}. Permutation i is seeded from (seed, i), and it
+    stops early once the p-values against `observed_deltas` are decided.
+    """
+    column2identifiers = {column: prop2array[column][0] for column in acr_discrete_columns_dict}
+    return permutation.permutation_deltas(dump_tree, column2identifiers, acr_discrete_columns_dict,
+        observed_deltas=observed_deltas, iterations=iteration, threads=threads,
+        prediction_method=prediction_method, model=model, ent_type=ent_type,
+        lambda0=lambda0, se=se, sim=sim, burn=burn, thin=thin, chains=chains, seed=seed)
 
 def tree2table(tree, internal_node=True, props=None, outfile='tree2table.csv'):
     node2leaves = {}
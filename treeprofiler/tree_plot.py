@@ -19,12 +19,14 @@ from ete4 import Tree, PhyloTree
 from ete4 import GTDBTaxa
 from ete4 import NCBITaxa
 from ete4.smartview import TreeStyle, NodeStyle, TreeLayout
-from treeprofiler.tree_image import get_image
+from treeprofiler import tree_render
 from treeprofiler.layouts import (
     text_layouts, taxon_layouts, staple_layouts, 
     conditional_layouts, seq_layouts, profile_layouts, phylosignal_layouts)
 
 import treeprofiler.src.utils as utils
+from treeprofiler.src import colormap, prop_cache, profile_matrix, canvas
+from treeprofiler.src.tree_index import LCAIndex
 from treeprofiler.tree_annotate import can_convert_to_bool
 
 import sys
@@ -52,6 +54,38 @@ paired_color = [
 
 DESC = "plot tree"
 
+# properties always shown in the popups of the explorer
+BASE_VIZ_PROPS = [
+    'name',
+    'dist',
+    'support',
+    'rank',
+    'sci_name',
+    'taxid',
+    'lineage',
+    'named_lineage',
+    'evoltype',
+    'dup_sp',
+    'dup_percent',
+    'lca',
+]
+
+# layouts whose arguments are the names of the properties they display
+PROP_LAYOUTS = [
+    'acr_discrete_layout', 'acr_continuous_layout', 'ls_layout',
+    'binary_layout', 'binary_aggregate_layout', 'binary_unicolor_layout', 'binary_unicolor_aggregate_layout',
+    'colorbranch_layout', 'textbranch_layout', 'circlenode_layout', 'squarenode_layout', 'trianglenode_layout',
+    'label_layout', 'rectangle_layout', 'bubble_layout', 'background_layout', 'piechart_layout',
+    'heatmap_layout', 'heatmap_mean_layout', 'heatmap_zscore_layout', 'barplot_layout',
+    'profiling_layout', 'categorical_matrix_layout', 'numerical_matrix_layout', 'binary_matrix_layout',
+]
+
+# options that may read any property of the tree
+ALL_PROPS_OPTIONS = [
+    'taxonclade_layout', 'taxonrectangle_layout', 'taxoncollapse_layout', 'emapper_layout',
+    'domain_layout', 'alignment_layout', 'collapsed_by', 'highlighted_by', 'pruned_by', 'rank_limit',
+]
+
 # Set up the logger with INFO level by default
 logger = logging.getLogger(__name__)
 
@@ -66,7 +100,24 @@ def setup_logger(level=logging.ERROR):
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s - [in %(filename)s:%(lineno)d]')
     
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # plots run one after another in a process (render-batch) share the handler
+    if not logger.handlers:
+        logger.addHandler(handler)
+
+def get_plot_props(args):
+    """
+    Properties needed by the requested layouts, so that binary .ete trees only
+    decode those columns (and their suffixed variants). Returns None when all
+    the properties must be loaded.
+    """
+    if any(getattr(args, option, None) for option in ALL_PROPS_OPTIONS):
+        return None
+    props = set(BASE_VIZ_PROPS)
+    for layout in PROP_LAYOUTS:
+        props.update(getattr(args, layout, None) or [])
+    if getattr(args, 'barplot_colorby', None):
+        props.add(args.barplot_colorby)
+    return props
 
 def string_or_file(value):
     if os.path.isfile(value):
@@ -360,10 +411,17 @@ def poplulate_plot_args(plot_args_p):
         default=5000,
         help="run interactive session on custom port.[default: 5000]")
     group.add_argument('--render',
-        #type=str,
-        action="store_true", 
+        nargs='?',
+        const='tree-1.svg',
+        default=None,
+        metavar='FILE',
+        required=False,
+        help="output the tree image to FILE, as svg, png or pdf after its extension.[default: tree-1.svg]")
+    group.add_argument('--render-backend',
+        choices=['headless', 'browser'],
+        default='headless',
         required=False,
-        help="output as svg")
+        help="draw --render images in-process (headless) or by screenshot of the explorer in a browser (browser, svg only).[default: headless]")
     group.add_argument('--out-colordict',
         action="store_true", 
         required=False,
@@ -371,7 +429,14 @@ def poplulate_plot_args(plot_args_p):
 
 
 ### visualize tree
-def run(args):
+def run(args, argv=None, parsed_tree=None, color_config=None):
+    """
+    Plot the tree of `args`. `argv` is the command line the args come from,
+    whose order sets the order of the layouts [default: sys.argv]. A tree
+    already parsed from args.tree can be given as `parsed_tree`, a
+    (tree, eteformat_flag) pair, and a color config already read from
+    args.color_config as `color_config`.
+    """
     global prop2type, properties, tree
     node_props=[]
     properties = {}
@@ -386,11 +451,15 @@ def run(args):
     # parsing tree
     import time
     start = time.time()
-    try:
-        tree, eteformat_flag = utils.validate_tree(args.tree, args.input_type, args.internal)
-    except utils.TreeFormatError as e:
-        print(e)
-        sys.exit(1)
+    if parsed_tree is not None:
+        tree, eteformat_flag = parsed_tree
+    else:
+        try:
+            tree, eteformat_flag = utils.validate_tree(args.tree, args.input_type, args.internal,
+                props=get_plot_props(args))
+        except utils.TreeFormatError as e:
+            print(e)
+            sys.exit(1)
     end = time.time()
     print(f"Tree parsing time: {end-start} seconds")
     
@@ -401,6 +470,9 @@ def run(args):
     if args.midgroup:
         tree.set_outgroup(tree.get_midpoint_outgroup())
 
+    # layout builders read their property arrays from one set of columns
+    prop_cache.register(tree, props=get_plot_props(args))
+
     #rest_prop = []
     if args.prop2type:
         if eteformat_flag:
@@ -469,13 +541,14 @@ def run(args):
     internal_num_rep = args.internal_plot_measure
 
     # color configuration
-    color_config = {}
-    if args.color_config:
-        color_config = read_config_to_dict(args.color_config, delimiter=args.config_sep)
+    if color_config is None:
+        color_config = {}
+        if args.color_config:
+            color_config = read_config_to_dict(args.color_config, delimiter=args.config_sep)
 
     # Get the input arguments in order
     input_order = []
-    for arg in sys.argv[1:]:
+    for arg in (sys.argv[1:] if argv is None else argv):
         if arg.startswith('-') and arg.endswith('layout'):
             input_order.append(arg[2:])
         else:
@@ -758,8 +831,8 @@ def run(args):
                         profiling_columns = '\t'.join(all_profiling_values)
                         f.write(f'#name\t{profiling_columns}\n')
                         for leaf in leaves:
-                            if matrix.get(leaf):
-                                row = leaf + '\t' + '\t'.join(map(str, matrix.get(leaf)))
+                            if leaf in matrix:
+                                row = leaf + '\t' + '\t'.join(map(str, matrix[leaf]))
                                 f.write(f'{row}\n')
 
         # categorical matrix
@@ -978,29 +1051,30 @@ def run(args):
         condition_strings = args.pruned_by
         tree = utils.conditional_prune(tree, condition_strings, prop2type)
 
+    prop_cache.unregister(tree)
+
     #### Output #####
-    viz_props = [
-        'name',
-        'dist',
-        'support',
-        'rank',
-        'sci_name',
-        'taxid',
-        'lineage',
-        'named_lineage',
-        'evoltype',
-        'dup_sp',
-        'dup_percent',
-        'lca',
-    ]
+    viz_props = list(BASE_VIZ_PROPS)
     viz_props.extend(list(set(visualized_props)))
     viz_props = sorted(tuple(viz_props))
 
     if args.out_colordict:
         wrtie_color(total_color_dict)
     if args.render:
-        file_path = "tree-1.svg"
-        get_image(tree, layouts, args.port, os.path.abspath(file_path))
+        file_path = os.path.abspath(args.render)
+        if args.render_backend == 'browser':
+            if not file_path.endswith('.svg'):
+                logger.error("The browser backend only renders svg images.")
+                sys.exit(1)
+            # selenium and the virtual display are only needed here
+            from treeprofiler.tree_image import get_image
+            get_image(tree, layouts, args.port, file_path)
+        else:
+            try:
+                tree_render.render(tree, layouts, file_path)
+            except canvas.UnsupportedFormat as e:
+                logger.error(str(e))
+                sys.exit(1)
     else:
         tree.explore(keep_server=True, compress=False, quiet=args.verbose, 
         layouts=layouts, port=args.port, include_props=viz_props,
@@ -1069,10 +1143,13 @@ def read_config_to_dict(file_obj, delimiter):
     return config_dict
 
 def process_common_ancestors(color_dict, tree, common_ancestor_separator='||'):
+    lca_index = None
     for key in list(color_dict.keys()):
         if common_ancestor_separator in key:
             children = key.split(common_ancestor_separator)
-            ancestor = tree.common_ancestor(children)
+            if lca_index is None:
+                lca_index = LCAIndex(tree)
+            ancestor = lca_index.common_ancestor(children)
             if ancestor:
                 if ancestor.name:
                     # If the ancestor has a name, update its color in the dictionary
@@ -1147,26 +1224,20 @@ def get_acr_discrete_layouts(tree, props, level, prop2type, column_width=70, pad
     return layouts, level, prop_color_dict
 
 def get_acr_continuous_layouts(tree, props, level, prop2type, padding_x=1, padding_y=0):
-    ncolors = 40
-    gradientscolor = utils.build_color_gradient(ncolors, colormap_name='jet')
+    gradientscolor = colormap.gradient('jet')
     layouts = []
     for prop in props:
         try:
-            all_values = np.array(sorted(list(set(utils.tree_prop_array(tree, prop, numeric=True))))).astype('float64')
+            all_values = np.array(utils.tree_prop_array(tree, prop, numeric=True), dtype=np.float64)
         except ValueError:
             logger.error(f"Property {prop} is not numeric. Please check the property type.")
             sys.exit(1)
         all_values = all_values[~np.isnan(all_values)]
         minval, maxval = all_values.min(), all_values.max()
-        num = len(gradientscolor)
-        index_values = np.linspace(minval, maxval, num)
-        value2color = {}
-        for search_value in all_values:
-            index = np.abs(index_values - search_value).argmin()+1
-            value2color[search_value] = gradientscolor[index]
+        lut = colormap.GradientLUT(gradientscolor, minval, maxval)
         layout = phylosignal_layouts.LayoutACRContinuous(name='ACR_'+prop, column=level, \
-            color_dict=value2color, score_prop=prop, value_range=[minval, maxval], \
-            color_range=[gradientscolor[num], gradientscolor[num//2], gradientscolor[1]])
+            color_dict=lut.value2color(all_values), score_prop=prop, value_range=[minval, maxval], \
+            color_range=lut.color_range)
         layouts.append(layout)
     return layouts
 
@@ -1177,13 +1248,12 @@ def get_ls_layouts(tree, props, level, prop2type, padding_x=1, padding_y=0, colo
     ls_clade_suffix = "ls_clade"
     ls_clade_props = [utils.add_suffix(prop, ls_clade_suffix) for prop in props]
     lsprop2color = utils.assign_color_to_values(ls_clade_props, paired_color)
-    ncolors = 40
     layouts = []
     ls_props = []
+    lut = colormap.GradientLUT(colormap.gradient('jet'), 0, 1)
     
     for prop in props:
         value2color = {}
-        gradientscolor = utils.build_color_gradient(ncolors, colormap_name='jet')
 
         for suffix in [precision_suffix, sensitivity_suffix, f1_suffix]:
             
@@ -1191,16 +1261,11 @@ def get_ls_layouts(tree, props, level, prop2type, padding_x=1, padding_y=0, colo
             minval, maxval = 0, 1
             
             # get value
-            internalnode_all_values = np.array(sorted(list(set(utils.tree_prop_array(tree, ls_prop, numeric=True))))).astype('float64')
+            internalnode_all_values = np.array(utils.tree_prop_array(tree, ls_prop, numeric=True), dtype=np.float64)
             all_values = internalnode_all_values[~np.isnan(internalnode_all_values)]
-            num = len(gradientscolor)
-            index_values = np.linspace(minval, maxval, num)
 
             if all_values.any():
-                for search_value in all_values:
-                    if search_value not in value2color:
-                        index = np.abs(index_values - search_value).argmin()+1
-                        value2color[search_value] = gradientscolor[index]
+                value2color = lut.value2color(all_values, value2color=value2color)
             else:
                 logger.error(f"Property {ls_prop} is empty. Please check annotation.")
                 sys.exit(1)
@@ -1211,12 +1276,12 @@ def get_ls_layouts(tree, props, level, prop2type, padding_x=1, padding_y=0, colo
             if suffix != "f1":
                 layout = staple_layouts.LayoutBranchScore(name='LS_'+ls_prop, \
                     color_dict=value2color, prop=ls_prop, value_range=[minval, maxval], \
-                    color_range=[gradientscolor[num], gradientscolor[num//2], gradientscolor[1]], 
+                    color_range=lut.color_range, 
                     show_score=True, active=False)
             else:
                 layout = staple_layouts.LayoutBranchScore(name='LS_'+ls_prop, \
                     color_dict=value2color, prop=ls_prop, value_range=[minval, maxval], \
-                    color_range=[gradientscolor[num], gradientscolor[num//2], gradientscolor[1]], 
+                    color_range=lut.color_range, 
                     show_score=True)
             
             layouts.append(layout)
@@ -1592,8 +1657,7 @@ def get_branchscore_layouts(tree, props, prop2type, padding_x=1, padding_y=0, in
             minval = float(temp_min_val)
         if temp_max_val:
             maxval = float(temp_max_val)
-        ncolors = 40
-        gradientscolor = utils.build_custom_gradient(ncolors, min_color, max_color, mid_color)
+        gradientscolor = colormap.custom_gradient(min_color, max_color, mid_color)
 
         return gradientscolor, value2color, minval, maxval
 
@@ -1601,11 +1665,11 @@ def get_branchscore_layouts(tree, props, prop2type, padding_x=1, padding_y=0, in
    
     for prop in props:
         # Get leaf values of each prop
-        leaf_all_values = np.array(sorted(list(set(utils.tree_prop_array(tree, prop, numeric=True))))).astype('float64')
+        leaf_all_values = np.array(utils.tree_prop_array(tree, prop, numeric=True), dtype=np.float64)
 
         # Get internal values of each prop
         internal_prop = utils.add_suffix(prop, internal_rep)
-        internalnode_all_values = np.array(sorted(list(set(utils.tree_prop_array(tree, internal_prop, numeric=True))))).astype('float64')
+        internalnode_all_values = np.array(utils.tree_prop_array(tree, internal_prop, numeric=True), dtype=np.float64)
         all_values = np.concatenate((leaf_all_values, internalnode_all_values))
         all_values = all_values[~np.isnan(all_values)]
         value2color = {}
@@ -1614,17 +1678,11 @@ def get_branchscore_layouts(tree, props, prop2type, padding_x=1, padding_y=0, in
         if color_config and color_config.get(prop) is not None:
             gradientscolor, value2color, minval, maxval = parse_color_config(prop, color_config, minval, maxval)
         else:
-            ncolors = 40
-            gradientscolor = utils.build_color_gradient(ncolors, colormap_name='jet')
+            gradientscolor = colormap.gradient('jet')
 
         # Preload corresponding gradient color of each value
-        num = len(gradientscolor)
-        index_values = np.linspace(minval, maxval, num)
-
-        for search_value in all_values:
-            if search_value not in value2color:
-                index = np.abs(index_values - search_value).argmin() + 1
-                value2color[search_value] = gradientscolor[index]
+        lut = colormap.GradientLUT(gradientscolor, minval, maxval)
+        value2color = lut.value2color(all_values, value2color=value2color)
         
         # Get corresponding gradient color on the fly of visualization
         layout = staple_layouts.LayoutBranchScore(
@@ -1633,7 +1691,7 @@ def get_branchscore_layouts(tree, props, prop2type, padding_x=1, padding_y=0, in
             prop=prop,
             internal_rep=internal_rep,
             value_range=[minval, maxval],
-            color_range=[gradientscolor[num], gradientscolor[num//2], gradientscolor[1]]
+            color_range=lut.color_range
         )
         layouts.append(layout)
 
@@ -1833,36 +1891,20 @@ def get_numerical_bubble_layouts(tree, props, level, prop2type, padding_x=0, pad
                 minval = float(temp_min_val)
             if temp_max_val:
                 maxval = float(temp_max_val)
-            ncolors = 40
-            gradientscolor = utils.build_custom_gradient(ncolors, min_color, max_color, mid_color)
+            gradientscolor = colormap.custom_gradient(min_color, max_color, mid_color)
         else:
-            ncolors = 40
-            gradientscolor = utils.build_color_gradient(ncolors, colormap_name='jet')
+            value2color = {}
+            gradientscolor = colormap.gradient('jet')
         
         # assign color to each value
-        if max_val == min_val:
-            value2color = {val: gradientscolor[0] for val in prop_values}
-        else:
-            value2color = {}
-            for val in prop_values:
-                
-                # Normalize the value to a scale between 0 and 1
-                normalized_val = (val - min_val) / (max_val - min_val)
-                
-                # Scale it to match the length of gradientscolor
-                color_index = int(normalized_val * (len(gradientscolor) - 1))
-                if color_index == 0:
-                    color_index = 1
-
-                # Assign the color from the gradient
-                value2color[val] = gradientscolor[color_index+1]
-        num = len(gradientscolor)
+        lut = colormap.GradientLUT(gradientscolor, min_val, max_val)
+        value2color = lut.value2color(prop_values, value2color=value2color)
         # Configure and add layout
         layout = staple_layouts.LayoutBubbleNumerical(name=f'Numerical-Bubble_{prop}', 
         column=level, prop=prop, max_radius=max_radius, abs_maxval=abs_maxval, 
         padding_x=padding_x, padding_y=padding_y, value2color=value2color, 
         bubble_range=bubble_range, 
-        color_range=[gradientscolor[num], gradientscolor[num//2], gradientscolor[1]],
+        color_range=lut.color_range,
         internal_rep=internal_rep)
 
         layouts.append(layout)
@@ -1871,16 +1913,6 @@ def get_numerical_bubble_layouts(tree, props, level, prop2type, padding_x=0, pad
     return layouts, level, prop_color_dict
 
 def get_heatmap_layouts(tree, props, level, column_width=70, padding_x=1, padding_y=0, internal_rep='avg', color_config=None, norm_method='min-max', show_text=False, global_scaling=True):
-    # Helper functions for normalization
-    def min_max_normalize(value, minval, maxval):
-        return 0 if maxval - minval == 0 else (value - minval) / (maxval - minval)
-
-    def mean_normalize(value, mean_val, minval, maxval):
-        return 0 if maxval - minval == 0 else (value - mean_val) / (maxval - minval)
-
-    def z_score_normalize(value, mean_val, std_val):
-        return 0 if std_val == 0 else (value - mean_val) / std_val
-
     # Helper function to parse color configuration
     def parse_color_config(prop, color_config, minval, maxval):
         # Default colors
@@ -1912,8 +1944,7 @@ def get_heatmap_layouts(tree, props, level, column_width=70, padding_x=1, paddin
             minval = float(temp_min_val)
         if temp_max_val:
             maxval = float(temp_max_val)
-        ncolors = 40
-        gradient = utils.build_custom_gradient(ncolors, min_color, max_color, mid_color)
+        gradient = colormap.custom_gradient(min_color, max_color, mid_color)
         return gradient, value2color, minval, maxval, nan_color
 
     layouts = []
@@ -1951,27 +1982,15 @@ def get_heatmap_layouts(tree, props, level, column_width=70, padding_x=1, paddin
         if color_config and color_config.get(prop):
             gradientscolor, value2color, minval, maxval, nan_color = parse_color_config(prop, color_config, minval, maxval)
         if not gradientscolor:
-            ncolors = 40
-            gradientscolor = utils.build_color_gradient(ncolors, colormap_name="Reds" if norm_method == 'min-max' else "coolwarm")
+            gradientscolor = colormap.gradient("Reds" if norm_method == 'min-max' else "coolwarm")
         
-        # Normalize values and map colors
-        index_values = np.linspace(0, 1 if norm_method == 'min-max' else (-3 if norm_method == 'zscore' else -1), len(gradientscolor))
-        for value in prop_all_values:
-            if np.isnan(value):
-                value2color[value] = nan_color
-            else:
-                if norm_method == "min-max":
-                    normalized_value = min_max_normalize(value, minval, maxval)
-                elif norm_method == "mean":
-                    normalized_value = mean_normalize(value, mean_val, minval, maxval)
-                elif norm_method == "zscore":
-                    normalized_value = z_score_normalize(value, mean_val, std_val)
-                else:
-                    raise ValueError("Unsupported normalization method.")
-
-                index = np.abs(index_values - normalized_value).argmin() + 1
-                if value not in value2color:  # Ensure color is not overwritten
-                    value2color[value] = gradientscolor.get(index, "")
+        # Normalize values and map colors, configured colors are not overwritten
+        if norm_method not in colormap.NORM_RANGES:
+            raise ValueError("Unsupported normalization method.")
+        lut = colormap.GradientLUT(gradientscolor, *colormap.NORM_RANGES[norm_method])
+        value2color = lut.value2color(prop_all_values,
+            lambda array: colormap.normalize(array, norm_method, minval, maxval, mean_val, std_val),
+            value2color=value2color)
         
         # Add layout for the current property
         layout = staple_layouts.LayoutHeatmap(
@@ -2081,43 +2100,6 @@ def numerical2matrix(tree, profiling_props, count_negative=True, internal_num_re
     def flatten(l):
         return [item for sublist in l for item in sublist]
 
-    def min_max_normalize(value, minval, maxval):
-        if maxval - minval == 0:
-            return 0
-        else:
-            return (value - minval) / (maxval - minval)
-
-    def mean_normalize(value, mean_val, minval, maxval):
-        if maxval - minval == 0:
-            return 0
-        else:
-            return (value - mean_val) / (maxval - minval)
-
-    def z_score_normalize(value, mean_val, std_val):
-        if std_val == 0:
-            return 0
-        else:
-            return (value - mean_val) / std_val
-
-    def _get_color(search_value, color_dict, norm_method='min-max'):
-        num = len(color_dict)
-        search_value = float(search_value)
-        if norm_method == "min-max":
-            normalized_value = min_max_normalize(search_value)
-            index_values = np.linspace(0, 1, num)
-        elif norm_method == "mean":
-            normalized_value = mean_normalize(search_value)
-            index_values = np.linspace(-1, 1, num)
-        elif norm_method == "zscore":
-            normalized_value = z_score_normalize(search_value)
-            index_values = np.linspace(-3, 3, num)
-        else:
-            logger.error("Unsupported normalization method.")
-            sys.exit(1)
-        index = np.abs(index_values - normalized_value).argmin() + 1
-        #index = np.abs(index_values - search_value).argmin() + 1
-        return color_dict.get(index, "")
-
     def parse_color_config(color_config, profiling_props, all_props_wildcard, minval, maxval):
         gradientscolor = None
         nan_color = '#EBEBEB'
@@ -2150,8 +2132,7 @@ def numerical2matrix(tree, profiling_props, count_negative=True, internal_num_re
                     minval = float(temp_min_val)
                 if temp_max_val:
                     maxval = float(temp_max_val)
-                ncolors = 40
-                gradientscolor = utils.build_custom_gradient(ncolors, min_color, max_color, mid_color)
+                gradientscolor = colormap.custom_gradient(min_color, max_color, mid_color)
 
         if profiling_props:
             for profiling_prop in profiling_props:
@@ -2176,8 +2157,7 @@ def numerical2matrix(tree, profiling_props, count_negative=True, internal_num_re
                             minval = float(temp_min_val)
                         if temp_max_val:
                             maxval = float(temp_max_val)
-                        ncolors = 40
-                        gradientscolor = utils.build_custom_gradient(ncolors, min_color, max_color, mid_color)
+                        gradientscolor = colormap.custom_gradient(min_color, max_color, mid_color)
         
         return value2color, gradientscolor, minval, maxval, nan_color
 
@@ -2207,39 +2187,28 @@ def numerical2matrix(tree, profiling_props, count_negative=True, internal_num_re
             nan_color = '#EBEBEB'
 
         if not gradientscolor:
-            ncolors = 40
             if norm_method == 'min-max':
-                gradientscolor = utils.build_color_gradient(ncolors, colormap_name="Reds")
+                gradientscolor = colormap.gradient("Reds")
             else: # "mean" "zscore"
-                gradientscolor = utils.build_color_gradient(ncolors, colormap_name="coolwarm")
-        
-        num = len(gradientscolor)
+                gradientscolor = colormap.gradient("coolwarm")
+        if norm_method not in colormap.NORM_RANGES:
+            logger.error("Unsupported normalization method.")
+            sys.exit(1)
+
         for search_value in all_values_raw:
-            if search_value is None:
-                value2color[search_value] = nan_color
-            elif math.isnan(search_value):
+            if search_value is None or math.isnan(search_value):
                 value2color[search_value] = nan_color
-            #value2color[search_value] = _get_color(search_value, gradientscolor, norm_method)
-            else:
-                search_value = float(search_value)
-                if search_value not in value2color:
-                    if not count_negative and search_value < 0:
-                        value2color[search_value] = nan_color
-                    else:
-                        if norm_method == "min-max":
-                            normalized_value = min_max_normalize(search_value, minval, maxval)
-                            index_values = np.linspace(0, 1, num)
-                        elif norm_method == "mean":
-                            normalized_value = mean_normalize(search_value, mean_val, minval, maxval)
-                            index_values = np.linspace(-1, 1, num)
-                        elif norm_method == "zscore":
-                            normalized_value = z_score_normalize(search_value, mean_val, std_val)
-                            index_values = np.linspace(-3, 3, num)
-                        else:
-                            logger.error("Unsupported normalization method.")
-                            sys.exit(1)
-                        index = np.abs(index_values - normalized_value).argmin() + 1
-                        value2color[search_value] = gradientscolor.get(index, "")
+
+        values = np.array(all_values, dtype=np.float64)
+        if not count_negative:
+            # negative values are left out of the gradient
+            for search_value in values[values < 0].tolist():
+                value2color.setdefault(search_value, nan_color)
+            values = values[values >= 0]
+        lut = colormap.GradientLUT(gradientscolor, *colormap.NORM_RANGES[norm_method])
+        value2color = lut.value2color(values,
+            lambda array: colormap.normalize(array, norm_method, minval, maxval, mean_val, std_val),
+            value2color=value2color)
         return minval, maxval, value2color, gradientscolor
 
     node2matrix_single = {}
@@ -2364,18 +2333,10 @@ def binary2matrix(tree, profiling_props, color_config=None):
                     if 'value2color' in prop_config and prop_config['value2color']:
                         value2color = prop_config['value2color']
                         value2color = {float(key): value for key, value in value2color.items()}
-    ncolors = 40
-    gradientscolor = utils.build_color_gradient(ncolors, colormap_name='Reds')
-    
     # get color for binary value 0 to 1
-    all_values_raw = list(set(utils.flatten([sublist for sublist in node2matrix.values()])))
-    all_values = sorted(list(filter(lambda x: x is not None and not math.isnan(x), all_values_raw)))
-    num = len(gradientscolor)
-    index_values = np.linspace(0, 1, num) # binary value 0 to 1
-    for search_value in all_values:
-        if search_value not in value2color:
-            index = np.abs(index_values - search_value).argmin() + 1
-            value2color[search_value] = gradientscolor[index]
+    lut = colormap.GradientLUT(colormap.gradient('Reds'), 0, 1)
+    all_values = [x for x in utils.flatten(node2matrix.values()) if x is not None]
+    value2color = lut.value2color(all_values, value2color=value2color)
     
     return node2matrix, value2color, is_list
 
@@ -2494,7 +2455,7 @@ def multiple2matrix(tree, profiling_prop, prop2type=None, color_config=None, ete
 
     # Determine the data type of the profiling property
     data_type = prop2type.get(profiling_prop)
-    node2leaves = tree.get_cached_content()
+    tree_index = prop_cache.tree_index(tree)
     # Get all categorical values based on whether data_type is a list and eteformat_flag
 
     if data_type and data_type == list:
@@ -2510,59 +2471,20 @@ def multiple2matrix(tree, profiling_prop, prop2type=None, color_config=None, ete
     else:
         all_categorical_values = profiling_list
     
-    # Create node to matrix mappings
-    node2matrix = {}
-    all_categorical_values_set = sorted(set(all_categorical_values))  # Convert to set for O(1) lookup
-
-    for node in tree.traverse():
-        node_prop = node.props.get(profiling_prop)
-        
-        if node.is_leaf and node_prop:
-            if data_type == list:
-                if eteformat_flag:
-                    node_prop_set = set(node_prop)
-                    node2matrix[node.name] = [1 if val in node_prop_set else 0 for val in all_categorical_values_set]
-                else:
-                    node2matrix[node.name] = [1 if val in node_prop else 0 for val in all_categorical_values_set]
-            else:
-                node2matrix[node.name] = [1 if val in node_prop else 0 for val in all_categorical_values_set]
-        else:
-            if data_type == list:
-                # calculate the ratio of each value in the list, out of total leaves in internal node.
-                counter_separator = '||'
-                items_separator = '--'
-                total = 0
-                ratios = []
-                representative_prop = utils.add_suffix(profiling_prop, "counter")
-                if node.props.get(representative_prop):
-                    counter_props = node.props.get(representative_prop).split(counter_separator)
-                    counter_dict = {k: int(v) for k, v in [counter_prop.split(items_separator) for counter_prop in counter_props]}
-                    total = len(node2leaves[node])
-                    ratios = [counter_dict.get(val, 0) / total for val in all_categorical_values_set]
-                    node2matrix[node.name] = ratios
-                    
-            else:
-                representative_prop = utils.add_suffix(profiling_prop, "counter")
-                if node.props.get(representative_prop):
-                    ratios = utils.categorical2ratio(node, representative_prop, all_categorical_values)
-                    node2matrix[node.name] = ratios
-        
-    # Build a color gradient for binary values
-    ncolors = 40
-    gradientscolor = utils.build_custom_gradient(ncolors, min_color=absence_color, max_color=precence_color)
-    value2color = {1: gradientscolor[ncolors], 0: gradientscolor[1]}
-
-    # Get unique values from node2matrix and sort non-NaN values
-    all_values_raw = list(set(utils.flatten(node2matrix.values())))
-    all_values = sorted([x for x in all_values_raw if x is not None and not math.isnan(x)])
-
-    # Map non-binary values to gradient colors
-    num = len(gradientscolor)
-    index_values = np.linspace(0, 1, num)
-    for search_value in all_values:
-        if search_value not in value2color:
-            index = np.abs(index_values - search_value).argmin() + 1
-            value2color[search_value] = gradientscolor[index]
+    # Presence of every value in the leaves, ratio of leaves with it in the internal nodes
+    all_categorical_values = list(dict.fromkeys(all_categorical_values))
+    if data_type == list:
+        node2matrix = profile_matrix.build_profile(tree_index, profiling_prop, all_categorical_values,
+            list_type=not eteformat_flag)
+    else:
+        node2matrix = profile_matrix.build_profile(tree_index, profiling_prop, all_categorical_values,
+            clade_total=False, minimum=0.01)
+
+    # Build a color gradient for binary values, ratios of internal nodes in between
+    gradientscolor = colormap.custom_gradient(absence_color, precence_color)
+    value2color = {1: gradientscolor[colormap.NCOLORS], 0: gradientscolor[1]}
+    lut = colormap.GradientLUT(gradientscolor, 0, 1)
+    value2color = lut.value2color(node2matrix.distinct_values(), value2color=value2color)
 
     return node2matrix, value2color, all_categorical_values
 
@@ -0,0 +1,80 @@
+import numpy as np
+
+from ete4.smartview import TreeStyle
+from ete4.smartview.renderer.drawer import DrawerRectFaces, DrawerAlignRectFaces
+from ete4.smartview.renderer.draw_helpers import Box
+
+from treeprofiler.src.canvas import Canvas
+from treeprofiler.src.tree_index import TreeIndex
+
+# Headless rendering of a tree with its layouts.
+#
+# The layouts are drawn in-process by the same smartview drawers that feed
+# the browser: the tree panel, the aligned panel and the header of the
+# aligned panel, each asked once for the whole tree at a fixed zoom. Their
+# graphic elements are painted on a Canvas and saved, so no server, browser
+# or virtual display is started and nothing waits on timers.
+
+TREE_WIDTH = 400        # pixels of the longest root-to-leaf path
+LEAF_HEIGHT = 20        # pixels per leaf
+ALIGNED_GAP = 20        # pixels between the tree and the aligned panel
+ALIGNED_WIDTH = 100000  # pixels of the aligned panel the drawers may fill
+HEADER_PANEL = -1
+
+def dist(node):
+    """Branch length of a node, with the defaults the tree view uses."""
+    default = 0 if node.is_root else 1
+    return float(node.props.get('dist', default))
+
+def tree_size(tree):
+    """Longest root-to-leaf distance and number of leaves of `tree`."""
+    tree_index = TreeIndex(tree)
+    x = np.zeros(len(tree_index.nodes))
+    for i, node in enumerate(tree_index.nodes):  # parents come before their children
+        parent = tree_index.parents[i]
+        x[i] = (x[parent] if parent >= 0 else 0) + dist(node)
+    return float(x.max()), tree_index.n_leaves
+
+def get_tree_style(tree, layouts):
+    tree_style = TreeStyle()
+    for layout in layouts:
+        layout.set_tree_style(tree, tree_style)
+    return tree_style
+
+def draw(drawer_class, tree, layouts, tree_style, panel, viewport, zoom):
+    """Graphic elements of one panel of the tree."""
+    drawer = drawer_class(tree, viewport, panel, zoom, layouts=layouts, tree_style=tree_style)
+    return list(drawer.draw())
+
+def render(tree, layouts, plot_file, tree_width=TREE_WIDTH, leaf_height=LEAF_HEIGHT):
+    """Draw `tree` with its active `layouts` into `plot_file` (.svg, .png or .pdf)."""
+    layouts = [layout for layout in layouts if layout.active]
+    tree_style = get_tree_style(tree, layouts)
+    dx, n_leaves = tree_size(tree)
+    zoom = (tree_width / dx if dx else 1, leaf_height)
+
+    elements = draw(DrawerRectFaces, tree, layouts, tree_style, 0, Box(0, 0, dx, n_leaves), zoom)
+    aligned, header = [], []
+    if any(layout.aligned_faces for layout in layouts):
+        aligned_viewport = Box(0, 0, ALIGNED_WIDTH, n_leaves)
+        aligned = draw(DrawerAlignRectFaces, tree, layouts, tree_style, 1, aligned_viewport, zoom)
+        header = draw(DrawerAlignRectFaces, tree, layouts, tree_style, HEADER_PANEL, aligned_viewport, zoom)
+
+    # the header goes above the tree, its height in pixels is that of its elements
+    measure = Canvas()
+    for element in header:
+        measure.add(element, lambda point: point)
+    header_height = measure.ymax
+
+    canvas = Canvas()
+    for element in elements:
+        canvas.add(element, lambda point: (point[0] * zoom[0], point[1] * zoom[1] + header_height))
+
+    # aligned faces are laid out in pixels from the right of the tree and its leaf names
+    x0 = canvas.xmax + ALIGNED_GAP
+    for element in aligned:
+        canvas.add(element, lambda point: (point[0] + x0, point[1] * zoom[1] + header_height))
+    for element in header:
+        canvas.add(element, lambda point: (point[0] + x0, point[1]))
+
+    return canvas.save(plot_file)